@@ -1,5 +1,6 @@
 from pathlib import Path
 import shutil
+from profiling import span, start_profile, stop_profile, PROFILE_FILE
 
 class BaseModel:
     """An abstract class representing an analysis.
@@ -55,6 +56,19 @@ class BaseModel:
         """
         raise NotImplemented()
 
+    def run(self, cprofile=False):
+        """Exports the analysis, writing the time and memory of its stages to
+        profile.json in the export dir (see `profiling`). With `cprofile`, 
+        also writes cProfile stats to profile.prof.
+        """
+        profiler = start_profile(cprofile=cprofile)
+        try:
+            with span("analysis", model=self.params['model']):
+                self.export()
+        finally:
+            stop_profile()
+            profiler.write(self.export_dir() / PROFILE_FILE)
+
     def export_dir(self):
         return Path(self.params['export_dir'])
 
@@ -1,9 +1,14 @@
 from pathlib import Path
 import pandas as pd
+import yaml
 from collections import defaultdict
+from datetime import timedelta
+from itertools import combinations
 import seaborn as sns
 import matplotlib.pyplot as plt
 from analysis.base import BaseModel
+from profiling import span
+from joint_attention import get_jva_episodes, merge_jva_episodes, read_jva_episodes
 from sklearn.linear_model import LinearRegression
 import statsmodels.api as sm
 from scipy.stats import ttest_ind
@@ -17,7 +22,9 @@ class JointAttentionCollaborationModel(BaseModel):
        whenever any dyad had JVA. 
      - When measure: player then each individual is considered; counting 
        JVA when they have JVA with any other group member.
-        
+
+    Percentages are of the segment's time, and are computed from JVA episodes 
+    (see `get_group_jva`). 
     """
     expected_params = [
         'model',
@@ -44,71 +51,80 @@ class JointAttentionCollaborationModel(BaseModel):
         data = []
         categorical = self.params.get('score_threshold') is not None
         for group in self.params['group_names']:
-            jva = self.get_jva_df(group)
-            players, pairwise_cols, player_cols = self.get_player_cols(jva)
+            with span("load jva", group=group):
+                episodes, pairs, start, end = get_group_jva(group)
+            seconds = (end - start).total_seconds()
+            players, pairwise_cols, player_cols = self.get_player_cols(pairs)
             score = scores.loc[group].mean()
             if categorical:
                 score = 'high' if score >= self.params['score_threshold'] else 'low'
 
             if self.params['measure'] == "pairwise":
                 for col in pairwise_cols:
+                    pair_episodes = episodes[episodes.pair == col]
                     data.append({
                         "group": group,
                         "group_size": len(players),
                         "collaboration_score": score,
-                        "percentage_jva": jva[col].mean(),
+                        "percentage_jva": pair_episodes.duration.sum() / seconds,
+                        "jva_episodes": len(pair_episodes),
                     })
             elif self.params['measure'] == "group":
+                group_episodes = merge_jva_episodes(episodes)
                 data.append({
                     "group": group,
                     "group_size": len(players),
                     "collaboration_score": score,
-                    "percentage_jva": jva[pairwise_jva_cols].any(axis=1).mean(),
+                    "percentage_jva": group_episodes.duration.sum() / seconds,
+                    "jva_episodes": len(group_episodes),
                 })
             elif self.params['measure'] == "player":
                 for player, cols in player_cols.items():
+                    player_episodes = merge_jva_episodes(episodes[episodes.pair.isin(cols)])
                     data.append({
                         "group": group,
                         "group_size": len(players),
                         "collaboration_score": score,
-                        "percentage_jva": jva[cols].any(axis=1).mean(),
+                        "percentage_jva": player_episodes.duration.sum() / seconds,
+                        "jva_episodes": len(player_episodes),
                     })
 
         df = pd.DataFrame.from_records(data)
         df.to_csv(self.export_dir() / (self.export_base_name + ".csv"))
 
-        if categorical:
-            bp = sns.barplot(x="collaboration_score", y="percentage_jva", data=df)
-            plt.xlabel("Collaboration level")
-            plt.ylabel("Percentage of segment spent in JVA")
-            bp.figure.savefig(self.export_dir() / (self.export_base_name + ".png"))
-            test = ttest_ind(
-                df[df.collaboration_score == "low"].percentage_jva,
-                df[df.collaboration_score == "high"].percentage_jva,
-                alternative="less",
-                equal_var=False,
-            )
-        else:
-            lm = sns.lmplot(x="percentage_jva", y="collaboration_score", data=df)
-            ax = lm.axes[0, 0]
-            ax.set_ylim([-0.5, 5.5])
-            ax.figure.savefig(self.export_dir() / (self.export_base_name + ".png"))
-            X = df.percentage_jva.to_numpy().reshape((-1, 1))
-            y = df.collaboration_score.to_numpy()
-            print(sm.OLS(y, X).fit().summary())
+        with span("plot and fit"):
+            if categorical:
+                bp = sns.barplot(x="collaboration_score", y="percentage_jva", data=df)
+                plt.xlabel("Collaboration level")
+                plt.ylabel("Percentage of segment spent in JVA")
+                bp.figure.savefig(self.export_dir() / (self.export_base_name + ".png"))
+                test = ttest_ind(
+                    df[df.collaboration_score == "low"].percentage_jva,
+                    df[df.collaboration_score == "high"].percentage_jva,
+                    alternative="less",
+                    equal_var=False,
+                )
+            else:
+                lm = sns.lmplot(x="percentage_jva", y="collaboration_score", data=df)
+                ax = lm.axes[0, 0]
+                ax.set_ylim([-0.5, 5.5])
+                ax.figure.savefig(self.export_dir() / (self.export_base_name + ".png"))
+                X = df.percentage_jva.to_numpy().reshape((-1, 1))
+                y = df.collaboration_score.to_numpy()
+                print(sm.OLS(y, X).fit().summary())
 
-        plt.clf()
-        vp = sns.violinplot(data=df, x="group_size", y="percentage_jva")
-        vp.get_figure().savefig(self.export_dir() / (self.export_base_name + "_group_size.png"))
+            plt.clf()
+            vp = sns.violinplot(data=df, x="group_size", y="percentage_jva")
+            vp.get_figure().savefig(self.export_dir() / (self.export_base_name + "_group_size.png"))
 
-    def get_player_cols(self, jva):
-        """Returns (players, pairwise_cols, player_cols) from JVA df
-        Pairwise JVA has column names like "X-Y"
+    def get_player_cols(self, pairs):
+        """Returns (players, pairwise_cols, player_cols) from JVA pair names
+        Pairwise JVA has names like "X-Y"
         players is like [a, b, c]
         pairwise_cols is like [a-b, a-c, b-c]
         player_cols is like {a: [a-b, a-c], b: [a-b, b-c], c: [a-c, b-c]}
         """
-        pairwise_cols = [col for col in jva.columns if '-' in col]
+        pairwise_cols = [col for col in pairs if '-' in col]
         players = set(sum([col.split('-') for col in pairwise_cols], []))
         player_cols = defaultdict(list)
         for col in pairwise_cols:
@@ -122,11 +138,32 @@ class JointAttentionCollaborationModel(BaseModel):
         df = df.drop(columns=["assessor"]).groupby("group").mean()
         return df
 
-    def get_jva_df(self, group):
-        "gets the JVA df for a group"
-        workshop_num = group[1]
-        f = Path("data/segments") / f"workshop_{workshop_num}_collaboration" / f"{group}_joint_attention.csv"
-        return pd.read_csv(f)
-        
-
+def get_segment_dir(group):
+    "Returns the export dir of the segment with a group's products"
+    workshop_num = group[1]
+    return Path("data/segments") / f"workshop_{workshop_num}_collaboration"
 
+def get_group_jva(group):
+    """Returns (episodes, pairs, start, end) for a group: its JVA episodes, the names 
+    of all its pairs (including pairs which never had JVA) and the segment's times. 
+    Episodes are read from the group's episodes file when its joint attention 
+    product has `episodes_filename`, and are otherwise computed from its boolean JVA.
+    """
+    segment_dir = get_segment_dir(group)
+    segment_params = yaml.safe_load((segment_dir / "params.yaml").read_text())
+    jva_filename = f"{group}_joint_attention.csv"
+    for product in segment_params['products']:
+        if product.get('export_filename') == jva_filename:
+            break
+    else:
+        raise ValueError("No joint attention product for group {} in {}".format(group, segment_dir))
+    players = list(product['players'].values())
+    pairs = [p0 + '-' + p1 for p0, p1 in combinations(players, 2)]
+    start = segment_params['start']
+    end = start + timedelta(seconds=segment_params['duration'])
+    if product.get('episodes_filename'):
+        episodes = read_jva_episodes(segment_dir / product['episodes_filename'])
+    else:
+        df = pd.read_csv(segment_dir / jva_filename, index_col="timestamp", parse_dates=["timestamp"])
+        episodes = get_jva_episodes(df, end=end)
+    return episodes, pairs, start, end
@@ -10,6 +10,9 @@ from collections import defaultdict
 import seaborn as sns
 import matplotlib.pyplot as plt
 from analysis.base import BaseModel
+from profiling import span
+from joint_attention import bin_jva_episodes
+from analysis.joint_attention import get_group_jva, get_segment_dir
 from sklearn.linear_model import LinearRegression
 import statsmodels.api as sm
 from scipy.stats import ttest_ind
@@ -40,14 +43,14 @@ class MultimodalCollaborationModel(BaseModel):
         scores = self.get_collaboration_assessment_scores()
         dfs = []
         for group in self.params['group_names']:
-            jva = self.get_jva_df(group)
+            with span("load jva", group=group):
+                episodes, pairs, start, end = get_group_jva(group)
             ba = self.get_ba_df(group).resample(g).sum()
             score = "high" if scores.loc[group].mean() >= self.params['score_threshold'] else "low"
-            players, pairwise_cols, player_cols = self.get_player_cols(jva)
+            players, pairwise_cols, player_cols = self.get_player_cols(pairs)
             for player, cols in player_cols.items():
-                playerdata = jva[cols].any(axis=1).to_frame("jva").resample(g).agg({
-                    "jva": (lambda sample: sample.any())
-                })
+                playerdata = bin_jva_episodes(episodes[episodes.pair.isin(cols)], start, end, g)
+                playerdata = playerdata.rename_axis("timestamp").to_frame("jva")
                 playerdata["player"] = player
                 playerdata["group"] = group
                 playerdata["group_size"] = len(players)
@@ -64,29 +67,30 @@ class MultimodalCollaborationModel(BaseModel):
         df = pd.concat(dfs)
         df.to_csv(self.export_dir() / (self.export_base_name + ".csv"))
 
-        df["jva_labeled"] = df.jva.apply(lambda jva: "JVA" if jva else "No JVA")
-        bp = sns.barplot(hue="collaboration_score", x="jva_labeled", y="block_actions", data=df, palette="viridis")
-        plt.ylabel("Block actions per second")
-        plt.xlabel("")
-        bp.figure.savefig(self.export_dir() / (self.export_base_name + ".png"))
+        with span("plot and test"):
+            df["jva_labeled"] = df.jva.apply(lambda jva: "JVA" if jva else "No JVA")
+            bp = sns.barplot(hue="collaboration_score", x="jva_labeled", y="block_actions", data=df, palette="viridis")
+            plt.ylabel("Block actions per second")
+            plt.xlabel("")
+            bp.figure.savefig(self.export_dir() / (self.export_base_name + ".png"))
 
-        high_delta = self.mean_block_actions(df, "high", True) - self.mean_block_actions(df, "high", False)
-        low_delta = self.mean_block_actions(df, "low", True) - self.mean_block_actions(df, "low", False)
-        test = ttest_ind(
-            high_delta,
-            low_delta,
-            equal_var=False,
-        )
-        print(test)
+            high_delta = self.mean_block_actions(df, "high", True) - self.mean_block_actions(df, "high", False)
+            low_delta = self.mean_block_actions(df, "low", True) - self.mean_block_actions(df, "low", False)
+            test = ttest_ind(
+                high_delta,
+                low_delta,
+                equal_var=False,
+            )
+            print(test)
 
-    def get_player_cols(self, jva):
-        """Returns (players, pairwise_cols, player_cols) from JVA df
-        Pairwise JVA has column names like "X-Y"
+    def get_player_cols(self, pairs):
+        """Returns (players, pairwise_cols, player_cols) from JVA pair names
+        Pairwise JVA has names like "X-Y"
         players is like [a, b, c]
         pairwise_cols is like [a-b, a-c, b-c]
         player_cols is like {a: [a-b, a-c], b: [a-b, b-c], c: [a-c, b-c]}
         """
-        pairwise_cols = [col for col in jva.columns if '-' in col]
+        pairwise_cols = [col for col in pairs if '-' in col]
         players = set(sum([col.split('-') for col in pairwise_cols], []))
         player_cols = defaultdict(list)
         for col in pairwise_cols:
@@ -100,16 +104,9 @@ class MultimodalCollaborationModel(BaseModel):
         df = df.drop(columns=["assessor"]).groupby("group").mean()
         return df
 
-    def get_jva_df(self, group):
-        "gets the JVA df for a group"
-        workshop_num = group[1]
-        f = Path("data/segments") / f"workshop_{workshop_num}_collaboration" / f"{group}_joint_attention.csv"
-        return pd.read_csv(f, index_col="timestamp", parse_dates=["timestamp"])
-
     def get_ba_df(self, group):
         "Gets the block activity dataframe for a group"
-        workshop_num = group[1]
-        f = Path("data/segments") / f"workshop_{workshop_num}_collaboration" / f"{group}_block_activity.csv"
+        f = get_segment_dir(group) / f"{group}_block_activity.csv"
         return pd.read_csv(f, index_col="timestamp", parse_dates=["timestamp"])
         
     def mean_block_actions(self, df, score, jva):
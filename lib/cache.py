@@ -0,0 +1,214 @@
+# A bounded, content-addressed cache for data derived from the logs
+#
+# Entries are keyed by a hash of what they were made from: a fingerprint of
+# the source data, the params used, and the version of the code which made
+# them. Changing any of these makes a new key, so stale entries are never
+# read; they are evicted, least recently used first, once the cache grows
+# past its disk budget. Dataframes are stored as Parquet, other entries as bytes.
+#
+# The cache's index (index.json) records each entry's size, kind, creation
+# and last use, and hit counts, plus the cache's budget and its total hits
+# and misses. It is locked while being updated, so several processes can
+# share a cache.
+
+import fcntl
+import inspect
+import json
+from contextlib import contextmanager
+from datetime import datetime
+from hashlib import md5
+from pathlib import Path
+import pandas as pd
+
+CACHE_DIR = "data/cache"
+DEFAULT_BUDGET = 2 * 1024 ** 3
+INDEX_FILE = "index.json"
+LOCK_FILE = "index.lock"
+DF_SUFFIX = ".parquet"
+BYTES_SUFFIX = ".bin"
+
+class CacheManager:
+    """Stores and retrieves cache entries in the directory at `path`.
+    `budget` is the cache's maximum size in bytes; when None, the budget
+    saved in the cache's index (or DEFAULT_BUDGET) is used.
+    """
+
+    def __init__(self, path=CACHE_DIR, budget=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+
+    def key(self, kind, source=None, params=None, code=None):
+        """Returns the key of an entry of `kind`, made from data with
+        fingerprint `source` (see `get_source_fingerprint`), using `params`,
+        by code with version `code` (see `get_code_version`). `params` must be
+        JSON-serializable; other values are converted with str.
+        """
+        description = json.dumps([kind, source, params, code], sort_keys=True, default=str)
+        return kind + "-" + md5(description.encode("utf-8")).hexdigest()
+
+    def get_df(self, key):
+        "Returns the dataframe stored at `key`, or None"
+        path = self.lookup(key, DF_SUFFIX)
+        return None if path is None else pd.read_parquet(path)
+
+    def put_df(self, key, df):
+        "Stores a dataframe at `key`"
+        path = self.path / (key + DF_SUFFIX)
+        df.to_parquet(path)
+        self.add_entry(key, path)
+
+    def get_bytes(self, key):
+        "Returns the bytes stored at `key`, or None"
+        path = self.lookup(key, BYTES_SUFFIX)
+        return None if path is None else path.read_bytes()
+
+    def put_bytes(self, key, data):
+        "Stores bytes at `key`"
+        path = self.path / (key + BYTES_SUFFIX)
+        path.write_bytes(data)
+        self.add_entry(key, path)
+
+    def contains(self, key):
+        "Checks whether there is an entry at `key`, without recording a hit or miss"
+        with self.index() as index:
+            entry = index["entries"].get(key)
+            return bool(entry) and (self.path / entry["file"]).exists()
+
+    def lookup(self, key, suffix):
+        """Returns the path of the entry at `key`, recording a hit, or None,
+        recording a miss.
+        """
+        path = self.path / (key + suffix)
+        with self.index() as index:
+            entry = index["entries"].get(key)
+            if entry and path.exists():
+                entry["last_used"] = datetime.now().isoformat()
+                entry["hits"] += 1
+                index["hits"] += 1
+                return path
+            index["misses"] += 1
+            return None
+
+    def add_entry(self, key, path):
+        "Records a new entry in the index, then evicts entries over budget"
+        with self.index() as index:
+            now = datetime.now().isoformat()
+            index["entries"][key] = {
+                "file": path.name,
+                "kind": key.split("-")[0],
+                "size": path.stat().st_size,
+                "created": now,
+                "last_used": now,
+                "hits": 0,
+            }
+            self.evict(index)
+
+    def evict(self, index, budget=None):
+        """Deletes least recently used entries until the cache fits in
+        `budget`. Returns the keys of the entries deleted.
+        """
+        budget = budget or self.budget or index["budget"]
+        entries = index["entries"]
+        size = sum(entry["size"] for entry in entries.values())
+        evicted = []
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if size <= budget:
+                break
+            size -= entries[key]["size"]
+            (self.path / entries[key]["file"]).unlink(missing_ok=True)
+            del entries[key]
+            evicted.append(key)
+        return evicted
+
+    def prune(self, budget=None):
+        """Evicts entries over `budget` (or the cache's budget), and forgets
+        entries whose files are missing. Returns the keys of the entries removed.
+        """
+        with self.index() as index:
+            missing = [k for k, e in index["entries"].items() if not (self.path / e["file"]).exists()]
+            for key in missing:
+                del index["entries"][key]
+            return missing + self.evict(index, budget)
+
+    def clear(self):
+        "Deletes all entries and resets stats. Returns the keys deleted."
+        with self.index() as index:
+            keys = list(index["entries"])
+            for entry in index["entries"].values():
+                (self.path / entry["file"]).unlink(missing_ok=True)
+            index.update(entries={}, hits=0, misses=0)
+            return keys
+
+    def set_budget(self, budget):
+        "Saves a new budget in bytes for the cache, evicting entries over it"
+        with self.index() as index:
+            index["budget"] = budget
+            return self.evict(index, budget)
+
+    def stats(self):
+        """Returns a dict with the cache's budget, size, number of entries,
+        hits, misses and hit rate, and its entries.
+        """
+        with self.index() as index:
+            entries = index["entries"]
+            lookups = index["hits"] + index["misses"]
+            return {
+                "budget": self.budget or index["budget"],
+                "size": sum(entry["size"] for entry in entries.values()),
+                "num_entries": len(entries),
+                "hits": index["hits"],
+                "misses": index["misses"],
+                "hit_rate": index["hits"] / lookups if lookups else 0.0,
+                "entries": entries,
+            }
+
+    @contextmanager
+    def index(self):
+        """Locks the cache's index and yields it as a dict. Changes to the dict
+        are saved when the block exits.
+        """
+        with open(self.path / LOCK_FILE, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index_path = self.path / INDEX_FILE
+            if index_path.exists():
+                index = json.loads(index_path.read_text())
+            else:
+                index = {"entries": {}, "hits": 0, "misses": 0, "budget": DEFAULT_BUDGET}
+            yield index
+            index_path.write_text(json.dumps(index, indent=2, sort_keys=True))
+
+def get_source_fingerprint(*paths, start=None, end=None, events=None):
+    """Returns a fingerprint of source data: for a log store, the partition
+    index entries of the partitions of `events` (all when None) which overlap 
+    the time range [start, end], which change whenever those partitions do,
+    and the store's column order; otherwise the paths, sizes and modification 
+    times of the files at `paths`. So syncing logs at other times, or of other
+    event types, doesn't change the fingerprint of data read from a store.
+    """
+    from logs.store import PARTITION_INDEX, COLUMN_ORDER, get_partition_entries, get_store_events
+
+    fingerprint = md5()
+    for path in paths:
+        path = Path(path)
+        if (path / PARTITION_INDEX).exists():
+            for event in get_store_events(path):
+                if not events or event in events:
+                    entries = get_partition_entries(path, event, start, end)
+                    fingerprint.update(json.dumps([event, entries], sort_keys=True).encode("utf-8"))
+            if (path / COLUMN_ORDER).exists():
+                fingerprint.update((path / COLUMN_ORDER).read_bytes())
+            continue
+        files = sorted(path.rglob("*")) if path.is_dir() else [path]
+        for f in files:
+            if f.is_file():
+                stat = f.stat()
+                fingerprint.update("{}:{}:{}".format(f, stat.st_size, stat.st_mtime).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+def get_code_version(*objects):
+    "Returns a hash of the source files of the given modules, classes or functions"
+    version = md5()
+    for obj in objects:
+        version.update(Path(inspect.getsourcefile(obj)).read_bytes())
+    return version.hexdigest()
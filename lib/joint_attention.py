@@ -1,3 +1,6 @@
+from collections import deque
+from itertools import combinations
+from math import isqrt
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import seaborn as sns
@@ -6,27 +9,62 @@ import numpy as np
 
 COORDS = ['x', 'y', 'z']
 ANGLES = ['pitch', 'yaw']
+LOCATION_GAZE_COLUMNS = (
+    ['location_' + c for c in COORDS] + 
+    ['eye_location_' + c for c in COORDS] + 
+    ['target_block_' + c for c in COORDS] + 
+    ['eye_direction_' + a for a in ANGLES]
+)
+EPISODE_COLUMNS = ['pair', 'start', 'end', 'duration', 'x', 'y', 'z']
 
 def get_location_gaze(df, players):
     """Converts a normalized logs df to a df with position and gaze columns
     for each player. Index is timestamps of the union of all player events.
     """
-    cols = (
-        ['location_' + c for c in COORDS] + 
-        ['eye_location_' + c for c in COORDS] + 
-        ['target_block_' + c for c in COORDS] + 
-        ['eye_direction_' + a for a in ANGLES]
-    )
     dfs = []
     for player in players:
         player_df = df[df.player == player]
-        player_col_names = {col: player + '_' + col for col in cols}
+        player_col_names = {col: player + '_' + col for col in LOCATION_GAZE_COLUMNS}
         player_df = player_df.rename(columns=player_col_names)
         dfs.append(player_df[player_col_names.values()])
     lgdf = pd.concat(dfs).sort_index()
     lgdf = lgdf.ffill().dropna()
     return lgdf
 
+def get_gaze_tensor(df, players, start, end, freq='1s', features=LOCATION_GAZE_COLUMNS):
+    """Returns (times, tensor), players' position and gaze on a fixed time grid. 
+    times is a DatetimeIndex every `freq` from `start` (floored to `freq`) until `end`.
+    tensor is a float32 array of shape (time, player, feature), holding each player's 
+    last known value of each of `features` at each time, or NaN before it is known.
+    Each player's values are found with an as-of lookup into that player's own rows
+    of df (a normalized logs df), so rows of different players are never combined or
+    sorted, and memory is proportional to the grid rather than to the events.
+    """
+    features = list(features)
+    times = pd.date_range(pd.Timestamp(start).floor(freq), end, freq=freq, inclusive='left', name='timestamp')
+    tensor = np.full((len(times), len(players), len(features)), np.nan, dtype=np.float32)
+    grid = times.as_unit('ns').asi8
+    event_times = df.index.as_unit('ns').asi8
+    feature_df = df[features]
+    player_rows = df.groupby('player', observed=True, sort=False).indices
+    for i, player in enumerate(players):
+        if player not in player_rows:
+            continue
+        rows = player_rows[player]
+        values = feature_df.iloc[rows].ffill().to_numpy(dtype=np.float32, na_value=np.nan)
+        last = np.searchsorted(event_times[rows], grid, side='right') - 1
+        known = last >= 0
+        tensor[known, i] = values[last[known]]
+    return times, tensor
+
+def gaze_tensor_to_lgdf(times, tensor, players, features=LOCATION_GAZE_COLUMNS):
+    """Converts the output of `get_gaze_tensor` to the layout of `get_location_gaze`,
+    with a column for each player's features, named like "a_target_block_x", and a 
+    row for each time at which all are known.
+    """
+    columns = [player + '_' + feature for player in players for feature in features]
+    return pd.DataFrame(tensor.reshape(len(times), -1), index=times, columns=columns).dropna()
+
 def distance_measure(df, key_a, key_b, location):
     """Computes the squared distance between two players for a given location.
     df should be in lgdf form. key_a and key_b refer to players; 
@@ -49,6 +87,265 @@ def joint_attention_schneider_pea_2013(df, key_a, key_b, distance_threshold=10,
     windows = joint.rolling(str(window_seconds)+'s')
     return windows.max().astype(bool)
 
+def joint_attention_schneider_pea_2013_all_pairs(df, players, distance_threshold=10, window_seconds=2, chunk_size=1 << 16):
+    """Computes `joint_attention_schneider_pea_2013` for every pair of players at once.
+    df should be in lgdf form, with a sorted timestamp index. Returns a df with the 
+    same index and a boolean column for each pair, named like "a-b", in the order of 
+    `itertools.combinations(players, 2)`. Target blocks are integer block coordinates,
+    so distances are computed in int32. Rows are processed in chunks of about
+    `chunk_size` values over all pairs, small enough to stay in cache.
+    The work is still per pair and row, so cost grows linearly with the number of
+    pairs: on 200k rows, 8 players (28 pairs) take about 0.15-0.2 s, about 5-7x
+    one pair (0.03 s), rather than the same as one pair.
+    """
+    players = list(players)
+    # Arrays are (player or pair, coordinate, time), so each pair's values are contiguous.
+    targets = np.zeros((len(players), len(COORDS), len(df)), dtype=np.int32)
+    known = np.ones((len(players), len(df)), dtype=bool)
+    for i, player in enumerate(players):
+        values = df[[player + '_target_block_' + c for c in COORDS]].to_numpy(dtype=float).T
+        missing = np.isnan(values)
+        known[i] = ~missing.any(axis=0)
+        np.copyto(targets[i], values, casting='unsafe', where=~missing)
+    all_known = known.all()
+    # A pair is joint when its squared distance d has d ** 2 <= distance_threshold,
+    # that is d <= limit. Differences are capped where they can no longer be joint,
+    # so their squares and sums fit in int32.
+    limit = isqrt(int(np.floor(distance_threshold))) if distance_threshold >= 0 else -1
+    cap = min(limit + 1, 1 << 14)
+    # Each row's window is (t - window_seconds, t], as in pandas' time-based rolling.
+    # A window's max is whether the last joint row up to t is in it; the last joint
+    # row of each pair carries over from one chunk of rows to the next.
+    times = df.index.tz_localize(None).to_numpy(dtype='datetime64[ns]').view(np.int64)
+    window_starts = np.searchsorted(times, times - int(window_seconds * 1e9), side='right').astype(np.int32)
+    a, b = np.triu_indices(len(players), 1)
+    # Pairs are grouped by their first player, which is compared against all later players.
+    pair_starts = np.searchsorted(a, range(len(players)))
+    windows = np.empty((len(a), len(df)), dtype=bool)
+    last_joint = np.full((len(a), 1), -1, dtype=np.int32)
+    step = max(1, chunk_size // max(1, len(a)))
+    dist = np.empty((len(a), step), dtype=np.int32)
+    diff = np.empty_like(dist)
+    for start in range(0, len(df), step):
+        stop = min(len(df), start + step)
+        chunk = targets[:, :, start:stop]
+        for i in range(len(players) - 1):
+            pairs = slice(pair_starts[i], pair_starts[i + 1])
+            d, t = dist[pairs, :stop - start], diff[pairs, :stop - start]
+            for c in range(len(COORDS)):
+                np.subtract(chunk[i + 1:, c], chunk[i, c], out=t)
+                np.abs(t, out=t)
+                np.minimum(t, cap, out=t)
+                if c == 0:
+                    np.square(t, out=d)
+                else:
+                    np.square(t, out=t)
+                    d += t
+        joint = dist[:, :stop - start] <= limit
+        if not all_known:
+            joint &= known[a, start:stop] & known[b, start:stop]
+        rows = np.where(joint, np.arange(start, stop, dtype=np.int32), np.int32(-1))
+        np.maximum(rows[:, :1], last_joint, out=rows[:, :1])
+        np.maximum.accumulate(rows, axis=1, out=rows)
+        last_joint = rows[:, -1:].copy()
+        np.greater_equal(rows, window_starts[start:stop], out=windows[:, start:stop])
+    names = [players[i] + '-' + players[j] for i, j in zip(a, b)]
+    return pd.DataFrame(windows.T, index=df.index, columns=names)
+
+def get_jva_episodes(df, end=None):
+    """Converts boolean JVA to episodes: runs of consecutive rows with JVA. df should be
+    in lgdf form, with a boolean column for each pair named like "a-b" (as returned
+    by `joint_attention_schneider_pea_2013_all_pairs`). Returns a df with a row for 
+    each episode, with columns:
+     - pair: the pair's column name
+     - start: timestamp of the episode's first row
+     - end: timestamp of the first row after the episode. Episodes still going at 
+       the last row end at `end`, or at the last row when `end` is None.
+     - duration: in seconds
+     - x, y, z: the mean over the episode's rows of the midpoint of the pair's target blocks
+    """
+    times = df.index
+    if end is None and len(df):
+        end = times[-1]
+    episodes = []
+    for pair in [col for col in df.columns if '-' in col]:
+        jva = df[pair].to_numpy(dtype=bool)
+        changes = np.diff(np.concatenate([[0], jva.astype(np.int8), [0]]))
+        starts = np.flatnonzero(changes == 1)
+        stops = np.flatnonzero(changes == -1)
+        player_a, player_b = pair.split('-')
+        midpoints = (
+            df[[player_a + '_target_block_' + c for c in COORDS]].to_numpy(dtype=float) + 
+            df[[player_b + '_target_block_' + c for c in COORDS]].to_numpy(dtype=float)
+        ) / 2
+        sums = np.concatenate([np.zeros((1, len(COORDS))), np.cumsum(midpoints, axis=0)])
+        means = (sums[stops] - sums[starts]) / (stops - starts)[:, np.newaxis]
+        ends = pd.Series(times[np.minimum(stops, len(df) - 1)])
+        ends[stops == len(df)] = end
+        pair_episodes = pd.DataFrame({
+            'pair': pair, 
+            'start': times[starts], 
+            'end': ends,
+            'x': means[:, 0], 
+            'y': means[:, 1], 
+            'z': means[:, 2],
+        })
+        episodes.append(pair_episodes)
+    if not episodes:
+        return pd.DataFrame(columns=EPISODE_COLUMNS)
+    episodes = pd.concat(episodes, ignore_index=True)
+    episodes['duration'] = (episodes.end - episodes.start).dt.total_seconds()
+    return episodes[EPISODE_COLUMNS]
+
+def merge_jva_episodes(episodes):
+    """Merges overlapping episodes, for example of several pairs, into a df 
+    with start, end, and duration of the times when any of them had JVA.
+    """
+    if len(episodes) == 0:
+        return pd.DataFrame(columns=['start', 'end', 'duration'])
+    episodes = episodes.sort_values('start')
+    starts = episodes.start.to_numpy()
+    ends = episodes.end.to_numpy()
+    # An episode starts a new merged episode unless it starts before every earlier one ends.
+    latest_ends = np.maximum.accumulate(ends)
+    new = np.concatenate([[True], starts[1:] > latest_ends[:-1]])
+    groups = np.cumsum(new) - 1
+    merged = pd.DataFrame({
+        'start': starts[new],
+        'end': pd.Series(ends).groupby(groups).max().to_numpy(),
+    })
+    merged['duration'] = (merged.end - merged.start).dt.total_seconds()
+    return merged
+
+def bin_jva_episodes(episodes, start, end, freq):
+    """Returns a boolean series with a bin of `freq` (like '1s') for each time from
+    `start` until `end`, which is True when any episode overlaps the bin.
+    """
+    bins = pd.date_range(pd.Timestamp(start).floor(freq), end, freq=freq, inclusive='left')
+    bin_starts = bins.to_numpy()
+    firsts = np.searchsorted(bin_starts, episodes.start.to_numpy(), side='right') - 1
+    lasts = np.searchsorted(bin_starts, episodes.end.to_numpy(), side='left') - 1
+    # Episodes without duration still mark their bin
+    lasts = np.maximum(firsts, lasts)
+    marks = np.zeros(len(bins) + 1, dtype=np.int64)
+    np.add.at(marks, np.clip(firsts, 0, len(bins)), 1)
+    np.add.at(marks, np.clip(lasts + 1, 0, len(bins)), -1)
+    return pd.Series(np.cumsum(marks[:-1]) > 0, index=bins)
+
+def write_jva_episodes(episodes, path):
+    episodes.to_csv(path, index=False)
+
+def read_jva_episodes(path):
+    "Reads episodes written by `write_jva_episodes`"
+    return pd.read_csv(path, parse_dates=['start', 'end'])
+
+class JointAttentionStream:
+    """Computes `joint_attention_schneider_pea_2013` for every pair of players 
+    incrementally, from a time-ordered stream of events, like those yielded by
+    `LogReader.iter_merged_events`. `update` adds one event and returns the JVA 
+    transitions it causes, so JVA can be computed live or over logs too large to 
+    load, in memory bounded by the number of pairs and the events in one window.
+
+    As in the lgdf form, every event of one of `players` is a tick, and players'
+    target blocks are carried forward from their last event which had one. Ticks
+    before every player has a target block are skipped. A pair's JVA at a tick is
+    the max of its joint attention over the ticks in the preceding window. For
+    boolean values the monotonic deque of a sliding max holds at most the last 
+    joint tick, so each pair only keeps that tick's time. Pairs which stop 
+    being joint are queued by when their window will expire; since ticks are in 
+    time order this queue is sorted, and each tick pops only expired pairs.
+    """
+    def __init__(self, players, distance_threshold=10, window_seconds=2):
+        self.players = list(players)
+        self.distance_threshold = distance_threshold
+        self.window = int(window_seconds * 1e9)
+        self.pairs = list(combinations(self.players, 2))
+        self.player_pairs = {player: [pair for pair in self.pairs if player in pair] for player in self.players}
+        self.targets = {}
+        self.joint = dict.fromkeys(self.pairs, False)
+        self.jva = dict.fromkeys(self.pairs, False)
+        self.last_joint = {}
+        self.expiries = deque()
+        self.time = None
+
+    def run(self, events):
+        "Yields the JVA transitions caused by each of `events`"
+        for event in events:
+            yield from self.update(event)
+
+    def update(self, event):
+        """Adds an event, a dict with 'timestamp', 'player' and 'target_block' 
+        (a list of coordinates, or 'target_block_x', etc.). Returns a list of 
+        transitions, dicts with the event's timestamp, the pair's name (like 
+        "a-b") and 'jva', which is True when JVA starts and False when it ends.
+        """
+        player = event.get("player")
+        if player not in self.player_pairs:
+            return []
+        target = self.get_target_block(event)
+        if target is not None:
+            self.targets[player] = target
+        if len(self.targets) < len(self.players):
+            return []
+        time = self.get_time(event["timestamp"])
+        if self.time is not None and time < self.time:
+            raise ValueError("Events must be in time order")
+        # Only the player's pairs can change, except at the first tick.
+        pairs = self.pairs if self.time is None else self.player_pairs[player]
+        for pair in pairs:
+            joint = self.is_joint(pair)
+            if self.joint[pair] and not joint:
+                self.last_joint[pair] = self.time
+                self.expiries.append((self.time + self.window, pair))
+            self.joint[pair] = joint
+        transitions = []
+        for pair in pairs:
+            if self.joint[pair] and not self.jva[pair]:
+                self.jva[pair] = True
+                transitions.append(self.transition(event, pair, True))
+        while self.expiries and self.expiries[0][0] <= time:
+            expiry, pair = self.expiries.popleft()
+            if self.jva[pair] and not self.joint[pair] and self.last_joint[pair] + self.window <= time:
+                self.jva[pair] = False
+                transitions.append(self.transition(event, pair, False))
+        self.time = time
+        return transitions
+
+    def get_jva(self):
+        "Returns the current JVA of each pair, keyed by pair name"
+        return {self.get_pair_name(pair): jva for pair, jva in self.jva.items()}
+
+    def is_joint(self, pair):
+        a, b = self.targets[pair[0]], self.targets[pair[1]]
+        dist = (b[0] - a[0]) ** 2 + (b[1] - a[1]) ** 2 + (b[2] - a[2]) ** 2
+        return dist ** 2 <= self.distance_threshold
+
+    def transition(self, event, pair, jva):
+        return {"timestamp": event["timestamp"], "pair": self.get_pair_name(pair), "jva": jva}
+
+    def get_pair_name(self, pair):
+        return pair[0] + '-' + pair[1]
+
+    def get_target_block(self, event):
+        "Returns an event's target block as a tuple, or None if it has none"
+        target = event.get("target_block")
+        if target is None:
+            target = [event.get("target_block_" + c) for c in COORDS]
+        try:
+            x, y, z = [float(value) for value in target]
+        except TypeError:
+            # A coordinate is None or pd.NA
+            return None
+        if x != x or y != y or z != z:
+            return None
+        return x, y, z
+
+    def get_time(self, timestamp):
+        "Returns a timestamp as int64 nanoseconds since the epoch"
+        if isinstance(timestamp, (int, np.integer)):
+            return int(timestamp)
+        return pd.Timestamp(timestamp).value
+
 def plot_boolean_joint_attention(df, colors=None):
     """Plots boolean values; returns figure
     """
@@ -1,80 +1,250 @@
+from itertools import product
+import numpy as np
+import pandas as pd
+from scipy import sparse
 from sklearn.cluster import DBSCAN
-from lib.joing_attention import get_location_gaze
+from joint_attention import COORDS
+
+TARGET_BLOCK_COLUMNS = ['target_block_' + c for c in COORDS]
 
 class JointAttentionDBSCAN:
     """Finds clusters of joint attention for multiple people over time.
-    TODO: Chris, submit a paper to CSCL 2024 about this.
 
-    Schneider & Pea (2013) follow Richardson & Dale (2005) in defining joint visual 
-    attention as when the gazes of a dyad are within a certain distance, within a 
-    certain time window. 
+    Schneider & Pea (2013) follow Richardson & Dale (2005) in defining joint visual
+    attention as when the gazes of a dyad are within a certain distance, within a
+    certain time window.
 
-    TODO: 
-    - Create a sparse distance matrix for the points, which takes into account the 
-      distance threshold and time window parameters. The distance is undefined when 
-      both points are from the same user. The effect of using such a sparse matrix is
-      that a gaze point can only join a cluster when it is within eps of someone else's 
-      gaze point. (It is not enough to be close to one's own gaze point at another timestep.)
-    - Perform DBSCAN. `min_samples` should be 2. Eps should be set to a constant, 
-      determined by how the distance matrix was computed.
+    The distance between two gaze points is the distance between their target blocks,
+    and is only defined when the points are from different users and within
+    `window_seconds` of each other. The distances are held in a sparse matrix, which
+    DBSCAN uses as precomputed distances, with eps of `distance_threshold`. The effect
+    is that a gaze point can only join a cluster when it is within eps of someone
+    else's gaze point. (It is not enough to be close to one's own gaze point at
+    another timestep.) `min_samples` is 2, so a point joins a cluster exactly when
+    anyone else's gaze was close to it.
 
     METHOD
-    1. Define a gaze point for each player at each moment. Reduce the granularity to make it 
-      manageable.
-    2. Create a sparse matrix defining pairwise 
+    1. Define a gaze point for each player at each event with a target block. A player's
+       points at the same target block within `resolution_seconds` are near-duplicates,
+       and are collapsed into one point, weighted by their number (as suggested in the
+       scikit-learn documentation). Points' times are approximate to within
+       `resolution_seconds`.
+    2. Create a sparse matrix of the defined distances which are within eps. Points are
+       hashed into cells of a grid over space (with sides of `distance_threshold`) and
+       time (with steps of `window_seconds`, a sweep of the sorted times), so each point
+       is only compared with the points in its own and adjacent cells.
+    3. Perform DBSCAN on the sparse matrix, with the points' weights.
 
     COMPLEXITY
-    This algorithm has O(n^2) time complexity. If there are n gaze points and k users, 
-    for each of k users, each of that user's (n/k) gaze points is compared with each of 
-    the (n - n/k) other gaze points, or n^2 (1 - 1/k). n dominates k. This metric does 
-    not respect the triangle inequality, so I doubt scikit-learn's O(n log n) optimizations 
-    can be applied. 
-
-    POSSIBLE OPTIMIZATIONS:
-    - As suggested in the scikit-learn documentation, "Another way to reduce memory 
-      and computation time is to remove (near-)duplicate points and use sample_weight 
-      instead."
-    - Using a rolling time window, we can greatly speed this up. We don't need to do most
-      of the comparisons.
+    Comparing every pair of n gaze points from k users would take n^2 (1 - 1/k)
+    comparisons. With the grid, a point is only compared with points close to it in
+    space and time, so the work is proportional to the number of neighbors, which
+    grows with the length of a session rather than with its square.
     """
-
-    def __init__(self, distance_threshold=10, window_ms=2):
+    min_samples = 2
+
+    def __init__(self, distance_threshold=10, window_seconds=2, resolution_seconds=0.5):
+        if distance_threshold <= 0:
+            raise ValueError("distance_threshold must be positive")
+        if window_seconds < 0:
+            raise ValueError("window_seconds must not be negative")
+        if resolution_seconds <= 0:
+            raise ValueError("resolution_seconds must be positive")
         self.distance_threshold = distance_threshold
-        self.window_ms = window_ms
-
-        def squared_distance(p0, p1):
-            """Computes the squared distance between point p0 and p1.
-            (Squared distance is used to save the expensive computation of
-            a square root. We use a suitable value of eps to compensate.)
-            """
-            return 
-
+        self.window_seconds = window_seconds
+        self.resolution_seconds = resolution_seconds
         self.dbscan = DBSCAN(
-            eps=TODO,
-            min_samples=2,
-            metric=distance
+            eps=distance_threshold,
+            min_samples=self.min_samples,
+            metric='precomputed'
         )
 
-    def fit(self, X):
-        """
+    def fit(self, df):
+        """Clusters the gaze points of a normalized logs df. Sets `points`, the gaze
+        points from `prepare_df` with each one's cluster in column `label` (-1 when
+        it is not in joint attention), and returns self.
         """
-        return self.dbscan.fit(X)
+        points = self.prepare_df(df)
+        graph = self.compute_sparse_matrix(points)
+        labels = np.full(len(points), -1)
+        if graph.nnz:
+            labels = self.dbscan.fit(graph, sample_weight=points.weight.to_numpy()).labels_
+            # A point whose weight reaches min_samples is a core point by itself, but
+            # its near-duplicates were never each other's neighbors, so it is noise.
+            linked = np.diff(graph.indptr) > 0
+            labels = np.where(linked, labels, -1)
+            labels[linked] = np.unique(labels[linked], return_inverse=True)[1]
+        points['label'] = labels
+        self.points = points
+        return self
 
-    def compute_sparse_matrix(self, df):
+    def prepare_df(self, df):
+        """Converts a normalized logs df into a df of gaze points, sorted by time, with
+        values (u, t, x, y, z, weight) where u is a user ID (an index into `players`),
+        t is a timestamp in ns, (x, y, z) are the coordinates of the target block and
+        weight is the number of near-duplicate gaze points collapsed into the point.
         """
+        df = df.dropna(subset=TARGET_BLOCK_COLUMNS)
+        self.players = sorted(df.player.unique())
+        self.tz = df.index.tz
+        index = df.index.tz_convert(None) if self.tz is not None else df.index
+        times = index.to_numpy(dtype='datetime64[ns]').view(np.int64)
+        points = pd.DataFrame({
+            'u': pd.Categorical(df.player, categories=self.players).codes.astype(np.int64),
+            't': times,
+            'bucket': times // int(self.resolution_seconds * 1e9),
+        })
+        for c, col in zip(COORDS, TARGET_BLOCK_COLUMNS):
+            points[c] = df[col].to_numpy(dtype=np.int64)
+        points = points.groupby(['u', 'bucket'] + COORDS, sort=False).t.agg(['min', 'size'])
+        points = points.reset_index().rename(columns={'min': 't', 'size': 'weight'})
+        points = points.sort_values('t', kind='stable').reset_index(drop=True)
+        points.insert(0, 'player', np.array(self.players, dtype=object)[points.u.to_numpy()])
+        return points[['player', 'u', 't'] + COORDS + ['weight']]
+
+    def compute_sparse_matrix(self, points):
+        """Returns a sparse (n, n) matrix of the distances between gaze points which
+        are close enough: from different users, within `window_seconds` of each other
+        and within `distance_threshold` of each other. Other distances are not stored.
+        Stored distances may be zero.
         """
+        n = len(points)
+        coords = points[COORDS].to_numpy(dtype=np.float64)
+        users = points.u.to_numpy()
+        times = points.t.to_numpy()
+        window = int(self.window_seconds * 1e9)
+        if n == 0:
+            return sparse.csr_matrix((0, 0))
+
+        # Points within the window are in the same or adjacent time steps, and points
+        # within the threshold are in the same or adjacent grid cells.
+        cells = np.column_stack([
+            np.floor(coords / self.distance_threshold).astype(np.int64),
+            times // (window + 1),
+        ])
+        # Cells are numbered rather than indexed into the whole grid, which may not fit
+        # in int64 (e.g. with far apart targets, or a window of zero).
+        cell_index = CellIndex(cells)
+        order = np.argsort(cell_index.ids, kind='stable')
+        _, cell_starts, cell_sizes = np.unique(cell_index.ids[order], return_index=True, return_counts=True)
+
+        rows, cols, dists = [], [], []
+        for offset in get_forward_offsets(cells.shape[1]):
+            pos = cell_index.find_adjacent(offset)
+            found = pos >= 0
+            a, b = np.flatnonzero(found), pos[found]
+            i, j = get_cell_pairs(cell_starts[a], cell_sizes[a], cell_starts[b], cell_sizes[b])
+            if not any(offset):
+                # Within a cell, each pair of points is compared once.
+                keep = i < j
+                i, j = i[keep], j[keep]
+            i, j = order[i], order[j]
+            close = (users[i] != users[j]) & (np.abs(times[i] - times[j]) <= window)
+            i, j = i[close], j[close]
+            squared = np.square(coords[i] - coords[j]).sum(axis=1)
+            close = squared <= self.distance_threshold ** 2
+            rows.append(i[close])
+            cols.append(j[close])
+            dists.append(np.sqrt(squared[close]))
+        rows, cols, dists = np.concatenate(rows), np.concatenate(cols), np.concatenate(dists)
+        return sparse.csr_matrix(
+            (np.concatenate([dists, dists]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+            shape=(n, n),
+        )
 
-    def close_enough(self, )
-
-
-    def prepare_df(self, df):
-        """Converts a Minecraft analytics dataframe into a series of gaze points 
-        with values (u, t, x, y, z) where U is a user ID, t is a timestamp, and 
-        (x, y, z) are spatial coordinates.
+    def get_clusters(self):
+        """Returns a df with a row for each cluster found by `fit`: its label, start and
+        end times, players (joined like "a-b-c"), number of gaze points and mean target
+        block, weighted by the gaze points' weights.
         """
-        user_lookup = {u:i for i, u in enumerate(sorted(df.player.unique()))}
-        df['u'] = df.player.apply(lambda u: user_lookup(u))
-
-
-
-
+        points = self.points[self.points.label >= 0]
+        weighted = points[COORDS].mul(points.weight, axis=0)
+        weighted['weight'] = points.weight
+        grouped = points.groupby('label')
+        clusters = pd.DataFrame({
+            'start': grouped.t.min(),
+            'end': grouped.t.max(),
+            'players': grouped.player.agg(lambda players: '-'.join(sorted(set(players)))),
+        })
+        sums = weighted.groupby(points.label).sum()
+        clusters['weight'] = sums.weight
+        for c in COORDS:
+            clusters[c] = sums[c] / sums.weight
+        for col in ['start', 'end']:
+            clusters[col] = pd.to_datetime(clusters[col], utc=self.tz is not None)
+            if self.tz is not None:
+                clusters[col] = clusters[col].dt.tz_convert(self.tz)
+        return clusters.reset_index()
+
+class CellIndex:
+    """Numbers the distinct rows of an integer array of cells from 0 (as `ids`, for
+    each row), and finds the numbers of adjacent cells. A cell's key combines the
+    ranks of its values among each column's values. When the next column's ranks
+    would overflow int64, the keys so far are first renumbered from 0, so keys fit
+    however far apart the values are.
+    """
+    def __init__(self, cells):
+        self.levels = []
+        ranks = np.empty(cells.shape[::-1], dtype=np.int64)
+        keys = np.zeros(len(cells), dtype=np.int64)
+        size = 1
+        for k, column in enumerate(cells.T):
+            values, ranks[k] = np.unique(column, return_inverse=True)
+            renumbered = None
+            if size * len(values) > np.iinfo(np.int64).max:
+                renumbered, keys = np.unique(keys, return_inverse=True)
+                size = len(renumbered)
+            keys = keys * len(values) + ranks[k]
+            size *= len(values)
+            # The rank of each value's neighbors, or -1 when they are not values.
+            adjacent = {o: find_sorted(values, values + o) for o in (-1, 1)}
+            self.levels.append((renumbered, len(values), adjacent))
+        self.keys, self.ids = np.unique(keys, return_inverse=True)
+        # Each distinct cell's ranks, by column.
+        self.ranks = np.empty((len(self.levels), len(self.keys)), dtype=np.int64)
+        self.ranks[:, self.ids] = ranks
+
+    def find_adjacent(self, offset):
+        """Returns, for each cell, the number of the cell at `offset` from it (-1, 0
+        or 1 in each column), or -1 where there is no such cell.
+        """
+        found = np.ones(len(self.keys), dtype=bool)
+        keys = np.zeros(len(self.keys), dtype=np.int64)
+        for ranks, o, (renumbered, size, adjacent) in zip(self.ranks, offset, self.levels):
+            if renumbered is not None:
+                keys = find_sorted(renumbered, keys)
+                found &= keys >= 0
+            if o:
+                ranks = adjacent[o][ranks]
+                found &= ranks >= 0
+            keys = keys * size + ranks
+        return np.where(found, find_sorted(self.keys, keys), -1)
+
+def find_sorted(sorted_values, values):
+    """Returns the position of each of values in sorted_values, or -1 when absent."""
+    pos = np.searchsorted(sorted_values, values)
+    found = pos < len(sorted_values)
+    found[found] = sorted_values[pos[found]] == values[found]
+    return np.where(found, pos, -1)
+
+def get_forward_offsets(ndim):
+    """Returns the offsets from a cell to itself and half of its adjacent cells in
+    `ndim` dimensions, such that each pair of adjacent cells is covered once.
+    """
+    offsets = []
+    for offset in product([-1, 0, 1], repeat=ndim):
+        nonzero = [o for o in offset if o]
+        if not nonzero or nonzero[0] > 0:
+            offsets.append(offset)
+    return np.array(offsets, dtype=np.int64)
+
+def get_cell_pairs(a_starts, a_sizes, b_starts, b_sizes):
+    """Returns (i, j), the positions of every pair of a point in cell a and a point in
+    cell b, for each pair of cells (a, b), given the cells' starts and sizes.
+    """
+    counts = a_sizes * b_sizes
+    cell = np.repeat(np.arange(len(counts)), counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    i = a_starts[cell] + within // b_sizes[cell]
+    j = b_starts[cell] + within % b_sizes[cell]
+    return i, j
@@ -0,0 +1,69 @@
+# Benchmarks and checks for log parsing
+
+from pathlib import Path
+from itertools import islice
+import gzip
+from time import perf_counter
+from logs.reader import LogReader
+
+def benchmark_parsers(logs_path, max_lines=100000):
+    """Times `LogReader.parse_line` against the fast path, `LogReader.parse_lines`,
+    on up to `max_lines` lines read from the log files in `logs_path`. 
+    Lines are read into memory first so that only parsing is timed.
+    Returns a dict mapping each parser to lines per second.
+    """
+    reader = LogReader(logs_path)
+    files = []
+    remaining = max_lines
+    for f in reader.log_files:
+        if remaining <= 0:
+            break
+        opener = gzip.open if f.suffix == reader.compressed_log_suffix else open
+        with opener(f, 'rt') as fh:
+            lines = list(islice(fh, remaining))
+        files.append((f, lines))
+        remaining -= len(lines)
+    num_lines = max_lines - remaining
+
+    start = perf_counter()
+    for f, lines in files:
+        for linenum, line in enumerate(lines):
+            reader.parse_line(line, linenum+1, f)
+    parse_line_time = perf_counter() - start
+
+    start = perf_counter()
+    for f, lines in files:
+        for i in range(0, len(lines), reader.parse_chunk_size):
+            reader.parse_lines(lines[i:i+reader.parse_chunk_size], f, i+1)
+    parse_lines_time = perf_counter() - start
+
+    return {
+        "lines": num_lines,
+        "parse_line": num_lines / parse_line_time,
+        "parse_lines": num_lines / parse_lines_time,
+    }
+
+def check_to_df(logs_path, workers=None, merge=False):
+    """Checks `LogReader.to_df` against the original reader, which parsed every line
+    with `LogReader.parse_line` and converted all the records at once, so that batching, 
+    splitting files and merging can't change the result's columns or dtypes. 
+    Returns a list of differences, which is empty when the dataframes match.
+    """
+    reader = LogReader(logs_path)
+    records = []
+    for f in reader.log_files:
+        opener = gzip.open if f.suffix == reader.compressed_log_suffix else open
+        with opener(f, 'rt') as fh:
+            for linenum, line in enumerate(fh):
+                records.append(reader.parse_line(line, linenum+1, f))
+    expected = reader.records_to_df(records)
+    df = LogReader(logs_path).to_df(workers=workers, merge=merge)
+    differences = []
+    if list(df.columns) != list(expected.columns):
+        differences.append("columns are {}, expected {}".format(list(df.columns), list(expected.columns)))
+    for col in expected.columns.intersection(df.columns):
+        if df[col].dtype != expected[col].dtype:
+            differences.append("{} is {}, expected {}".format(col, df[col].dtype, expected[col].dtype))
+    if len(df) != len(expected):
+        differences.append("{} rows, expected {}".format(len(df), len(expected)))
+    return differences
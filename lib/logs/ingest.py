@@ -0,0 +1,134 @@
+# Incremental ingest of SuperLog files into the log store
+
+import json
+import gzip
+from hashlib import md5
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from logs.store import write_logs, append_logs
+
+MANIFEST_SUFFIX = ".manifest.json"
+HEAD_LENGTH = 1024
+
+class LogManifest:
+    """Records how much of each log file has been ingested into a log store.
+    For each file (keyed by path), stores:
+        - size and mtime: the file's stat when it was last read
+        - offset: the byte offset up to which the file has been parsed. For 
+          gzip files this is a member boundary in the compressed file.
+        - lines: the number of lines parsed so far
+        - head and head_length: an md5 hash of the file's first (decompressed) 
+          bytes, used to detect files which were truncated or replaced.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if self.path.exists():
+            self.files = json.loads(self.path.read_text())
+        else:
+            self.files = {}
+
+    def save(self):
+        self.path.write_text(json.dumps(self.files, indent=2, sort_keys=True))
+
+def get_manifest_path(store_path):
+    "Returns the path of the manifest which sits next to a log store"
+    store_path = Path(store_path)
+    return store_path.parent / (store_path.name + MANIFEST_SUFFIX)
+
+def ingest_logs(reader, store_path, workers=None, incremental=True):
+    """Parses `reader`'s log files into the log store at `store_path` and
+    records what was read in the store's manifest. Returns the number of new events.
+
+    When `incremental`, only lines appended since the last ingest are parsed and
+    appended to the store. New files are parsed in full, and a log file which
+    SuperLog rotated into a .gz file is continued where we left off. If any
+    file was truncated or replaced, we can't tell which of the store's rows
+    came from it, so every file is re-parsed and the store is rebuilt.
+    When `workers` is greater than 1, files are parsed in parallel. Parse
+    stats for the files read are recorded in `reader.file_stats`.
+    """
+    store_path = Path(store_path)
+    manifest = LogManifest(get_manifest_path(store_path))
+    tasks = None
+    if incremental and store_path.exists():
+        tasks = plan_ingest(reader.log_files, manifest)
+    rebuild = tasks is None
+    if rebuild:
+        manifest.files = {}
+        if reader.quarantine_path and reader.quarantine_path.exists():
+            reader.quarantine_path.unlink()
+        tasks = [(f, 0, 0, 1) for f in reader.log_files]
+    stats = {f: f.stat() for f, offset, skip, linenum in tasks}
+    if tasks:
+        if workers and workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(reader.read_file_tail, *zip(*tasks)))
+        else:
+            results = [reader.read_file_tail(*task) for task in tasks]
+    else:
+        results = []
+    reader.add_file_stats([file_stats for df, new_offset, num_lines, file_stats in results])
+
+    dfs = [df for df, new_offset, num_lines, file_stats in results if df is not None]
+    if rebuild:
+        if len(dfs) == 0:
+            raise ValueError("No events found in log files")
+        write_logs(reader.merge_sorted_dfs(dfs), store_path)
+    elif dfs:
+        append_logs(reader.merge_sorted_dfs(dfs), store_path)
+
+    for (f, offset, skip, linenum), (df, new_offset, num_lines, file_stats) in zip(tasks, results):
+        head = get_file_head(f, HEAD_LENGTH)
+        manifest.files[str(f)] = {
+            "size": stats[f].st_size,
+            "mtime": stats[f].st_mtime,
+            "offset": new_offset,
+            "lines": linenum - 1 + num_lines,
+            "head": md5(head).hexdigest(),
+            "head_length": len(head),
+        }
+    current_files = set(str(f) for f in reader.log_files)
+    manifest.files = {k: v for k, v in manifest.files.items() if k in current_files}
+    manifest.save()
+    return sum(len(df) for df in dfs)
+
+def plan_ingest(log_files, manifest):
+    """Compares log files against the manifest and returns a list of 
+    (logfile, offset, skip, first_linenum) arguments for `LogReader.read_file_tail`,
+    covering only the unread parts of files. Returns None when a file was
+    truncated or replaced, meaning everything must be re-parsed.
+    """
+    tasks = []
+    current_files = set(str(f) for f in log_files)
+    for f in log_files:
+        entry = manifest.files.get(str(f))
+        if entry is None:
+            # Was this file rotated from a log file we have already read?
+            original = str(f.with_suffix(""))
+            rotated_entry = manifest.files.get(original)
+            if f.suffix == ".gz" and rotated_entry and original not in current_files:
+                if not head_matches(f, rotated_entry):
+                    return None
+                tasks.append((f, 0, rotated_entry["offset"], rotated_entry["lines"] + 1))
+            else:
+                tasks.append((f, 0, 0, 1))
+        else:
+            stat = f.stat()
+            if stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+                continue
+            if stat.st_size < entry["offset"] or not head_matches(f, entry):
+                return None
+            tasks.append((f, entry["offset"], 0, entry["lines"] + 1))
+    return tasks
+
+def head_matches(logfile, entry):
+    "Checks whether a file still begins with the bytes recorded in its manifest entry"
+    head = get_file_head(logfile, entry["head_length"])
+    return len(head) == entry["head_length"] and md5(head).hexdigest() == entry["head"]
+
+def get_file_head(logfile, length):
+    "Returns the first `length` bytes of a log file, decompressing if needed"
+    opener = gzip.open if Path(logfile).suffix == ".gz" else open
+    with opener(logfile, 'rb') as fh:
+        return fh.read(length)
@@ -2,9 +2,22 @@ from pathlib import Path
 import json
 import re
 from datetime import datetime
+import heapq
+from itertools import islice
+from operator import itemgetter
+import numpy as np
 import pandas as pd
 import code
 import gzip
+import zlib
+import io
+import mmap
+import time
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from orjson import loads as fast_json_loads
+except ImportError:
+    from json import loads as fast_json_loads
 
 class LogReader:
     """
@@ -14,19 +27,71 @@ class LogReader:
     For example:
 
         [2021-06-26T13:37:26.0801][PlayerMoveEvent]: "player": "thispettypace", "location": [33, 71, 99], "eye_location": [33, 71, 98], "eye_direction": [45.60006, 129.45012], "target_block": [32, 71, 98]
+
+    `parse_line` parses one line at a time. `parse_lines` is the fast path
+    used when reading files: it uses precompiled patterns, decodes JSON with
+    orjson when it is installed, and parses a whole batch of timestamps at once.
+
+    Reads can be filtered to a time range [start, end], to `events` and to
+    `players`. Files whose path names another player are skipped, and lines
+    are checked against their [timestamp][event] header before their JSON
+    data is decoded, so rejected lines cost little more than a regex match.
+
+    Files are read as bytes: plain log files are memory-mapped and gzip files
+    are decompressed a block at a time. Lines are matched in place in the
+    buffer, so only the fields of each line are copied out of it. Log
+    files are written in time order, so a read stops once it passes `end`, 
+    and a read of a plain log file with a `start` binary-searches to it.
+
+    By default, the first malformed line raises LogReader.ParseError. When
+    `lenient`, bad lines are skipped instead, and appended (one JSON object
+    per line, with their file:line location) to `quarantine_path` once their
+    file has been read. A gzip file which is cut off or corrupt is read up 
+    to the damage, and its partial last line is treated as a bad line. Either
+    way, `file_stats` counts the lines, events and errors of each file read, 
+    and whether it was truncated, and `report` summarizes them.
     """
     log_line_pattern = "^\[(?P<timestamp>.+?)\]\[(?P<event>.+?)\](\[Cancelled\])?: (?P<data>.*)$"
     command_pattern = '"command":\s*(".*")'
+    log_line_bytes_regex = re.compile(log_line_pattern.encode())
+    # Matches any one line, including its newline. Lines which aren't log 
+    # lines match the `bad` group.
+    any_line_pattern = "^(?:{}|(?P<bad>.*))$\n?".format(log_line_pattern[1:-1])
+    any_line_regex = re.compile(any_line_pattern, re.MULTILINE)
+    any_line_bytes_regex = re.compile(any_line_pattern.encode(), re.MULTILINE)
+    command_regex = re.compile(command_pattern)
     log_timestamp_format = "%Y-%m-%dT%H:%M:%S.%f"
     log_suffix = ".log"
     compressed_log_suffix = ".gz"
+    default_batch_size = 100000
+    parse_chunk_size = 10000
+    split_size = 64 * 1024 * 1024
+    gzip_block_size = 4 * 1024 * 1024
+    timestamp_prefix_format = "%Y-%m-%dT%H:%M:%S"
+    list_cols = [
+        ["location", ["location_x", "location_y", "location_z"]],
+        ["eye_location", ["eye_location_x", "eye_location_y", "eye_location_z"]],
+        ["eye_direction",["eye_direction_pitch", "eye_direction_yaw"]],
+        ["target_block", ["target_block_x", "target_block_y", "target_block_z"]],
+    ]
     streams = None
 
-    def __init__(self, logs_path, player_name=None):
+    def __init__(self, logs_path, player_name=None, start=None, end=None, events=None, players=None,
+            lenient=False, quarantine_path=None):
         """Logspath should be a single file or a directory. If `logs_path` is a
         directory, all files ending in '.log' or '.gz will be parsed.
+        `start` and `end` are datetimes; `events` and `players` are lists of
+        names to keep.
         """
         self.player_name = player_name
+        self.lenient = lenient
+        self.quarantine_path = Path(quarantine_path) if quarantine_path else None
+        self.file_stats = {}
+        self.rejected_lines = {}
+        self.start = pd.Timestamp(start) if start is not None else None
+        self.end = pd.Timestamp(end) if end is not None else None
+        self.events = set(events) if events is not None else None
+        self.players = set(players) if players is not None else None
         logs_path = Path(logs_path)
         if not logs_path.exists():
             raise ValueError("logs_path {} does not exist".format(logs_path))
@@ -34,37 +99,492 @@ class LogReader:
             glob_pattern = "**/*[{}][{}]".format(self.log_suffix, self.compressed_log_suffix)
             self.log_files = list(logs_path.glob(glob_pattern))
         else:
-            self.log_files = logs_path
+            self.log_files = [logs_path]
         if len(self.log_files) == 0:
             raise ValueError("No matching log files found")
+        if self.players is not None:
+            self.log_files = [f for f in self.log_files if self.file_player_matches(f)]
+
+    def file_player_matches(self, logfile):
+        """Checks whether a log file may contain events from `players`. Files
+        whose player can't be told from the path may contain anyone's events.
+        """
+        player = self.player_name or self.get_player_name(logfile)
+        return player is None or player in self.players
 
-    def to_df(self):
+    def to_df(self, workers=None, merge=False):
         """Returns a dataframe from all log files.
-        Currently, this is done in memory and ignores the fact that each log
-        file is sorted (we could merge logs in O(n) instead of O(nlog(n)) but 
-        we'd lose built-in sort optimizations). The dataframe can be cached as
-        CSV so this doesn't need to happen every run.
+        By default, files' events are concatenated in file order. When
+        `merge`, the result is globally time-ordered: each log file is already
+        sorted, so the per-file dataframes are merged rather than sorted
+        (see `merge_sorted_dfs`). The dataframe can be cached so this doesn't
+        need to happen every run.
+
+        Each file is streamed through `iter_file_events` and batched into
+        dataframes, so parsing never holds more than one batch of dicts.
+        When `workers` is greater than 1, log files are parsed in parallel
+        by a pool of `workers` processes, with files larger than `split_size`
+        split into byte ranges (see `plan_file_reads`). Each worker sends back
+        a dataframe for one range (which pickles as a few column arrays rather
+        than a list of dicts), and these are concatenated in file order,
+        exactly as in the serial path. Workers also send back their `file_stats`.
+        """
+        if workers and workers > 1:
+            tasks = self.plan_file_reads()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self.read_file_df_with_stats, *zip(*tasks)))
+            dfs = [df for df, stats in results]
+            for f in self.log_files:
+                self.file_stats.pop(str(f), None)
+            self.add_file_stats([stats for df, stats in results])
+        else:
+            dfs = [self.read_file_df(f) for f in self.log_files]
+        dfs = [df for df in dfs if df is not None]
+        if len(dfs) == 0:
+            raise ValueError("No events found in log files")
+        if merge:
+            return self.merge_sorted_dfs(dfs)
+        return self.concat_dfs(dfs)
+
+    def merge_sorted_dfs(self, dfs):
+        """Merges dataframes which are each sorted by timestamp into one
+        time-ordered dataframe. numpy's stable sort of timestamps is timsort, 
+        which finds the k pre-sorted runs and merges them in O(n log k) instead 
+        of sorting from scratch, so this is the k-way merge of `iter_merged_events`
+        done in C. (Merging with a heap in Python, even a whole run of a file at 
+        a time, is about 100x slower, since players' events interleave into 
+        nearly as many runs as rows; merging the files pairwise with numpy's 
+        searchsorted is still about 5x slower.) Ties keep file order, matching 
+        `iter_merged_events`. A file which turns out not to be sorted is sorted
+        on its own first.
+        """
+        dfs = [df if df.index.is_monotonic_increasing else df.sort_index(kind="stable") for df in dfs]
+        df = self.concat_dfs(dfs)
+        order = np.argsort(df.index.values, kind="stable")
+        return df.iloc[order]
+
+    def concat_dfs(self, dfs):
+        """Concatenates dataframes of consecutive events, with columns in the order 
+        they would have if all the events were converted at once (see `get_column_order`).
         """
-        logs = []
+        df = pd.concat(dfs)
+        return df[self.get_column_order(dfs)]
+
+    def get_column_order(self, dfs):
+        """Returns the columns of dataframes of consecutive events (as produced by
+        `records_to_df`) in the order `records_to_df` gives them for all the events 
+        at once: columns in order of their first appearance, and then the columns 
+        split from list-valued columns.
+        """
+        split = [col for oldcol, newcols in self.list_cols for col in newcols]
+        columns = {col: None for df in dfs for col in df.columns if col not in split}
+        present = set(col for df in dfs for col in df.columns)
+        return list(columns) + [col for col in split if col in present]
+
+    def plan_file_reads(self):
+        """Returns a list of (logfile, start, end) byte ranges covering all log
+        files, splitting files larger than `split_size` so that several workers
+        can parse them. For gzip files, ranges are offsets into the 
+        decompressed data, whose size is read from the gzip trailer.
+        """
+        tasks = []
         for f in self.log_files:
-            if f.suffix == self.compressed_log_suffix:
-                opener = lambda f: gzip.open(f, 'rt')
+            size = self.get_data_size(f)
+            num_ranges = max(1, -(-size // self.split_size))
+            bounds = [i * size // num_ranges for i in range(num_ranges)] + [None]
+            tasks.extend((f, start, end) for start, end in zip(bounds[:-1], bounds[1:]))
+        return tasks
+
+    def get_data_size(self, logfile):
+        """Returns the size of a log file's data. For gzip files this is the
+        decompressed size (modulo 2**32) of the last member, which is the whole 
+        file for gzip files with one member; it only affects how files are split.
+        """
+        logfile = Path(logfile)
+        if logfile.suffix != self.compressed_log_suffix:
+            return logfile.stat().st_size
+        with open(logfile, 'rb') as fh:
+            fh.seek(0, io.SEEK_END)
+            if fh.tell() < 4:
+                return 0
+            fh.seek(-4, io.SEEK_END)
+            return int.from_bytes(fh.read(4), "little")
+
+    def read_file_df(self, logfile, start=0, end=None):
+        """Parses a single log file, or the lines starting within the byte range
+        [start, end) of it, and returns a dataframe, or None if there are no
+        events. The file is read in batches, so the only full-size copy of its
+        events is the returned dataframe.
+        """
+        dfs = list(self.batch_events(self.iter_file_events(logfile, start, end)))
+        if len(dfs) == 0:
+            return None
+        return self.concat_dfs(dfs)
+
+    def read_file_df_with_stats(self, logfile, start=0, end=None):
+        """Like `read_file_df`, but returns (df, stats) so that a worker process
+        can send the file's stats back.
+        """
+        df = self.read_file_df(logfile, start, end)
+        return df, self.file_stats.get(str(logfile))
+
+    def add_file_stats(self, stats_list):
+        """Records file stats sent back from worker processes, adding up the
+        stats of files which were split between workers.
+        """
+        for stats in stats_list:
+            if stats is None:
+                continue
+            if stats["file"] in self.file_stats:
+                total = self.file_stats[stats["file"]]
+                for key in ["lines", "events", "errors", "seconds"]:
+                    total[key] += stats[key]
+                total["truncated"] = total.get("truncated", False) or stats.get("truncated", False)
             else:
-                opener = open
-            with opener(f) as fh:
-                for linenum, line in enumerate(fh):
-                    logs.append(self.parse_line(line, linenum+1, f))
-        df = pd.DataFrame.from_records(logs, index="timestamp")
-        list_cols = [
-            ["location", ["location_x", "location_y", "location_z"]],
-            ["eye_location", ["eye_location_x", "eye_location_y", "eye_location_z"]],
-            ["eye_direction",["eye_direction_pitch", "eye_direction_yaw"]],
-            ["target_block", ["target_block_x", "target_block_y", "target_block_z"]],
-        ]
-        for oldcol, newcols in list_cols:
+                self.file_stats[stats["file"]] = dict(stats)
+
+    def iter_events(self):
+        """Yields parsed events (dicts) from all log files, one at a time.
+        Only the current line is held in memory.
+        """
+        for f in self.log_files:
+            yield from self.iter_file_events(f)
+
+    def iter_file_events(self, logfile, start=0, end=None):
+        """Yields parsed events from a single log file, or from the lines 
+        starting within the byte range [start, end) of it. Lines are read and
+        parsed in chunks of `parse_chunk_size` using `parse_lines`, so
+        events' timestamps are int64 nanoseconds since the epoch.
+        """
+        logfile = Path(logfile)
+        if logfile.suffix == self.compressed_log_suffix:
+            chunks = self.iter_gzip_line_chunks(logfile, start, end)
+        else:
+            chunks = self.iter_mmap_line_chunks(logfile, start, end)
+        yield from self.iter_chunk_events(chunks, logfile)
+
+    def iter_chunk_events(self, chunks, logfile):
+        """Yields parsed events from (first_linenum, matches) chunks of `logfile`.
+        Resets the file's stats, and quarantines its bad lines once the chunks
+        are finished. Stops early once a chunk ends after the reader's `end`.
+        """
+        self.file_stats[str(logfile)] = {"file": str(logfile), "lines": 0, "events": 0, "errors": 0, "seconds": 0.0,
+                "truncated": False}
+        self.rejected_lines[str(logfile)] = []
+        for linenum, matches in chunks:
+            yield from self.parse_matches(matches, logfile, linenum)
+            if self.is_after_end(matches[-1]):
+                break
+        self.write_quarantine(logfile)
+
+    def is_after_end(self, match):
+        "Checks whether a matched line's timestamp is past the reader's `end`"
+        timestamp = match.group('timestamp')
+        if self.end is None or timestamp is None:
+            return False
+        if not isinstance(timestamp, str):
+            timestamp = timestamp.decode()
+        end_prefix = self.end.strftime(self.timestamp_prefix_format)
+        return timestamp[:len(end_prefix)] > end_prefix
+
+    def iter_mmap_line_chunks(self, logfile, start=0, end=None):
+        """Yields (first_linenum, matches) chunks from a memory-mapped plain log
+        file. When the reader has a `start`, skips ahead to it.
+        """
+        if Path(logfile).stat().st_size == 0:
+            return
+        with open(logfile, 'rb') as fh:
+            buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = self.find_line_start(buffer, start)
+            if self.start is not None:
+                start = max(start, self.seek_time(buffer, self.start))
+            end = len(buffer) if end is None else self.find_line_start(buffer, end)
+            first_linenum = 1 + self.count_lines(buffer, 0, start)
+            yield from self.match_lines(buffer, first_linenum, start, end)
+        finally:
+            buffer.close()
+
+    def iter_gzip_line_chunks(self, logfile, start=0, end=None):
+        """Yields (first_linenum, matches) chunks from a gzip log file, which is 
+        decompressed `gzip_block_size` bytes at a time. `start` and `end` are 
+        offsets into the decompressed data; lines before `start` are counted
+        but not split, and decompression stops at `end`. A file which is cut 
+        off or corrupt ends where the damage starts, and its partial last line
+        is rejected (see `reject_truncated_tail`).
+        """
+        linenum = 1
+        offset = 0
+        pending = b''
+        with gzip.open(logfile, 'rb') as fh:
+            while end is None or offset < end:
+                block, truncated = self.read_gzip_block(fh)
+                buffer = pending + block
+                if not buffer and not truncated:
+                    break
+                complete = len(buffer) if not (block or truncated) else buffer.rfind(b'\n') + 1
+                line_start = self.find_line_start(buffer, start - offset, complete)
+                line_end = complete if end is None else self.find_line_start(buffer, end - offset, complete)
+                line_end = max(line_start, line_end)
+                linenum += self.count_lines(buffer, 0, line_start)
+                yield from self.match_lines(buffer, linenum, line_start, line_end)
+                linenum += self.count_lines(buffer, line_start, complete)
+                pending = buffer[complete:]
+                offset += complete
+                if truncated:
+                    # The partial line belongs to the range in which it starts.
+                    if start <= offset and (end is None or offset < end):
+                        self.reject_truncated_tail(logfile, linenum, pending)
+                    break
+                if not block:
+                    break
+
+    def read_gzip_block(self, fh):
+        """Reads up to `gzip_block_size` bytes of decompressed data from an open
+        gzip file. Returns (block, truncated), where truncated is True when the
+        file ends within a member or is corrupt; block then holds the data which
+        could be decompressed before the damage.
+        """
+        parts = []
+        size = 0
+        while size < self.gzip_block_size:
+            try:
+                # read1 decompresses a little at a time, so the data before 
+                # the damage is kept when a read fails.
+                part = fh.read1(self.gzip_block_size - size)
+            except (EOFError, gzip.BadGzipFile, zlib.error):
+                return b''.join(parts), True
+            if not part:
+                break
+            parts.append(part)
+            size += len(part)
+        return b''.join(parts), False
+
+    def iter_truncated_chunks(self, chunks, logfile, linenum, tail):
+        "Yields the chunks of a gzip log file which was cut off, then rejects its partial last line"
+        yield from chunks
+        self.reject_truncated_tail(logfile, linenum, tail)
+
+    def reject_truncated_tail(self, logfile, linenum, tail):
+        """Handles the end of a gzip log file which was cut off or is corrupt:
+        marks the file as truncated in `file_stats`, and rejects its partial 
+        last line `tail` (which may be empty), numbered `linenum`.
+        """
+        stats = self.file_stats.get(str(logfile))
+        if stats is not None:
+            stats["truncated"] = True
+            stats["lines"] += 1 if tail else 0
+            stats["errors"] += 1
+        self.reject_line(logfile, linenum, tail, self.ParseError(
+                "{} is truncated or corrupt after line {}".format(logfile, linenum - 1)))
+
+    def match_lines(self, buffer, first_linenum=1, start=0, end=None):
+        """Matches the lines in buffer[start:end], which may be a string or a
+        bytes-like object, with `any_line_pattern`, yielding (first_linenum, 
+        matches) chunks of at most `parse_chunk_size` lines. Matching happens
+        in place, so lines are never copied out of the buffer.
+        """
+        end = len(buffer) if end is None else end
+        regex = self.any_line_regex if isinstance(buffer, str) else self.any_line_bytes_regex
+        matches = regex.finditer(buffer, start, end)
+        while True:
+            chunk = list(islice(matches, self.parse_chunk_size))
+            if chunk and chunk[-1].start() == chunk[-1].end():
+                # The empty match at the end of the buffer
+                chunk.pop()
+            if not chunk:
+                break
+            yield first_linenum, chunk
+            first_linenum += len(chunk)
+
+    def find_line_start(self, buffer, pos, limit=None):
+        """Returns the offset of the first line in buffer which starts at or
+        after `pos`, or `limit` if there is none.
+        """
+        limit = len(buffer) if limit is None else limit
+        if pos <= 0:
+            return 0
+        if pos >= limit:
+            return limit
+        newline = buffer.find(b'\n', pos - 1, limit)
+        return limit if newline == -1 else newline + 1
+
+    def count_lines(self, buffer, start, end):
+        "Counts the newlines in buffer[start:end], copying at most `split_size` bytes at a time"
+        return sum(buffer[i:min(i + self.split_size, end)].count(b'\n') 
+                for i in range(start, end, self.split_size))
+
+    def seek_time(self, buffer, timestamp):
+        """Binary-searches a time-ordered buffer of log lines for the first line
+        whose timestamp, to the second, is not before `timestamp`. Returns its
+        offset.
+        """
+        prefix = timestamp.strftime(self.timestamp_prefix_format)
+        low, high = 0, len(buffer)
+        while low < high:
+            mid = self.find_line_start(buffer, (low + high) // 2)
+            if mid >= high:
+                high = (low + high) // 2
+                continue
+            newline = buffer.find(b'\n', mid)
+            line_end = len(buffer) if newline == -1 else newline + 1
+            match = self.log_line_bytes_regex.match(buffer[mid:line_end])
+            if match and match.group('timestamp').decode()[:len(prefix)] < prefix:
+                low = line_end
+            else:
+                high = mid
+        return self.find_line_start(buffer, low)
+
+    def read_file_tail(self, logfile, offset=0, skip=0, first_linenum=1):
+        """Parses a log file starting from byte `offset`, for incremental ingest.
+        Returns (df, new_offset, num_lines, stats), where df is None if there 
+        were no new events and stats are the file's `file_stats` for this read.
+        For plain log files only complete lines are parsed, and new_offset
+        follows the last newline, so a line still being written is picked up
+        next time. For gzip files, `offset` must be a member boundary; every
+        member from there to the end of the file is read, and the first `skip`
+        decompressed bytes are dropped. (This is how we continue a log file
+        which was rotated into a .gz file after we had read part of it.) A gzip
+        file which is cut off or corrupt is read up to the damage, and its 
+        partial last line is rejected (see `reject_truncated_tail`).
+        """
+        logfile = Path(logfile)
+        with open(logfile, 'rb') as fh:
+            fh.seek(offset)
+            truncated = False
+            if logfile.suffix == self.compressed_log_suffix:
+                blocks = []
+                with gzip.GzipFile(fileobj=fh) as gz:
+                    while not truncated:
+                        block, truncated = self.read_gzip_block(gz)
+                        if not block:
+                            break
+                        blocks.append(block)
+                data = b''.join(blocks)[skip:]
+                new_offset = fh.tell()
+            else:
+                data = fh.read()
+                data = data[:data.rfind(b'\n') + 1]
+                new_offset = offset + len(data)
+        num_lines = data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
+        if truncated:
+            complete = data.rfind(b'\n') + 1
+            chunks = self.iter_truncated_chunks(self.match_lines(data, first_linenum, 0, complete), 
+                    logfile, first_linenum + data.count(b'\n'), data[complete:])
+        else:
+            chunks = self.match_lines(data, first_linenum)
+        events = self.iter_chunk_events(chunks, logfile)
+        dfs = list(self.batch_events(events))
+        df = self.concat_dfs(dfs) if dfs else None
+        return df, new_offset, num_lines, self.file_stats.get(str(logfile))
+
+    def iter_merged_events(self):
+        """Yields parsed events from all log files in global time order.
+        Each log file is sorted, so this is a heap-based k-way merge over one
+        stream per file: O(n log k) time and memory bounded by one pending
+        event per file. Events with equal timestamps are yielded in file order.
+        """
+        streams = [self.iter_file_events(f) for f in self.log_files]
+        yield from heapq.merge(*streams, key=itemgetter("timestamp"))
+
+    def iter_batches(self, size=None, merge=False):
+        """Yields dataframes of at most `size` events from all log files.
+        Memory use is bounded by the batch size rather than the size of the logs.
+        When `merge`, events are yielded in global time order.
+        """
+        events = self.iter_merged_events() if merge else self.iter_events()
+        yield from self.batch_events(events, size)
+
+    def batch_events(self, events, size=None):
+        "Groups an iterator of parsed events into dataframes of at most `size` rows"
+        size = size or self.default_batch_size
+        records = []
+        for event in events:
+            records.append(event)
+            if len(records) >= size:
+                yield self.records_to_df(records)
+                records = []
+        if records:
+            yield self.records_to_df(records)
+
+    def reject_line(self, path, linenum, line, error):
+        """Handles a line which could not be parsed. Raises the error, unless
+        the reader is lenient, in which case the line is set aside for the 
+        quarantine file.
+        """
+        if not self.lenient:
+            raise error
+        self.rejected_lines.setdefault(str(path), []).append({
+            "location": "{}:{}".format(path, linenum),
+            "error": str(error),
+            "line": self.line_text(line).rstrip("\n"),
+        })
+
+    def line_text(self, line):
+        "Returns a line as a string, decoding it if it was read as bytes"
+        if isinstance(line, str):
+            return line
+        return bytes(line).decode(errors="replace")
+
+    def write_quarantine(self, logfile):
+        """Appends a file's rejected lines to the quarantine file, in one write
+        so that worker processes' files don't interleave.
+        """
+        rejected = self.rejected_lines.pop(str(logfile), [])
+        if self.quarantine_path is None or not rejected:
+            return
+        self.quarantine_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.quarantine_path, 'a') as fh:
+            fh.write("".join(json.dumps(r) + "\n" for r in rejected))
+
+    def report(self):
+        """Summarizes `file_stats`: totals across files, plus parse rate (lines
+        per second spent parsing) and error rate (bad lines per line) overall
+        and for each file, and the files which were truncated.
+        """
+        files = {}
+        for path, stats in self.file_stats.items():
+            files[path] = dict(stats, **self.get_rates(stats))
+        totals = {key: sum(stats[key] for stats in self.file_stats.values()) 
+                for key in ["lines", "events", "errors", "seconds"]}
+        truncated = sorted(path for path, stats in self.file_stats.items() if stats.get("truncated"))
+        return dict(totals, files=files, truncated=truncated, **self.get_rates(totals))
+
+    def get_rates(self, stats):
+        "Returns parse and error rates for a dict of stats"
+        return {
+            "parse_rate": stats["lines"] / stats["seconds"] if stats["seconds"] else 0.0,
+            "error_rate": stats["errors"] / stats["lines"] if stats["lines"] else 0.0,
+        }
+
+    def format_report(self):
+        "Returns `report` as a printable table"
+        report = self.report()
+        row = "{:<50} {:>10} {:>10} {:>8} {:>12} {:>8.3%}"
+        header = "{:<50} {:>10} {:>10} {:>8} {:>12} {:>8}".format(
+                "file", "lines", "events", "errors", "lines/sec", "errors")
+        rows = [header]
+        for path, stats in sorted(report["files"].items()):
+            rows.append(row.format(path[-50:], stats["lines"], stats["events"], stats["errors"], 
+                    "{:,.0f}".format(stats["parse_rate"]), stats["error_rate"]))
+        rows.append(row.format("total", report["lines"], report["events"], report["errors"], 
+                "{:,.0f}".format(report["parse_rate"]), report["error_rate"]))
+        for path in report["truncated"]:
+            rows.append("{} is truncated or corrupt; lines after the damage were lost".format(path))
+        return "\n".join(rows)
+
+    def records_to_df(self, records):
+        """Converts a list of parsed records into a dataframe indexed by
+        timestamp, splitting list-valued columns into one float column per component.
+        The dtype is explicit so that records in which a column is always missing 
+        (like "Unknown" target blocks) still concatenate with others to float64.
+        """
+        df = pd.DataFrame.from_records(records, index="timestamp")
+        df.index = pd.to_datetime(df.index)
+        for oldcol, newcols in self.list_cols:
             if oldcol in df.columns:
                 values = [(v if isinstance(v, list) else [None] * len(newcols)) for v in df[oldcol].tolist()]
-                df[newcols] = pd.DataFrame(values, columns=newcols, index=df.index)
+                df[newcols] = pd.DataFrame(values, columns=newcols, index=df.index, dtype=float)
                 df = df.drop(columns=oldcol)
         return df
 
@@ -94,7 +614,11 @@ class LogReader:
             if command_match:
                 command_value = command_match.group(1)
                 json_string = json_string.replace(command_value, json.dumps(command_value))
-                data = json.loads(json_string)
+                try:
+                    data = json.loads(json_string)
+                except json.decoder.JSONDecodeError as command_error:
+                    raise self.ParseError("Error decoding data at {}. JSON error: {}. Line:\n{}".format(
+                            loc, command_error, line))
             else:
                 raise self.ParseError("Error decoding data at {}. JSON error: {}. Line:\n{}".format(loc, e, line))
         try:
@@ -109,6 +633,171 @@ class LogReader:
             data["player"] = player
         return data
 
+    def parse_lines(self, lines, path, first_linenum=1):
+        """Parses a batch of consecutive lines from one log file. 
+        Equivalent to calling `parse_line` on each line, except that the
+        timestamps are parsed together into int64 nanoseconds, and that lines
+        outside the reader's filters are skipped. Lines may be strings or 
+        bytes-like objects.
+        Raises LogReader.ParseError if there's trouble, unless the reader is
+        lenient (see `reject_line`).
+        """
+        binary = len(lines) > 0 and not isinstance(lines[0], str)
+        match_line = (self.any_line_bytes_regex if binary else self.any_line_regex).match
+        return self.parse_matches([match_line(line) for line in lines], path, first_linenum)
+
+    def parse_matches(self, matches, path, first_linenum=1):
+        """Parses consecutive lines from one log file, already matched with
+        `any_line_pattern` (see `parse_lines`).
+        """
+        started = time.perf_counter()
+        binary = len(matches) > 0 and not isinstance(matches[0].string, str)
+        player = self.player_name or self.get_player_name(path)
+        # Timestamps are ISO-formatted, so comparing their first characters 
+        # as strings safely rejects lines outside [start, end] to the second.
+        # Lines within the boundary seconds are checked exactly once parsed.
+        if self.start is not None:
+            start_prefix = self.start.strftime(self.timestamp_prefix_format)
+            start_prefix = start_prefix.encode() if binary else start_prefix
+            prefix_length = len(start_prefix)
+        if self.end is not None:
+            end_prefix = self.end.strftime(self.timestamp_prefix_format)
+            end_prefix = end_prefix.encode() if binary else end_prefix
+            prefix_length = len(end_prefix)
+        event_names = {}
+        events = []
+        timestamps = []
+        linenums = []
+        errors = 0
+        for linenum, match in enumerate(matches, first_linenum):
+            timestamp, event, data_string = match.group('timestamp', 'event', 'data')
+            if timestamp is None:
+                line = self.line_text(match.group(0))
+                errors += 1
+                self.reject_line(path, linenum, line, self.ParseError("Error reading {}:{}: {}".format(
+                        path, linenum, line)))
+                continue
+            if binary:
+                event_name = event_names.get(event)
+                if event_name is None:
+                    event_name = event_names[event] = event.decode()
+                event = event_name
+            if self.events is not None and event not in self.events:
+                continue
+            if self.start is not None and timestamp[:prefix_length] < start_prefix:
+                continue
+            if self.end is not None and timestamp[:prefix_length] > end_prefix:
+                continue
+            try:
+                data = self.decode_data(data_string, linenum, path, match.group(0))
+            except self.ParseError as e:
+                errors += 1
+                self.reject_line(path, linenum, match.group(0), e)
+                continue
+            data["event"] = event
+            if player:
+                data["player"] = player
+            events.append(data)
+            timestamps.append(timestamp)
+            linenums.append(linenum)
+        try:
+            parsed = self.parse_timestamps(timestamps, path, linenums)
+        except (self.ParseError, ValueError):
+            if not self.lenient:
+                raise
+            bad = set(self.find_bad_timestamps(timestamps))
+            for i in sorted(bad):
+                self.reject_line(path, linenums[i], matches[linenums[i] - first_linenum].group(0), self.ParseError(
+                        "Could not parse timestamp at {}:{}: {}".format(path, linenums[i], self.line_text(timestamps[i]))))
+            errors += len(bad)
+            events = [data for i, data in enumerate(events) if i not in bad]
+            timestamps = [ts for i, ts in enumerate(timestamps) if i not in bad]
+            linenums = [n for i, n in enumerate(linenums) if i not in bad]
+            parsed = self.parse_timestamps(timestamps, path, linenums)
+        for data, ts in zip(events, parsed):
+            data["timestamp"] = ts
+        if self.start is not None or self.end is not None:
+            start_ns = self.start.value if self.start is not None else None
+            end_ns = self.end.value if self.end is not None else None
+            events = [data for data in events if 
+                    (start_ns is None or data["timestamp"] >= start_ns) and 
+                    (end_ns is None or data["timestamp"] <= end_ns)]
+        if self.players is not None:
+            events = [data for data in events if data.get("player") in self.players]
+        stats = self.file_stats.get(str(path))
+        if stats is not None:
+            stats["lines"] += len(matches)
+            stats["events"] += len(events)
+            stats["errors"] += errors
+            stats["seconds"] += time.perf_counter() - started
+        return events
+
+    def decode_data(self, data_string, linenum, path, line):
+        """Decodes the JSON data of a line, with the same 'Unknown' substitution
+        and unescaped-command recovery as `parse_line`. `data_string` may be
+        bytes, which are only decoded to a string if recovery is needed.
+        """
+        if isinstance(data_string, bytes):
+            try:
+                return fast_json_loads(b'{' + data_string.replace(b'Unknown', b'null') + b'}')
+            except ValueError:
+                data_string = data_string.decode(errors="replace")
+                line = self.line_text(line)
+        json_string = '{' + data_string + '}'
+        json_string = json_string.replace('Unknown', 'null')
+        try:
+            return fast_json_loads(json_string)
+        except ValueError as e:
+            # Maybe there was unescaped content in the command field?
+            command_match = self.command_regex.search(json_string)
+            if command_match:
+                command_value = command_match.group(1)
+                json_string = json_string.replace(command_value, json.dumps(command_value))
+                try:
+                    return json.loads(json_string)
+                except ValueError as command_error:
+                    # The line is corrupt, not just unescaped.
+                    e = command_error
+            raise self.ParseError("Error decoding data at {}:{}. JSON error: {}. Line:\n{}".format(
+                    path, linenum, e, line))
+
+    def parse_timestamps(self, timestamps, path, linenums):
+        """Parses a list of log timestamps in one vectorized call, returning a
+        list of int64 nanoseconds since the epoch. If any timestamp is invalid,
+        finds it and raises LogReader.ParseError. `linenums` are the 
+        timestamps' line numbers, for error messages.
+        """
+        try:
+            parsed = self.to_datetime64(timestamps)
+        except ValueError:
+            for linenum, ts in zip(linenums, timestamps):
+                try:
+                    datetime.strptime(self.line_text(ts), self.log_timestamp_format)
+                except ValueError:
+                    raise self.ParseError("Could not parse timestamp at {}:{}: {}".format(
+                            path, linenum, self.line_text(ts)))
+            raise
+        return parsed.view("int64").tolist()
+
+    def to_datetime64(self, timestamps):
+        """Converts a list of log timestamps, which may be strings or bytes,
+        to a datetime64[ns] array.
+        """
+        if len(timestamps) > 0 and isinstance(timestamps[0], bytes):
+            timestamps = [ts.decode() for ts in timestamps]
+        parsed = pd.to_datetime(timestamps, format=self.log_timestamp_format)
+        return np.asarray(parsed, dtype="datetime64[ns]")
+
+    def find_bad_timestamps(self, timestamps):
+        "Returns the indices of timestamps which can't be parsed"
+        bad = []
+        for i, ts in enumerate(timestamps):
+            try:
+                self.to_datetime64([ts])
+            except ValueError:
+                bad.append(i)
+        return bad
+
     class ParseError(Exception):
         "Custom error class for problems reading logs"
 
@@ -0,0 +1,86 @@
+# Schemas for SuperLog event types
+#
+# Each event type is stored in its own narrow table, containing only the
+# columns its events have. EVENT_SCHEMAS gives compact dtypes for the columns
+# of known event types (see server/config/superlog/log_player_movement.yml). 
+# Block coordinates are nullable int32 because SuperLog writes null when, 
+# for example, a player is not looking at a block.
+
+def block_coords(name):
+    return {name + '_' + c: "Int32" for c in ['x', 'y', 'z']}
+
+def angles(name):
+    return {name + '_' + a: "float32" for a in ['pitch', 'yaw']}
+
+EVENT_SCHEMAS = {
+    "PlayerMoveEvent": {
+        "player": "category",
+        **block_coords("location"),
+        **block_coords("eye_location"),
+        **angles("eye_direction"),
+        **block_coords("target_block"),
+    },
+    "BlockBreakEvent": {
+        "player": "category",
+        "block": "category",
+        **block_coords("location"),
+    },
+    "BlockPlaceEvent": {
+        "player": "category",
+        "block": "category",
+        **block_coords("location"),
+    },
+    "PlayerJoinEvent": {
+        "player": "category",
+    },
+    "PlayerQuitEvent": {
+        "player": "category",
+    },
+    "PlayerGameModeChangeEvent": {
+        "player": "category",
+        "gamemode": "category",
+    },
+    "PlayerCommandPreprocessEvent": {
+        "player": "category",
+        "command": "string",
+    },
+    "AsyncPlayerChatEvent": {
+        "player": "category",
+        "message": "string",
+    },
+    "PlayerRespawnEvent": {
+        "player": "category",
+        **block_coords("location"),
+        "bedspawn": "category",
+    },
+    "SignChangeEvent": {
+        "player": "category",
+        **block_coords("location"),
+    },
+}
+
+def to_event_table(df, event):
+    """Converts rows of a logs dataframe, all of type `event`, into a narrow
+    table: the event column and columns with no values are dropped, and known
+    columns are cast to the event's schema. Columns which are not in the
+    schema are kept, with generic dtypes.
+    """
+    schema = EVENT_SCHEMAS.get(event, {})
+    df = df.drop(columns="event", errors="ignore").dropna(axis=1, how="all")
+    for col in df.columns:
+        if col in schema:
+            df[col] = df[col].astype(schema[col])
+        else:
+            df[col] = generic_dtype(df[col])
+    return df
+
+def generic_dtype(series):
+    """Returns a series with a Parquet-friendly dtype, for columns which are
+    not in a schema. Object columns become nullable booleans or strings.
+    """
+    if series.dtype != object:
+        return series
+    values = series.dropna()
+    if values.map(lambda v: isinstance(v, bool)).all():
+        return series.astype("boolean")
+    return series.map(str, na_action="ignore").astype("string")
@@ -0,0 +1,289 @@
+# Reading and writing parsed logs as a columnar store
+#
+# A log store is a directory holding one table per event type. Each table is 
+# narrow (only the columns its events have) and typed according to 
+# logs.schema. `read_logs` reassembles the wide dataframe produced by 
+# `LogReader.to_df`, keeping the compact dtypes; `read_event_table` reads 
+# one compact table.
+#
+# Tables are partitioned by hour, with one Parquet file per partition, like
+# data/df/production.parquet/PlayerMoveEvent/2021-07-14/18.parquet. 
+# A partition index (partitions.json) records each partition's time range
+# and row count, so that reading a time range only opens the partitions
+# which overlap it. It also records the first timestamp of each of a
+# partition's row groups, so that within a partition a reader binary-searches
+# for the row groups overlapping its time range and decodes only those.
+# The store also records the order of the dataframe's columns (columns.json),
+# so that `read_logs` returns them in the order `LogReader.to_df` gave them.
+
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from logs.schema import to_event_table
+
+CATEGORICAL_COLUMNS = ["player", "event", "block"]
+STORE_SUFFIX = ".parquet"
+CSV_SUFFIX = ".csv"
+ROW_GROUP_SIZE = 10000
+PARTITION_FREQ = "h"
+PARTITION_INDEX = "partitions.json"
+COLUMN_ORDER = "columns.json"
+
+def write_logs(df, path):
+    """Writes a logs dataframe (as produced by `LogReader.to_df`) to a store at
+    `path`, replacing any existing tables.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    for event in read_partition_index(path):
+        shutil.rmtree(get_table_path(path, event), ignore_errors=True)
+    index = {}
+    for event, event_df in df.groupby("event", sort=False, observed=True):
+        table = to_event_table(event_df, event)
+        index[event] = write_partitions(table, path, event)
+    write_partition_index(path, index)
+    write_column_order(path, list(df.columns))
+
+def append_logs(df, path):
+    """Adds the rows of a logs dataframe to the store at `path`, keeping each
+    table in time order. Only the partitions which receive new rows are
+    rewritten. Rows with equal timestamps keep existing rows first.
+    """
+    index = read_partition_index(path)
+    for event, event_df in df.groupby("event", sort=False, observed=True):
+        partitions = {p["path"]: p for p in index.get(event, [])}
+        table = to_event_table(event_df, event)
+        for key, new_rows in table.groupby(table.index.floor(PARTITION_FREQ)):
+            partition_path = get_partition_path(key)
+            if partition_path in partitions:
+                existing = pd.read_parquet(get_table_path(path, event) / partition_path)
+                new_rows = to_event_table(pd.concat([existing, new_rows]), event)
+                new_rows = new_rows.iloc[np.argsort(new_rows.index.values, kind="stable")]
+            for partition in write_partitions(new_rows, path, event):
+                partitions[partition["path"]] = partition
+        index[event] = sorted(partitions.values(), key=lambda p: p["start"])
+    write_partition_index(path, index)
+    write_column_order(path, merge_column_order(read_column_order(path) or [], list(df.columns)))
+
+def write_partitions(table, path, event):
+    """Writes an event type's table as hourly partitions, each sorted by time.
+    Returns index entries for the partitions written.
+    """
+    partitions = []
+    for key, partition in table.groupby(table.index.floor(PARTITION_FREQ)):
+        if not partition.index.is_monotonic_increasing:
+            partition = partition.iloc[np.argsort(partition.index.values, kind="stable")]
+        partition_path = get_partition_path(key)
+        file_path = get_table_path(path, event) / partition_path
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        partition.to_parquet(file_path, row_group_size=ROW_GROUP_SIZE)
+        partitions.append({
+            "path": partition_path,
+            "start": partition.index.min().isoformat(),
+            "end": partition.index.max().isoformat(),
+            "rows": len(partition),
+            "row_groups": get_row_group_starts(file_path, partition.index),
+        })
+    return partitions
+
+def get_row_group_starts(file_path, index):
+    """Returns the first timestamp of each row group in a partition file, 
+    given the partition's (sorted) index.
+    """
+    metadata = pq.ParquetFile(file_path).metadata
+    row_group_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    offsets = np.cumsum([0] + row_group_rows[:-1])
+    return [index[offset].isoformat() for offset in offsets]
+
+def get_partition_path(key):
+    "Returns the path of the partition starting at `key`, relative to its table"
+    return key.strftime("%Y-%m-%d/%H") + STORE_SUFFIX
+
+def get_table_path(path, event):
+    "Returns the directory of an event type's table in the store at `path`"
+    return Path(path) / event
+
+def read_partition_index(path):
+    """Returns the partition index of the store at `path`: a dict mapping each
+    event type to a time-ordered list of partitions like 
+    {"path": ..., "start": ..., "end": ..., "rows": ..., "row_groups": [...]}
+    where row_groups lists the first timestamp of each row group.
+    """
+    index_path = Path(path) / PARTITION_INDEX
+    if index_path.exists():
+        return json.loads(index_path.read_text())
+    return {}
+
+def write_partition_index(path, index):
+    (Path(path) / PARTITION_INDEX).write_text(json.dumps(index, indent=2, sort_keys=True))
+
+def read_column_order(path):
+    """Returns the order of the columns of the dataframes written to the store
+    at `path`, or None for stores which don't record it.
+    """
+    order_path = Path(path) / COLUMN_ORDER
+    if order_path.exists():
+        return json.loads(order_path.read_text())
+
+def write_column_order(path, columns):
+    (Path(path) / COLUMN_ORDER).write_text(json.dumps(columns))
+
+def merge_column_order(order, columns):
+    """Adds the new ones of `columns` (in order) to a column order, each after the
+    last of the columns before it which is already there.
+    """
+    order = list(order)
+    position = 0
+    for col in columns:
+        if col in order:
+            position = order.index(col) + 1
+        else:
+            order.insert(position, col)
+            position += 1
+    return order
+
+def get_store_events(path):
+    "Returns the event types which have tables in the store at `path`"
+    return sorted(read_partition_index(path))
+
+def get_partitions(path, event, start=None, end=None):
+    """Returns the paths of an event type's partitions which overlap the time
+    range [start, end].
+    """
+    return [get_table_path(path, event) / p["path"] for p in get_partition_entries(path, event, start, end)]
+
+def get_partition_entries(path, event, start=None, end=None):
+    """Returns the partition index entries of an event type's partitions which
+    overlap the time range [start, end].
+    """
+    partitions = read_partition_index(path).get(event, [])
+    if start is not None:
+        partitions = [p for p in partitions if pd.Timestamp(p["end"]) >= pd.Timestamp(start)]
+    if end is not None:
+        partitions = [p for p in partitions if pd.Timestamp(p["start"]) <= pd.Timestamp(end)]
+    return partitions
+
+def get_row_groups(partition, start=None, end=None):
+    """Binary-searches a partition's row group start times for the row groups
+    which may hold rows in the time range [start, end]. Returns a list of row
+    group ids, or None when the partition's index entry has no row groups.
+    """
+    if "row_groups" not in partition:
+        return None
+    starts = pd.DatetimeIndex(partition["row_groups"])
+    first = 0
+    last = len(starts)
+    if start is not None:
+        # Rows equal to `start` may end the row group before the first which
+        # starts at or after it.
+        first = max(0, starts.searchsorted(pd.Timestamp(start), side="left") - 1)
+    if end is not None:
+        last = starts.searchsorted(pd.Timestamp(end), side="right")
+    return list(range(first, last))
+
+def read_partition(partition_path, partition, columns=None, start=None, end=None):
+    """Reads the rows of one partition in the time range [start, end]. Only
+    the row groups which overlap the range are decoded, and they are then
+    sliced by binary search, since partitions are sorted by time.
+    """
+    row_groups = get_row_groups(partition, start, end)
+    if row_groups is None:
+        filters = []
+        if start is not None:
+            filters.append(("timestamp", ">=", pd.Timestamp(start)))
+        if end is not None:
+            filters.append(("timestamp", "<=", pd.Timestamp(end)))
+        return pd.read_parquet(partition_path, columns=columns, filters=filters or None)
+    table = pq.ParquetFile(partition_path).read_row_groups(row_groups, columns=columns, use_pandas_metadata=True)
+    df = table.to_pandas()
+    first = 0 if start is None else df.index.searchsorted(pd.Timestamp(start), side="left")
+    last = len(df) if end is None else df.index.searchsorted(pd.Timestamp(end), side="right")
+    return df.iloc[first:last]
+
+def read_event_table(path, event, columns=None, start=None, end=None):
+    """Loads one event type's narrow, typed table from the store at `path`.
+    Only partitions overlapping the time range [start, end] are opened, only
+    their row groups overlapping it are decoded (see `read_partition`), and
+    only `columns` which the table has are read (all columns when None).
+    """
+    dfs = []
+    for partition in get_partition_entries(path, event, start, end):
+        partition_path = get_table_path(path, event) / partition["path"]
+        if columns is None:
+            partition_columns = None
+        else:
+            available = pq.read_schema(partition_path).names
+            partition_columns = [col for col in columns if col in available]
+        dfs.append(read_partition(partition_path, partition, partition_columns, start, end))
+    if dfs:
+        df = pd.concat(dfs)
+    else:
+        all_partitions = get_partitions(path, event)
+        if not all_partitions:
+            raise ValueError("No table for {} in {}".format(event, path))
+        df = pq.read_schema(all_partitions[0]).empty_table().to_pandas()
+    if columns is not None:
+        df = df[[col for col in columns if col in df.columns]]
+    return df
+
+def read_logs(path, columns=None, start=None, end=None, events=None, utc=False):
+    """Loads a logs dataframe indexed by timestamp. This is the one loader for
+    all consumers of the main log. 
+    `path` may be a store written by `write_logs` or a CSV export. 
+    For a store, only the tables for `events` (all when None) and their 
+    partitions overlapping the time range [start, end] are opened, and only
+    `columns` are read (all columns when None). Tables are combined into one
+    time-ordered dataframe which keeps the tables' compact dtypes (see 
+    logs.schema); only columns whose dtypes differ between tables are upcast.
+    Columns are in the order of `columns`, or else of the dataframe written
+    (see `read_column_order`). The store doesn't know which log file a row came
+    from, so rows with equal timestamps are not in file order as in 
+    `LogReader.to_df(merge=True)`: they are ordered by event type name, and
+    then as written.
+    When `utc`, the index is made timezone-aware in UTC.
+    """
+    path = Path(path)
+    if path.suffix == CSV_SUFFIX:
+        df = pd.read_csv(path, index_col="timestamp", low_memory=False)
+        df.index = pd.to_datetime(df.index, format="ISO8601")
+        df = filter_logs(df, start=start, end=end, events=events)
+        if columns is not None:
+            df = df[columns]
+    else:
+        dfs = []
+        store_events = get_store_events(path)
+        for event in store_events:
+            if events and event not in events:
+                continue
+            table = read_event_table(path, event, columns, start, end)
+            table["event"] = event
+            dfs.append(table)
+        if dfs:
+            df = pd.concat(dfs)
+            df = df.iloc[np.argsort(df.index.values, kind="stable")]
+        else:
+            df = pd.DataFrame(index=pd.DatetimeIndex([], name="timestamp"))
+        for col in CATEGORICAL_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype("category")
+        if columns is not None:
+            df = df.reindex(columns=columns)
+        else:
+            order = [col for col in read_column_order(path) or [] if col in df.columns]
+            df = df[order + [col for col in df.columns if col not in order]]
+    if utc and df.index.tz is None:
+        df.index = df.index.tz_localize("UTC")
+    return df
+
+def filter_logs(df, start=None, end=None, events=None):
+    "Filters a logs dataframe to the time range [start, end] and to `events`"
+    if start is not None:
+        df = df[df.index >= start]
+    if end is not None:
+        df = df[df.index <= end]
+    if events:
+        df = df[df.event.isin(events)]
+    return df
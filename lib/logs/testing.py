@@ -1,11 +1,16 @@
+import sys
 import pandas as pd
 import collaboration
 import selection
 
+# Run from lib/logs; the log store is imported as a package, like elsewhere.
+sys.path.append("..")
+from logs.store import read_logs
+
 
 def main():
-    filename = '../../data/df/production.csv'
-    dataframe = pd.read_csv(filename)
+    filename = '../../data/df/production.parquet'
+    dataframe = read_logs(filename)
 
     # print(dataframe)
     file_excerpt1 = "../../data/minecraft_replay_recordings/2021_07_07_Workshop_1.mcpr"
@@ -0,0 +1,205 @@
+# Timing and memory instrumentation for exports and analyses
+#
+# Code marks stages of its work as spans, like `with span("log load"):`.
+# Spans do nothing unless a profiler is active (see `start_profile`). While
+# one is, each span records its wall time, CPU time, and peak resident memory
+# (RSS), sampled by a background thread. RSS is the whole process's, so
+# concurrent spans see each other's memory. Spans nest within each thread; a
+# span's path is its name prefixed by the names of the spans enclosing it, 
+# like "segment/product trace.csv/plot". The profile is written as JSON, and
+# optionally the whole run is also profiled with cProfile.
+#
+# Worker processes forked while a profiler is active record spans with their
+# copy of it, and send them back to the parent with `collect_spans`. Forking
+# while other threads run is unsafe, so the sampler is paused while workers
+# are forked (see `paused_sampling`).
+
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+PROFILE_FILE = "profile.json"
+CPROFILE_FILE = "profile.prof"
+SAMPLE_INTERVAL = 0.01
+
+_profiler = None
+
+class Profiler:
+    """Records spans. With `cprofile`, also runs cProfile until `stop`.
+    """
+
+    def __init__(self, cprofile=False, sample_interval=SAMPLE_INTERVAL):
+        self.records = []
+        self.open = []
+        self.local = threading.local()
+        self.start_time = time.perf_counter()
+        self.sample_interval = sample_interval
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self.start_sampler()
+        if self.cprofile:
+            self.cprofile.enable()
+
+    def start_sampler(self):
+        "Starts a thread which samples RSS, updating the peak of each open span"
+        self.sampling = True
+        self.sampler_pid = os.getpid()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def stop_sampler(self):
+        "Stops the sampler thread, waiting for it to finish"
+        self.sampling = False
+        if self.sampler.is_alive() and self.sampler is not threading.current_thread():
+            self.sampler.join()
+
+    def sample(self):
+        while self.sampling:
+            self.update_peaks()
+            time.sleep(self.sample_interval)
+
+    def update_peaks(self):
+        rss = get_rss()
+        for record in list(self.open):
+            record["peak_rss"] = max(record["peak_rss"], rss)
+
+    def get_stack(self):
+        "Returns the open spans of the current thread"
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name, **attrs):
+        stack = self.get_stack()
+        record = {
+            "name": name,
+            "path": "/".join([r["name"] for r in stack] + [name]),
+            "start": time.perf_counter() - self.start_time,
+            "start_rss": get_rss(),
+            "peak_rss": 0,
+            "pid": os.getpid(),
+        }
+        record["peak_rss"] = record["start_rss"]
+        record.update(attrs)
+        stack.append(record)
+        self.open.append(record)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = time.process_time() - cpu
+            self.update_peaks()
+            stack.remove(record)
+            self.open.remove(record)
+            self.records.append(record)
+
+    def add_spans(self, records):
+        "Adds spans recorded elsewhere, like in a worker process"
+        self.records += records
+
+    def after_fork(self):
+        """Prepares a forked copy of the profiler to record the spans of a task
+        in a worker process. Spans enclosing the fork are left to the parent.
+        """
+        self.fork_mark = len(self.records)
+        if self.sampler_pid != os.getpid():
+            self.open = []
+            self.start_sampler()
+
+    def stop(self):
+        self.sampling = False
+        if self.cprofile:
+            self.cprofile.disable()
+
+    def get_profile(self):
+        "Returns the profile as a dict"
+        return {
+            "pid": os.getpid(),
+            "peak_rss": max([r["peak_rss"] for r in self.records], default=get_rss()),
+            "spans": sorted(self.records, key=lambda r: r["start"]),
+        }
+
+    def write(self, path):
+        """Writes the profile as JSON to `path`, and the cProfile stats, if
+        any, next to it.
+        """
+        path = Path(path)
+        path.write_text(json.dumps(self.get_profile(), indent=2))
+        if self.cprofile:
+            self.cprofile.dump_stats(path.with_name(CPROFILE_FILE))
+
+def start_profile(cprofile=False):
+    "Starts recording spans with a new profiler, and returns it"
+    global _profiler
+    _profiler = Profiler(cprofile=cprofile)
+    return _profiler
+
+def stop_profile():
+    "Stops and returns the active profiler"
+    global _profiler
+    profiler = _profiler
+    _profiler = None
+    if profiler:
+        profiler.stop()
+    return profiler
+
+def get_profiler():
+    return _profiler
+
+@contextmanager
+def span(name, **attrs):
+    """Records the enclosed block as a span named `name` when a profiler is
+    active. `attrs` are saved with the span.
+    """
+    if _profiler is None:
+        yield None
+    else:
+        with _profiler.span(name, **attrs) as record:
+            yield record
+
+@contextmanager
+def paused_sampling():
+    """Stops the active profiler's sampler thread during the enclosed block,
+    like while forking worker processes.
+    """
+    if _profiler is None or not _profiler.sampling:
+        yield
+        return
+    _profiler.stop_sampler()
+    try:
+        yield
+    finally:
+        _profiler.start_sampler()
+
+def after_fork():
+    "Call in a forked worker process before each task which records spans"
+    if _profiler:
+        _profiler.after_fork()
+
+def collect_spans():
+    "Returns the spans recorded by a task in a forked worker process"
+    if _profiler is None:
+        return []
+    return _profiler.records[getattr(_profiler, "fork_mark", 0):]
+
+def add_spans(records):
+    if _profiler:
+        _profiler.add_spans(records)
+
+def get_rss():
+    "Returns the process's resident memory in bytes"
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Elsewhere, fall back to the peak RSS, in bytes on macOS and KB on Linux.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
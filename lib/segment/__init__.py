@@ -1,10 +1,26 @@
 # Working with segmentation parameters
 
+import json
 import shutil
 import yaml
 from datetime import datetime
 from pathlib import Path
 from .product import PRODUCT_FORMATS
+from .product.logs import SegmentLogs
+from .context import SegmentDataContext
+from .scheduler import ExportScheduler, get_export_order, get_dependencies, get_product_name
+from .planner import (
+    new_plan, 
+    estimate_log_read, 
+    estimate_frame_memory, 
+    estimate_read_seconds, 
+    get_warnings,
+)
+from .context import get_logs_cache_key
+from cache import CacheManager
+from profiling import span, start_profile, stop_profile, get_profiler, PROFILE_FILE
+
+FINGERPRINTS_FILE = "fingerprints.json"
 
 class Segment:
     """Represents segment--a slice of time across all data files. Params should include:
@@ -23,12 +39,24 @@ class Segment:
     def __init__(self, params):
         self.params = params
 
-    def export(self, clean=False):
+    def export(self, clean=False, workers=1, subprocess_workers=2, context=None, incremental=False, 
+            cprofile=False):
         """Creates a directory at `export_dir` with the specified segment products.
         When `clean`, deletes and recreates `export_dir` if it exists.
         Otherwise, raises an error if `export_dir` exists and is not empty.
         (This is safer, but `clean` allows us to re-run a command repeatedly
         without having to clear out the results each time.)
+        With `workers` > 1, independent products are exported concurrently
+        (see `segment.scheduler.ExportScheduler`). If any products fail, the
+        others are still exported, and then ExportScheduler.ExportError is raised.
+        Products read logs from `context`, which may be shared with other
+        segments (see `segment.batch`); by default the segment has its own.
+        When `incremental`, an existing `export_dir` is reused: products whose
+        fingerprints (recorded in fingerprints.json) are unchanged, and whose
+        outputs and dependencies are unchanged, are not exported again.
+        The time and memory of each stage of the export are written to 
+        profile.json (see `profiling`); with `cprofile`, cProfile stats of
+        the main process are written to profile.prof.
 
         TODO:
         - For each product, initialize and 
@@ -36,8 +64,46 @@ class Segment:
         """
         self.params["export_time"] = datetime.utcnow()
         export_dir = Path(self.params["export_dir"])
-        self.prepare_export_dir(export_dir, clean=clean)
+        if incremental and export_dir.exists():
+            manifest = self.read_fingerprints(export_dir)
+        else:
+            self.prepare_export_dir(export_dir, clean=clean)
+            manifest = {}
+        profiler = None if get_profiler() else start_profile(cprofile=cprofile)
+        try:
+            with span("segment", export_dir=str(export_dir)):
+                failures = self.export_products(export_dir, manifest, workers, subprocess_workers, 
+                        context, incremental)
+        finally:
+            if profiler:
+                stop_profile()
+                profiler.write(export_dir / PROFILE_FILE)
         (export_dir / "params.yaml").write_text(yaml.dump(self.params))
+        if failures:
+            raise ExportScheduler.ExportError(failures)
+
+    def export_products(self, export_dir, manifest, workers=1, subprocess_workers=2, context=None, 
+            incremental=False):
+        """Exports the segment's products into `export_dir`, skipping unchanged
+        products when `incremental`. Returns a dict mapping the names of 
+        products which failed to their errors.
+        """
+        context = context or SegmentDataContext(SegmentLogs.main_log_file)
+        products = self.get_products()
+        fingerprints = [product.get_fingerprint() for product in products]
+        skip = self.get_unchanged_products(products, fingerprints, manifest, export_dir) if incremental else set()
+        self.remove_stale_outputs(products, manifest, export_dir)
+        for i, product in enumerate(products):
+            if i in skip:
+                print("Skipping unchanged {}".format(get_product_name(product)))
+            else:
+                product.set_data_context(context)
+        if workers > 1:
+            context.preload()
+        scheduler = ExportScheduler(products, workers=workers, subprocess_workers=subprocess_workers, skip=skip)
+        failures = scheduler.run()
+        self.write_fingerprints(export_dir, products, fingerprints, failures)
+        return failures
 
     def prepare_export_dir(self, export_dir, clean=False):
         """Prepares the export dir"""
@@ -49,21 +115,122 @@ class Segment:
                         "This is forbidden as a safety measure to prevent accidental deletion."
                     )
                     raise ValueError(err.format(export_dir))
-            shutil.rmtree(export_dir)
+                shutil.rmtree(export_dir)
         else:
             if export_dir.exists():
                 raise ValueError("{} exists. Can't overwrite without --clean".format(export_dir))
         export_dir.mkdir()
+
+    def get_products(self, context=None):
+        """Returns the segment's products, with products which are exported in
+        several steps replaced by their steps (see `SegmentProduct.get_steps`).
+        When `context` is given, products register the logs they need with it.
+        """
+        products = []
         for product_params in self.params['products']:
             product_class = PRODUCT_FORMATS[product_params['format']]
-            product = product_class(self.params, product_params)
-            product.export()
-            
+            for product in product_class(self.params, product_params).get_steps():
+                if context:
+                    product.set_data_context(context)
+                products.append(product)
+        return products
 
-    def dry_run(self, clean=False):
-        """Returns a list of steps which would be taken by `export`.
+    def get_unchanged_products(self, products, fingerprints, manifest, export_dir):
+        """Returns the indices of products which don't need to be exported
+        again: their fingerprints match those recorded in `manifest`, their
+        outputs exist, and the products they depend on are also unchanged.
         """
-        return []
+        dependencies = get_dependencies(products)
+        unchanged = set()
+        for i in get_export_order(products):
+            recorded = manifest.get(get_product_name(products[i]), {})
+            if (
+                recorded.get("fingerprint") == fingerprints[i] and
+                all((export_dir / f).exists() for f in products[i].get_output_filenames()) and
+                dependencies[i] <= unchanged
+            ):
+                unchanged.add(i)
+        return unchanged
+
+    def remove_stale_outputs(self, products, manifest, export_dir):
+        "Deletes the outputs of products in `manifest` which are no longer in the segment"
+        names = [get_product_name(product) for product in products]
+        current = {f for product in products for f in product.get_output_filenames()}
+        for name, recorded in manifest.items():
+            if name not in names:
+                for f in recorded["outputs"]:
+                    if f not in current:
+                        (export_dir / f).unlink(missing_ok=True)
+
+    def read_fingerprints(self, export_dir):
+        "Returns the products' fingerprints recorded in `export_dir`"
+        path = export_dir / FINGERPRINTS_FILE
+        return json.loads(path.read_text()) if path.exists() else {}
+
+    def write_fingerprints(self, export_dir, products, fingerprints, failures):
+        """Records the fingerprints and outputs of the products which were
+        exported successfully or were unchanged in `export_dir`.
+        """
+        recorded = {}
+        for product, fingerprint in zip(products, fingerprints):
+            name = get_product_name(product)
+            if name in failures:
+                continue
+            recorded[name] = {
+                "fingerprint": fingerprint,
+                "outputs": product.get_output_filenames(),
+            }
+        path = export_dir / FINGERPRINTS_FILE
+        path.write_text(json.dumps(recorded, indent=2, sort_keys=True))
+
+    def dry_run(self, clean=False, incremental=False):
+        """Returns a plan of what `export` would do, without exporting anything.
+        The plan is a dict with:
+            - logs: the shared read of the logs (see `SegmentDataContext`), or None
+            - steps: each product's plan (see `SegmentProduct.plan`), with
+              `skip` set for unchanged products when `incremental`
+            - memory: estimated peak memory, with products exported in turn
+            - seconds: estimated time
+            - warnings: a list of warnings about memory or time
+        """
+        export_dir = Path(self.params["export_dir"])
+        products = self.get_products()
+        skip = set()
+        if incremental and export_dir.exists():
+            fingerprints = [product.get_fingerprint() for product in products]
+            skip = self.get_unchanged_products(products, fingerprints, self.read_fingerprints(export_dir), export_dir)
+        context = SegmentDataContext(SegmentLogs.main_log_file)
+        for i, product in enumerate(products):
+            if i not in skip:
+                product.set_data_context(context)
+        plan = {"logs": None, "steps": [], "memory": 0, "seconds": 0.0}
+        if context.start is not None:
+            start, end, columns, events = context.get_load_args()
+            logs = new_plan("logs")
+            read = estimate_log_read(context.log_file, start, end, columns, events)
+            logs["reads"].append(read)
+            logs["memory"] = estimate_frame_memory(read.get("rows", 0), read.get("columns", 0))
+            logs["seconds"] = estimate_read_seconds(read)
+            if context.use_cache:
+                cache = CacheManager()
+                key = get_logs_cache_key(cache, context.log_file, start, end, columns, events)
+                logs["cache"].append({"key": key, "hit": cache.contains(key)})
+            plan["logs"] = logs
+            plan["memory"] = logs["memory"]
+            plan["seconds"] = logs["seconds"]
+        step_memory = 0
+        for i, product in enumerate(products):
+            if i in skip:
+                step = new_plan(get_product_name(product))
+                step["skip"] = True
+            else:
+                step = product.plan()
+            plan["steps"].append(step)
+            step_memory = max(step_memory, step["memory"])
+            plan["seconds"] += step["seconds"]
+        plan["memory"] += step_memory
+        plan["warnings"] = get_warnings(plan)
+        return plan
 
     def validate(self, strict=True):
         """Validates params, raising an exception when `strict`.
@@ -96,6 +263,13 @@ class Segment:
                         errors.append("Invalid format '{}' in product {}".format(pfmt, i))
                 else:
                     errors.append("Product {} must have 'format'".format(i))
+            try:
+                get_export_order([
+                    PRODUCT_FORMATS[p['format']](self.params, p) for p in self.params['products'] 
+                    if p.get('format') in PRODUCT_FORMATS
+                ])
+            except ValueError as err:
+                errors.append(str(err))
         else:
             errors.append("Params must have 'products'")
         if strict and errors:
@@ -0,0 +1,89 @@
+# Exporting many segments in one pass
+#
+# Segments whose logs overlap, or are close in time, are grouped. For each
+# group, the union of the logs its segments' products need is loaded once into
+# a shared data context, and then the group's segments are exported in forked
+# worker processes which share the loaded logs. Where fork is unavailable or
+# unsafe, segments are exported one at a time.
+
+import traceback
+from datetime import timedelta
+from segment.context import SegmentDataContext
+from segment.product.logs import SegmentLogs
+from segment.scheduler import can_fork, start_process_pool
+
+# Segments and context being exported, inherited by forked worker processes.
+_segments = []
+_context = None
+
+def export_segments(segments, clean=False, workers=1, max_gap=timedelta(hours=1), incremental=False):
+    """Exports each of `segments` (Segment instances), exporting up to
+    `workers` segments concurrently. Segments whose log time ranges are
+    within `max_gap` of each other share one load of the logs. A failing
+    segment doesn't stop the others. Returns a dict mapping the export dirs
+    of segments which failed to their errors. `clean` and `incremental` are
+    passed to `Segment.export`.
+    """
+    global _segments, _context
+    failures = {}
+    for group, context in plan_segment_groups(segments, max_gap):
+        context.preload()
+        _segments = group
+        _context = context
+        if workers > 1 and can_fork():
+            with start_process_pool(workers) as executor:
+                errors = list(executor.map(
+                    export_segment_in_worker, 
+                    range(len(group)), 
+                    [clean] * len(group), 
+                    [incremental] * len(group),
+                ))
+        else:
+            errors = [export_segment_in_worker(i, clean, incremental) for i in range(len(group))]
+        for segment, error in zip(group, errors):
+            if error:
+                print("{} failed:\n{}".format(segment.params["export_dir"], error))
+                failures[segment.params["export_dir"]] = error
+    _segments = []
+    _context = None
+    return failures
+
+def export_segment_in_worker(i, clean, incremental):
+    "Exports a segment, returning the formatted traceback if it fails"
+    segment = _segments[i]
+    try:
+        segment.export(clean=clean, context=_context, incremental=incremental)
+        print("Exported {}".format(segment.params["export_dir"]))
+    except Exception:
+        return traceback.format_exc()
+
+def plan_segment_groups(segments, max_gap=timedelta(hours=1)):
+    """Groups segments whose products' log time ranges are within `max_gap` of
+    each other. Returns a list of (segments, context) tuples, where each
+    context has registered the logs needed by all of its group's segments.
+    Segments which don't read logs each form their own group.
+    """
+    ranges = []
+    groups = []
+    for segment in segments:
+        context = SegmentDataContext(SegmentLogs.main_log_file)
+        segment.get_products(context)
+        if context.start is None:
+            groups.append([segment])
+        else:
+            ranges.append((context.start, context.end, segment))
+    clusters = []
+    for start, end, segment in sorted(ranges, key=lambda r: r[0]):
+        if clusters and start - clusters[-1][1] <= max_gap:
+            clusters[-1][1] = max(clusters[-1][1], end)
+            clusters[-1][2].append(segment)
+        else:
+            clusters.append([start, end, [segment]])
+    groups += [cluster_segments for _, _, cluster_segments in clusters]
+    plan = []
+    for group in groups:
+        context = SegmentDataContext(SegmentLogs.main_log_file)
+        for segment in group:
+            segment.get_products(context)
+        plan.append((group, context))
+    return plan
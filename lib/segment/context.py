@@ -0,0 +1,153 @@
+# Data shared by the products of one segment export
+
+import pandas as pd
+import logs.schema
+import logs.store
+from logs.store import read_logs
+from cache import CacheManager, get_source_fingerprint, get_code_version
+from profiling import span
+
+class SegmentDataContext:
+    """Loads the main log once for all the products of a segment, and memoizes
+    frames derived from it.
+
+    Before anything is loaded, products `request` the time ranges, columns
+    and event types they need. The first call to `get_logs` loads the union of
+    these in one read, which only reads the columns and event tables needed;
+    products then receive slices of the shared dataframe, which share its data
+    and should be treated as read-only. Derived frames, like the output of 
+    `joint_attention.get_location_gaze`, are computed once per time range and
+    arguments by `get_derived`.
+    When any product asks to `use_cache`, the logs are loaded through the cache.
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.use_cache = False
+        self.start = None
+        self.end = None
+        self.columns = set()
+        self.all_columns = False
+        self.events = set()
+        self.all_events = False
+        self.df = None
+        self.derived = {}
+
+    def request(self, start, end, columns=None, events=None, use_cache=False):
+        """Registers a product's need for the logs in [start, end]. When
+        `columns` or `events` are None, all columns or event types are needed. 
+        Requests made after the logs are loaded which aren't covered by them
+        cause a reload.
+        """
+        self.use_cache = self.use_cache or use_cache
+        self.start = start if self.start is None else min(self.start, start)
+        self.end = end if self.end is None else max(self.end, end)
+        if columns is None:
+            self.all_columns = True
+        else:
+            self.columns.update(columns)
+        if events is None:
+            self.all_events = True
+        else:
+            self.events.update(events)
+        if self.df is not None and not self.covers(start, end, columns, events):
+            self.df = None
+            self.derived = {}
+
+    def covers(self, start, end, columns=None, events=None):
+        "Checks whether the loaded logs include [start, end], `columns` and `events`"
+        if self.df is None or start < self.loaded_start or end > self.loaded_end:
+            return False
+        if self.loaded_columns is not None and (columns is None or not set(columns) <= self.loaded_columns):
+            return False
+        if self.loaded_events is not None and (events is None or not set(events) <= self.loaded_events):
+            return False
+        return True
+
+    def get_load_args(self):
+        """Returns (start, end, columns, events) for loading the union of the 
+        requested logs. When not all events are loaded, the event column is
+        always loaded so that each product's events can be selected.
+        """
+        columns = None if self.all_columns else self.columns
+        events = None if self.all_events else sorted(self.events)
+        if columns is not None and not self.all_events:
+            columns = columns | {"event"}
+        columns = None if columns is None else sorted(columns)
+        return self.start, self.end, columns, events
+
+    def load(self):
+        "Loads the union of the requested time ranges, columns and events"
+        start, end, columns, events = self.get_load_args()
+        with span("log load"):
+            self.df = load_logs(self.log_file, start, end, columns, events, self.use_cache)
+        self.loaded_start = start
+        self.loaded_end = end
+        self.loaded_columns = None if columns is None else set(columns)
+        self.loaded_events = None if events is None else set(events)
+
+    def preload(self):
+        """Loads the requested logs now, if any were requested, e.g. before
+        forking worker processes which should share them.
+        """
+        if self.start is not None and self.df is None:
+            self.load()
+
+    def get_logs(self, start, end, columns=None, events=None):
+        """Returns the logs in [start, end], with only `columns` and `events`
+        when they are given, loading them first if needed.
+        """
+        if not self.covers(start, end, columns, events):
+            self.request(start, end, columns, events)
+            self.load()
+        df = self.df.loc[start:end]
+        if events is not None and self.loaded_events != set(events):
+            df = df[df.event.isin(events)]
+        if columns is not None:
+            df = df[list(columns)]
+        return df
+
+    def get_derived(self, func, start, end, *args, columns=None, events=None):
+        """Returns func(logs, *args) for the logs in [start, end] (and 
+        `columns` and `events`), computing it only the first time it is asked
+        for. `args` must be hashable. Dataframes are returned as shallow copies,
+        so callers may add columns without affecting others.
+        """
+        columns = None if columns is None else tuple(columns)
+        events = None if events is None else tuple(events)
+        key = (func, start, end, args, columns, events)
+        if key not in self.derived:
+            self.derived[key] = func(self.get_logs(start, end, columns, events), *args)
+        if isinstance(self.derived[key], pd.DataFrame):
+            return self.derived[key].copy(deep=False)
+        return self.derived[key]
+
+def load_logs(log_file, start, end, columns=None, events=None, use_cache=False):
+    """Returns the time-ordered logs in [start, end], reading only `columns`
+    and `events` (all when None). When `use_cache`, the
+    logs are read from the cache if they are there, and saved to it if not.
+    Cache keys include the log store's fingerprint and the loader's code
+    version, so entries are never stale.
+    """
+    if use_cache:
+        cache = CacheManager()
+        key = get_logs_cache_key(cache, log_file, start, end, columns, events)
+        df = cache.get_df(key)
+        if df is not None:
+            return df
+    df = read_logs(log_file, columns=columns, start=start, end=end, events=events)
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+    df = df.loc[start:end]
+    if use_cache:
+        cache.put_df(key, df)
+    return df
+
+def get_logs_cache_key(cache, log_file, start, end, columns=None, events=None):
+    "Returns the key under which `load_logs` caches logs"
+    return cache.key(
+        "logs", 
+        source=get_source_fingerprint(log_file, start=start, end=end, events=events), 
+        params={"start": start, "end": end, "columns": columns, "events": events},
+        code=get_code_version(logs.store, logs.schema, load_logs),
+    )
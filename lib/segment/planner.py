@@ -0,0 +1,142 @@
+# Estimating the cost of a segment export before running it
+#
+# Products describe what their export would do in a plan (see
+# `SegmentProduct.plan`): the data they would read, cache entries they would
+# hit, large intermediate values, and rough peak memory and time. Log reads
+# are estimated from the log store's partition index and Parquet footers, so
+# a plan never decodes any data. Time estimates use the rough throughputs
+# below, measured on a laptop; they are meant to flag exports which would
+# take hours, not to predict minutes.
+
+import os
+from pathlib import Path
+import pyarrow.parquet as pq
+from logs.store import CSV_SUFFIX, get_partition_entries, get_row_groups, get_table_path, read_partition_index
+
+READ_BYTES_PER_SECOND = 100 * 1024 ** 2
+BYTES_PER_CELL = 16
+ROWS_PER_SECOND = 1000000
+VOXELS_PER_SECOND = 50000
+BYTES_PER_VOXEL = 100
+MATRIX_CELLS_PER_SECOND = 50000000
+CROSS_RECURRENCE_BYTES_PER_CELL = 9
+MAX_SECONDS = 60 * 60
+MAX_MEMORY_FRACTION = 0.5
+
+def new_plan(name):
+    "Returns an empty product plan"
+    return {
+        "product": name,
+        "reads": [],
+        "cache": [],
+        "intermediates": {},
+        "memory": 0,
+        "seconds": 0.0,
+    }
+
+def estimate_log_read(log_file, start=None, end=None, columns=None, events=None):
+    """Estimates reading the logs in [start, end] from the store at `log_file`,
+    with only `columns` and `events` (all when None). Returns a dict with the
+    number of partitions and row groups which would be decoded, and the rows
+    and compressed bytes they hold. Rows and bytes are upper bounds, as row
+    groups at the ends of the range are only partly used.
+    """
+    log_file = Path(log_file)
+    if log_file.suffix == CSV_SUFFIX:
+        return estimate_file_reads([log_file])[0]
+    read = {"source": str(log_file), "partitions": 0, "row_groups": 0, "rows": 0, "bytes": 0, "columns": 0}
+    index = read_partition_index(log_file)
+    names = set()
+    for event in (events or index):
+        for partition in get_partition_entries(log_file, event, start, end):
+            metadata = pq.ParquetFile(get_table_path(log_file, event) / partition["path"]).metadata
+            row_groups = get_row_groups(partition, start, end)
+            if row_groups is None:
+                row_groups = range(metadata.num_row_groups)
+            read["partitions"] += 1
+            read["row_groups"] += len(row_groups)
+            for i in row_groups:
+                row_group = metadata.row_group(i)
+                read["rows"] += row_group.num_rows
+                for j in range(row_group.num_columns):
+                    column = row_group.column(j)
+                    if columns is None or column.path_in_schema in columns or column.path_in_schema == "timestamp":
+                        read["bytes"] += column.total_compressed_size
+                        names.add(column.path_in_schema)
+    read["columns"] = len(columns) if columns is not None else len(names)
+    return read
+
+def estimate_file_reads(paths):
+    "Estimates reading whole files: returns a dict with each file's size"
+    return [{"source": str(path), "bytes": Path(path).stat().st_size if Path(path).is_file() else 0} 
+            for path in paths]
+
+def estimate_frame_memory(rows, columns):
+    "Estimates the memory of a dataframe with `rows` and `columns`"
+    return rows * (columns + 1) * BYTES_PER_CELL
+
+def estimate_read_seconds(read):
+    return read["bytes"] / READ_BYTES_PER_SECOND + read.get("rows", 0) / ROWS_PER_SECOND
+
+def get_memory_limit():
+    "Returns the memory which an export may use before the planner warns"
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * MAX_MEMORY_FRACTION
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def get_warnings(plan):
+    "Returns warnings about a segment plan which would need too much memory or time"
+    warnings = []
+    limit = get_memory_limit()
+    for step in plan["steps"]:
+        if limit and step["memory"] > limit:
+            warnings.append("{} may need {} of memory, more than {}".format(
+                step["product"], format_bytes(step["memory"]), format_bytes(limit)))
+        if step["seconds"] > MAX_SECONDS:
+            warnings.append("{} may take {}".format(step["product"], format_seconds(step["seconds"])))
+    if limit and plan["memory"] > limit:
+        warnings.append("The export may need {} of memory, more than {}".format(
+            format_bytes(plan["memory"]), format_bytes(limit)))
+    if plan["seconds"] > MAX_SECONDS:
+        warnings.append("The export may take {}".format(format_seconds(plan["seconds"])))
+    return warnings
+
+def format_plan(plan):
+    "Formats a segment plan (see `Segment.dry_run`) as a readable report"
+    lines = []
+    steps = ([plan["logs"]] if plan["logs"] else []) + plan["steps"]
+    for step in steps:
+        lines.append("{}: ~{}, ~{} peak memory".format(
+            step["product"], format_seconds(step["seconds"]), format_bytes(step["memory"])))
+        if step.get("skip"):
+            lines.append("    unchanged; would be skipped")
+        for read in step["reads"]:
+            if "partitions" in read:
+                lines.append("    reads {} rows ({}) from {} partitions, {} row groups of {}".format(
+                    read["rows"], format_bytes(read["bytes"]), read["partitions"], read["row_groups"],
+                    read["source"]))
+            else:
+                lines.append("    reads {} from {}".format(format_bytes(read["bytes"]), read["source"]))
+        for entry in step["cache"]:
+            lines.append("    cache {}: {}".format("hit" if entry["hit"] else "miss", entry["key"]))
+        for name, size in step["intermediates"].items():
+            lines.append("    {}: {}".format(name, format_bytes(size)))
+    lines.append("Total: ~{}, ~{} peak memory".format(format_seconds(plan["seconds"]), format_bytes(plan["memory"])))
+    for warning in plan["warnings"]:
+        lines.append("WARNING: " + warning)
+    return "\n".join(lines)
+
+def format_bytes(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} TB".format(size)
+
+def format_seconds(seconds):
+    if seconds < 60:
+        return "{:.1f}s".format(seconds)
+    if seconds < 60 * 60:
+        return "{:.1f}m".format(seconds / 60)
+    return "{:.1f}h".format(seconds / 60 / 60)
@@ -1,15 +1,33 @@
 from subprocess import run
 from segment.product.base import SegmentProduct
+from metadata import METADATA_SUFFIX
+from segment.planner import estimate_file_reads, estimate_read_seconds
 
 class SegmentAudio(SegmentProduct):
     """An audio file in m4a format"""
 
+    executor = "subprocess"
     expected_params = [
         "format",
         "export_filename",
         "audio_source",
     ]
 
+    def get_media_sources(self):
+        "Returns the paths of the media files this product is cut from"
+        return [self.params['audio_source']]
+
+    def get_sources(self):
+        sources = self.get_media_sources()
+        return sources + [source + METADATA_SUFFIX for source in sources]
+
+    def plan(self):
+        "ffmpeg copies streams without re-encoding, so reading the sources dominates"
+        plan = super().plan()
+        plan["reads"] = estimate_file_reads(self.get_media_sources())
+        plan["seconds"] = sum(estimate_read_seconds(read) for read in plan["reads"])
+        return plan
+
     def export(self):
         cmd = 'ffmpeg -v quiet -ss {} -t {} -i "{}" -c copy "{}"'
         start_time = self.get_media_relative_start_time(self.params['audio_source'])
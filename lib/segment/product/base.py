@@ -1,21 +1,53 @@
+import json
 from datetime import datetime
+from hashlib import md5
 from pathlib import Path
 from metadata import get_media_metadata, METADATA_SUFFIX
+from cache import get_source_fingerprint, get_code_version
+from segment.planner import new_plan
+from segment.scheduler import get_product_name
 
 class SegmentProduct:
     """An abstract class which models a product to be produced from a segment.
     Required methods are validate and export.
+    Any product may list, in `depends_on`, the export filenames of products
+    which must be exported before it. `executor` says where the export runs
+    when products are exported concurrently (see `segment.scheduler`): 
+    "process" for Python work, "subprocess" for products which mostly wait 
+    on external programs. A product which does both may be scheduled as 
+    several steps (see `get_steps`).
+    A product's fingerprint (see `get_fingerprint`) changes whenever its 
+    outputs would, so that incremental exports can skip unchanged products.
     """
     expected_params = [
         "format",
         "export_filename",
     ]
     optional_params = []
+    scheduling_params = [
+        "depends_on",
+    ]
+    executor = "process"
+    # Names a step of a product (see `get_steps`)
+    step = None
+    data_context = None
+    # Params which don't affect a product's outputs
+    unfingerprinted_params = [
+        "use_cache",
+        "depends_on",
+    ]
 
     def __init__(self, segment_params, product_params):
         self.segment_params = segment_params
         self.params = product_params
 
+    def set_data_context(self, context):
+        """Gives the product a `SegmentDataContext` shared with the other
+        products of its segment. Products which read logs should register
+        the data they need with it.
+        """
+        self.data_context = context
+
     def validate(self):
         """Product-specific validation. Returns a list of errors.
         """
@@ -27,7 +59,7 @@ class SegmentProduct:
                     param
                 ))
         for param in self.params:
-            if param not in self.expected_params and param not in self.optional_params:
+            if param not in self.expected_params + self.optional_params + self.scheduling_params:
                 errors.append("Product {} received unexpected param {}".format(
                     self.__class__.__name__,
                     param
@@ -39,12 +71,60 @@ class SegmentProduct:
         """
         raise NotImplemented()
 
+    def get_steps(self):
+        """Returns the products to schedule in order to export this product. 
+        Usually this is just the product, but a product may split its work into
+        steps with different executors, each a product named by its `step`, 
+        which depends on the steps before it.
+        """
+        return [self]
+
     def export_filename(self, filename_key='export_filename'):
         """Returns a fully-qualified export filename"""
         export_dir = Path(self.segment_params['export_dir'])
         export_filename = export_dir / self.params[filename_key]
         return export_filename.resolve()
 
+    def get_output_filenames(self):
+        "Returns the names of the files this product exports"
+        return [v for k, v in self.params.items() if k.endswith("filename") and v]
+
+    def get_sources(self):
+        "Returns the paths of the data files this product is made from"
+        return []
+
+    def get_code_modules(self):
+        "Returns the modules and classes whose code makes this product"
+        return [cls for cls in type(self).__mro__ if cls is not object]
+
+    def get_source_data_fingerprint(self):
+        """Returns a fingerprint of the data this product is made from (see 
+        `cache.get_source_fingerprint`). Products which read only part of a 
+        log store override this, so that other parts don't change it.
+        """
+        return get_source_fingerprint(*self.get_sources())
+
+    def get_fingerprint(self):
+        """Returns a hash of everything the product's outputs depend on: the
+        segment's time span, the product's params, its source data (see
+        `get_source_data_fingerprint`) and its code version.
+        """
+        description = json.dumps({
+            "start": self.segment_params["start"],
+            "duration": self.segment_params["duration"],
+            "params": {k: v for k, v in self.params.items() if k not in self.unfingerprinted_params},
+            "sources": self.get_source_data_fingerprint(),
+            "code": get_code_version(*self.get_code_modules()),
+        }, sort_keys=True, default=str)
+        return md5(description.encode("utf-8")).hexdigest()
+
+    def plan(self):
+        """Returns an estimate of what exporting this product would do: the
+        data it would read, cache entries it would use, large intermediate 
+        values, and its peak memory and time (see `segment.planner`).
+        """
+        return new_plan(get_product_name(self))
+
     def get_media_relative_start_time(self, source_path):
         """Returns the media's relative start time as HH:MM:SS. 
         """
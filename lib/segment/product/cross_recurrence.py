@@ -1,8 +1,12 @@
 from datetime import timedelta
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from segment.product.joint_attention import SegmentJointAttention
+from segment.product.logs import SegmentLogs
+from profiling import span
+from segment.planner import CROSS_RECURRENCE_BYTES_PER_CELL, MATRIX_CELLS_PER_SECOND
 from joint_attention import (
     get_location_gaze,
     distance_measure,
@@ -12,6 +16,8 @@ from joint_attention import (
 
 class SegmentCrossRecurrence(SegmentJointAttention):
     """Returns a cross-recurrence dataframe.
+    Players' target blocks are compared at each time step of `granularity` over
+    the segment, using each player's last known target block at that time.
     """
     expected_params = [
         "format",
@@ -46,36 +52,70 @@ class SegmentCrossRecurrence(SegmentJointAttention):
         end = self.segment_params['start'] + timedelta(seconds=self.segment_params['duration'])
         return start, end
 
+    def get_data_columns(self):
+        "Only players' target blocks are needed"
+        return ["player"] + self.get_features()
+
+    def get_data_events(self):
+        "Only move events have target blocks"
+        return ["PlayerMoveEvent"]
+
+    def get_features(self):
+        return [self.location + '_' + ax for ax in ['x', 'y', 'z']]
+
+    def plan(self):
+        """Adds the gaze tensor and the n×n matrices compared at each pair of 
+        times, where n is the number of time steps at `granularity`.
+        """
+        plan = SegmentLogs.plan(self)
+        n = int(self.segment_params['duration'] / pd.Timedelta(
+                self.params.get("granularity", self.default_granularity)).total_seconds())
+        tensor_size = n * len(self.params.get("players", {})) * len(self.get_features()) * 4
+        plan["intermediates"]["gaze tensor"] = tensor_size
+        size = n * n * CROSS_RECURRENCE_BYTES_PER_CELL
+        plan["intermediates"]["cross-recurrence matrices ({0}×{0})".format(n)] = size
+        plan["memory"] += tensor_size + size
+        plan["seconds"] += n * n * 4 / MATRIX_CELLS_PER_SECOND
+        return plan
+
+    def get_cross_recurrence(self):
+        """Returns (times, cross_recurrence), where cross_recurrence[i, j] is 
+        whether the first player's target block at times[i] is within 
+        `distance_threshold` of the second player's at times[j].
+        """
+        players = list(self.params['players'].values())
+        granularity = self.params.get("granularity", self.default_granularity)
+        times, gaze = self.get_gaze_tensor(players, granularity, self.get_features())
+        with span("cross recurrence"):
+            d2 = np.zeros((len(times), len(times)), dtype=np.float32)
+            for ax in range(gaze.shape[2]):
+                diff = np.subtract.outer(gaze[:, 0, ax], gaze[:, 1, ax])
+                np.square(diff, out=diff)
+                d2 += diff
+            dt2 = self.params.get('distance_threshold', self.default_distance_threshold) ** 2
+            cross_recurrence = d2 <= dt2
+        return times, cross_recurrence
+
     def export(self):
-        df = self.get_segment_data()
-        lgdf = get_location_gaze(df, self.params['players'].values())
-        lgdf = lgdf.resample(self.params.get("granularity", self.default_granularity)).first()
         (k0, p0), (k1, p1) = self.params["players"].items()
-        i, j = np.indices((len(lgdf), len(lgdf)))
-        axd2 = {}
-        for ax in ['x', 'y', 'z']:
-            p0ax = lgdf[f"{p0}_target_block_{ax}"].to_numpy()
-            p1ax = lgdf[f"{p1}_target_block_{ax}"].to_numpy()
-            axd2[ax] = (p0ax[i] - p1ax[j]) ** 2
-        d2 = axd2['x'] + axd2['y'] + axd2['z']            
-        dt2 = self.params.get('distance_threshold', self.default_distance_threshold) ** 2
-        cross_recurrence = d2 <= dt2
+        times, cross_recurrence = self.get_cross_recurrence()
         np.save(self.export_filename(), cross_recurrence)
 
         if self.params.get("plot_filename"):
-            date_format = mdates.DateFormatter('%H:%M')
-            extent = mdates.date2num([lgdf.index[0].to_pydatetime(), lgdf.index[-1].to_pydatetime()] * 2)
-            f, ax = plt.subplots()
-            ax.imshow(cross_recurrence, origin="lower", extent=extent, cmap='Greys', vmin=0, vmax=1)
-            ax.xaxis_date()
-            ax.yaxis_date()
-            ax.xaxis.set_major_formatter(date_format)
-            ax.yaxis.set_major_formatter(date_format)
-            ax.set_xlabel(k0)
-            ax.set_ylabel(k1)
-            if self.params.get("plot_title"):
-                plt.suptitle(self.params.get("plot_title"))
-            ax.figure.savefig(self.export_filename("plot_filename"), bbox_inches="tight")
+            with span("plot"):
+                date_format = mdates.DateFormatter('%H:%M')
+                extent = mdates.date2num([times[0].to_pydatetime(), times[-1].to_pydatetime()] * 2)
+                f, ax = plt.subplots()
+                ax.imshow(cross_recurrence, origin="lower", extent=extent, cmap='Greys', vmin=0, vmax=1)
+                ax.xaxis_date()
+                ax.yaxis_date()
+                ax.xaxis.set_major_formatter(date_format)
+                ax.yaxis.set_major_formatter(date_format)
+                ax.set_xlabel(k0)
+                ax.set_ylabel(k1)
+                if self.params.get("plot_title"):
+                    plt.suptitle(self.params.get("plot_title"))
+                ax.figure.savefig(self.export_filename("plot_filename"), bbox_inches="tight")
 
 
 
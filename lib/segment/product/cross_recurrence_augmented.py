@@ -2,6 +2,7 @@ from datetime import timedelta
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from profiling import span
 from segment.product.joint_attention import SegmentJointAttention
 from segment.product.cross_recurrence import SegmentCrossRecurrence
 from joint_attention import (
@@ -29,74 +30,71 @@ class SegmentCrossRecurrenceAugmented(SegmentCrossRecurrence):
         "block_action_filename",
     ]
 
+    def get_data_columns(self):
+        return super().get_data_columns() + ["event"]
+
+    def get_data_events(self):
+        return super().get_data_events() + ['BlockBreakEvent', 'BlockPlaceEvent']
+
     def export(self):
         df = self.get_segment_data()
-        lgdf = get_location_gaze(df, self.params['players'].values())
-        lgdf = lgdf.resample(self.params.get("granularity", self.default_granularity)).first()
         badf = self.get_block_action_df(df)
         (player_label0, player0), (player_label1, player1) = self.params["players"].items()
-        i, j = np.indices((len(lgdf), len(lgdf)))
-        axd2 = {}
-        for ax in ['x', 'y', 'z']:
-            p0ax = lgdf[f"{player0}_target_block_{ax}"].to_numpy()
-            p1ax = lgdf[f"{player1}_target_block_{ax}"].to_numpy()
-            axd2[ax] = (p0ax[i] - p1ax[j]) ** 2
-        d2 = axd2['x'] + axd2['y'] + axd2['z']            
-        dt2 = self.params.get('distance_threshold', self.default_distance_threshold) ** 2
-        cross_recurrence = d2 <= dt2
+        times, cross_recurrence = self.get_cross_recurrence()
         np.save(self.export_filename(), cross_recurrence)
         if self.params.get('block_action_filename'):
             badf.to_csv(self.export_filename('block_action_filename'))
 
         if self.params.get("plot_filename"):
-            date_format = mdates.DateFormatter('%H:%M')
-            zeros = np.zeros(shape=(len(badf), 1))
-            fig = plt.figure(figsize=(8, 8), constrained_layout=True)
-            spec = fig.add_gridspec(2, 2, width_ratios=[5, 1], height_ratios=[1,5])
-            axcr = fig.add_subplot(spec[1, 0])
-            axtop = fig.add_subplot(spec[0, 0], sharex=axcr)
-            axright = fig.add_subplot(spec[1, 1], sharey=axcr)
+            with span("plot"):
+                date_format = mdates.DateFormatter('%H:%M')
+                zeros = np.zeros(shape=(len(badf), 1))
+                fig = plt.figure(figsize=(8, 8), constrained_layout=True)
+                spec = fig.add_gridspec(2, 2, width_ratios=[5, 1], height_ratios=[1,5])
+                axcr = fig.add_subplot(spec[1, 0])
+                axtop = fig.add_subplot(spec[0, 0], sharex=axcr)
+                axright = fig.add_subplot(spec[1, 1], sharey=axcr)
 
-            time_bounds = [lgdf.index[0].to_pydatetime(), lgdf.index[-1].to_pydatetime()]
-            extent = mdates.date2num(time_bounds * 2)
+                time_bounds = [times[0].to_pydatetime(), times[-1].to_pydatetime()]
+                extent = mdates.date2num(time_bounds * 2)
 
-            if player0 in badf.columns:
-                axtop.plot(badf.index, badf[player0], color='#365c8d')
-            else:
-                axtop.plot(badf.index, zeros)
-            axtop.axes.get_xaxis().set_visible(False)
-            axtop.set_xlim(time_bounds)
-            axtop.set_ylabel("Block edits")
-            if player1 in badf.columns:
-                axright.plot(badf[player1], badf.index, color='#277f8e')
-            else:
-                axright.plot(zeros, badf.index)
-            axright.axes.get_yaxis().set_visible(False)
-            axright.set_xlabel("Block edits")
+                if player0 in badf.columns:
+                    axtop.plot(badf.index, badf[player0], color='#365c8d')
+                else:
+                    axtop.plot(badf.index, zeros)
+                axtop.axes.get_xaxis().set_visible(False)
+                axtop.set_xlim(time_bounds)
+                axtop.set_ylabel("Block edits")
+                if player1 in badf.columns:
+                    axright.plot(badf[player1], badf.index, color='#277f8e')
+                else:
+                    axright.plot(zeros, badf.index)
+                axright.axes.get_yaxis().set_visible(False)
+                axright.set_xlabel("Block edits")
 
-            axcr.imshow(
-                cross_recurrence, 
-                origin="lower", 
-                extent=extent, 
-                cmap='Greys', 
-                vmin=0, 
-                vmax=1,
-            )
-            axcr.xaxis_date()
-            axcr.yaxis_date()
-            axcr.xaxis.set_major_formatter(date_format)
-            axcr.yaxis.set_major_formatter(date_format)
-            axcr.set_xlabel(player_label0)
-            axcr.set_ylabel(player_label1)
+                axcr.imshow(
+                    cross_recurrence, 
+                    origin="lower", 
+                    extent=extent, 
+                    cmap='Greys', 
+                    vmin=0, 
+                    vmax=1,
+                )
+                axcr.xaxis_date()
+                axcr.yaxis_date()
+                axcr.xaxis.set_major_formatter(date_format)
+                axcr.yaxis.set_major_formatter(date_format)
+                axcr.set_xlabel(player_label0)
+                axcr.set_ylabel(player_label1)
 
-            _, max0 = axtop.get_ylim()
-            _, max1 = axright.get_xlim()
-            axtop.set_ylim([0, max(max0, max1)])
-            axright.set_xlim([0, max(max0, max1)])
+                _, max0 = axtop.get_ylim()
+                _, max1 = axright.get_xlim()
+                axtop.set_ylim([0, max(max0, max1)])
+                axright.set_xlim([0, max(max0, max1)])
 
-            if self.params.get("plot_title"):
-                plt.suptitle(self.params.get("plot_title"))
-            fig.savefig(self.export_filename("plot_filename"))
+                if self.params.get("plot_title"):
+                    plt.suptitle(self.params.get("plot_title"))
+                fig.savefig(self.export_filename("plot_filename"))
 
     def get_block_action_df(self, df):
         "Returns a df filtered to include only block action"
@@ -6,10 +6,16 @@ import seaborn as sns
 from matplotlib.colors import ListedColormap
 from datetime import timedelta
 from segment.product.logs import SegmentLogs
+from segment.planner import estimate_frame_memory, ROWS_PER_SECOND
+from profiling import span
 from joint_attention import (
+    LOCATION_GAZE_COLUMNS,
     get_location_gaze,
     distance_measure,
     joint_attention_schneider_pea_2013,
+    joint_attention_schneider_pea_2013_all_pairs,
+    get_jva_episodes,
+    write_jva_episodes,
     plot_boolean_joint_attention,
 )
 
@@ -18,6 +24,8 @@ class SegmentJointAttention(SegmentLogs):
     Param `players` should be a dict mapping desired keys (e.g. 'a') to usernames
     Optional param `lookback` will look back this many seconds for initial position and
     gaze values
+    Optional param `episodes_filename` also exports JVA as episodes, with a row for each
+    run of JVA of each pair (see `joint_attention.get_jva_episodes`)
     """
     expected_params = [
         "format",
@@ -29,6 +37,7 @@ class SegmentJointAttention(SegmentLogs):
         "use_cache",
         "lookback",
         "plot_filename",
+        "episodes_filename",
         "distance_threshold",
         "window_seconds",
         "plot_title",
@@ -47,6 +56,23 @@ class SegmentJointAttention(SegmentLogs):
         end = self.segment_params['start'] + timedelta(seconds=self.segment_params['duration'] + ws)
         return start, end
 
+    def get_data_columns(self):
+        """Only players' positions and gaze are needed. All events are needed,
+        since every event is a tick of the location-gaze frame.
+        """
+        return ["player"] + LOCATION_GAZE_COLUMNS
+
+    def plan(self):
+        "Adds the location-gaze frame, with a row per event, to the logs read"
+        plan = super().plan()
+        rows = sum(read.get("rows", 0) for read in plan["reads"])
+        num_players = len(self.params.get("players", {}))
+        size = estimate_frame_memory(rows, len(LOCATION_GAZE_COLUMNS) * num_players)
+        plan["intermediates"]["location-gaze frame"] = size
+        plan["memory"] += size
+        plan["seconds"] += rows * num_players / ROWS_PER_SECOND
+        return plan
+
     def trim_df(self, df):
         """Trims a df to start and end (start+duration) times defined in segment.
         Sometimes this should be done after initial selection because lookback 
@@ -65,22 +91,38 @@ class SegmentJointAttention(SegmentLogs):
     def get_joint_attention_schneider_pea_2013_df(self):
         ws = self.params.get('window_seconds', self.default_window_seconds)
         dt = self.params.get('distance_threshold', self.default_distance_threshold)
-        df = self.get_segment_data()
-        lgdf = get_location_gaze(df, self.params['players'].values())
-        keypairs = list(combinations(self.params['players'].keys(), 2))
-        for k0, k1 in keypairs:
-            p0 = self.params['players'][k0]
-            p1 = self.params['players'][k1]
-            col = p0 + '-' + p1
-            lgdf[col] = joint_attention_schneider_pea_2013(lgdf, p0, p1, distance_threshold=dt, window_seconds=ws)
-        result = self.trim_df(lgdf)
+        players = list(self.params['players'].values())
+        lgdf = self.get_location_gaze_df(players)
+        with span("jva"):
+            jva = joint_attention_schneider_pea_2013_all_pairs(lgdf, players, distance_threshold=dt, window_seconds=ws)
+        result = self.trim_df(pd.concat([lgdf, jva], axis=1))
         return result
 
+    def get_joint_attention_episodes(self, df=None):
+        """Returns JVA episodes, from `df` when given, as returned by 
+        `get_joint_attention_schneider_pea_2013_df`. Episodes still going at the
+        end of the segment end there.
+        """
+        if df is None:
+            df = self.get_joint_attention_schneider_pea_2013_df()
+        end = self.segment_params['start'] + timedelta(seconds=self.segment_params['duration'])
+        with span("episodes"):
+            return get_jva_episodes(df, end=end)
+
     def export_joint_attention_schneider_pea_2013(self):
         result = self.get_joint_attention_schneider_pea_2013_df()
-        result.to_csv(self.export_filename())
+        with span("csv write"):
+            result.to_csv(self.export_filename())
+        if self.params.get('episodes_filename'):
+            episodes = self.get_joint_attention_episodes(result)
+            write_jva_episodes(episodes, self.export_filename('episodes_filename'))
         if self.params.get('plot_filename'):
+            self.plot_joint_attention(result)
+
+    def plot_joint_attention(self, result):
+        with span("plot"):
             figfile = self.export_filename('plot_filename')
+            keypairs = list(combinations(self.params['players'].keys(), 2))
             player_name_cols = [self.params['players'][k0] + '-' + self.params['players'][k1] for k0, k1 in keypairs]
             label_cols = [k0 + '-' + k1 for k0, k1 in keypairs]
             result = result[player_name_cols].rename(columns=dict(zip(player_name_cols, label_cols)))
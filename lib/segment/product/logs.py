@@ -1,39 +1,134 @@
-from pathlib import Path
-import pandas as pd
 from datetime import timedelta
+import joint_attention
+import logs.store
+import segment.context
 from segment.product.base import SegmentProduct
+from segment.context import load_logs, get_logs_cache_key
+from segment.planner import estimate_log_read, estimate_frame_memory, estimate_read_seconds
+from cache import CacheManager, get_source_fingerprint
+from profiling import span
+from joint_attention import LOCATION_GAZE_COLUMNS, get_location_gaze, get_gaze_tensor
 
 class SegmentLogs(SegmentProduct):
     """A log file in .csv format.
-    When `use_cache` is true, will use a cached subset of the main log file when possible.
+    When `use_cache` is true, will use a cached subset of the main log file when possible
+    (see `cache.CacheManager`). When the product has a data context, logs are
+    read from it instead.
+    Optional params `columns` and `events` restrict the log to these columns
+    and event types. Subclasses declare the data they need by overriding 
+    `get_data_columns` and `get_data_events`; only these are read.
     """
     optional_params = [
         "use_cache",
+        "columns",
+        "events",
     ]
-    main_log_file = "data/df/production.csv"
+    main_log_file = "data/df/production.parquet"
+
+    def set_data_context(self, context):
+        super().set_data_context(context)
+        context.request(
+            *self.get_start_end_times(), 
+            columns=self.get_data_columns(), 
+            events=self.get_data_events(),
+            use_cache=self.params.get("use_cache", False),
+        )
+
+    def get_sources(self):
+        return [self.main_log_file]
+
+    def get_code_modules(self):
+        return super().get_code_modules() + [segment.context, logs.store, joint_attention]
+
+    def get_source_data_fingerprint(self):
+        """Fingerprints only the log partitions which overlap the product's time 
+        range (see `get_start_end_times`), of the events it reads, and the 
+        columns and events it reads.
+        """
+        start, end = self.get_start_end_times()
+        return {
+            "logs": get_source_fingerprint(self.main_log_file, start=start, end=end, events=self.get_data_events()),
+            "columns": self.get_data_columns(),
+            "events": self.get_data_events(),
+        }
+
+    def get_data_columns(self):
+        "Returns the log columns this product needs, or None for all columns"
+        return self.params.get("columns")
+
+    def get_data_events(self):
+        "Returns the event types this product needs, or None for all events"
+        return self.params.get("events")
 
     def get_segment_data(self):
-        """Returns a dataframe 
+        """Returns a dataframe of the logs in the segment, with only the 
+        columns and events the product needs.
         """
-        if self.params.get("use_cache") and self.get_cached_log_path().exists():
-            datapath = self.get_cached_log_path()
-        else:
-            datapath = self.main_log_file
-        df = pd.read_csv(datapath, index_col="timestamp", parse_dates=["timestamp"], low_memory=False)
-        df = df.sort_index()
         start, end = self.get_start_end_times()
-        df = df.loc[start:end]
-        if self.params.get("use_cache") and not self.get_cached_log_path().exists():
-            self.get_cached_log_path().parent.mkdir(parents=True, exist_ok=True)
-            df.to_csv(self.get_cached_log_path())
-        return df
+        columns = self.get_data_columns()
+        events = self.get_data_events()
+        if self.data_context:
+            return self.data_context.get_logs(start, end, columns, events)
+        return load_logs(self.main_log_file, start, end, columns, events, self.params.get("use_cache", False))
 
     def export(self):
-        self.get_segment_data().to_csv(self.export_filename())
+        df = self.get_segment_data()
+        with span("csv write"):
+            df.to_csv(self.export_filename())
+
+    def get_location_gaze_df(self, players):
+        """Returns `get_location_gaze` for the segment data, shared with other
+        products when there is a data context.
+        """
+        if self.data_context:
+            start, end = self.get_start_end_times()
+            with span("location gaze"):
+                return self.data_context.get_derived(
+                    get_location_gaze, start, end, tuple(players), 
+                    columns=self.get_data_columns(), 
+                    events=self.get_data_events(),
+                )
+        df = self.get_segment_data()
+        with span("location gaze"):
+            return get_location_gaze(df, players)
 
-    def get_cached_log_path(self):
+    def get_gaze_tensor(self, players, freq, features=LOCATION_GAZE_COLUMNS):
+        """Returns `get_gaze_tensor` for the segment data, on a grid of `freq` over
+        the segment, shared with other products when there is a data context.
+        Data from before the segment (see `get_start_end_times`) gives initial values.
+        """
+        grid_start = self.segment_params['start']
+        grid_end = grid_start + timedelta(seconds=self.segment_params['duration'])
+        if self.data_context:
+            start, end = self.get_start_end_times()
+            with span("gaze tensor"):
+                return self.data_context.get_derived(
+                    get_gaze_tensor, start, end, tuple(players), grid_start, grid_end, freq, tuple(features),
+                    columns=self.get_data_columns(), 
+                    events=self.get_data_events(),
+                )
+        df = self.get_segment_data()
+        with span("gaze tensor"):
+            return get_gaze_tensor(df, players, grid_start, grid_end, freq, features)
+
+    def plan(self):
+        """Estimates the product's read of the logs. When the product has a data
+        context, the read is shared, so its time is counted for the context.
+        """
+        plan = super().plan()
         start, end = self.get_start_end_times()
-        return Path("data/cache") / f"logs_{start}-{end}.csv"
+        columns = self.get_data_columns()
+        events = self.get_data_events()
+        read = estimate_log_read(self.main_log_file, start, end, columns, events)
+        plan["reads"].append(read)
+        plan["memory"] += estimate_frame_memory(read.get("rows", 0), read.get("columns", 0))
+        if not self.data_context:
+            plan["seconds"] += estimate_read_seconds(read)
+            if self.params.get("use_cache", False):
+                cache = CacheManager()
+                key = get_logs_cache_key(cache, self.main_log_file, start, end, columns, events)
+                plan["cache"].append({"key": key, "hit": cache.contains(key)})
+        return plan
 
     def get_start_end_times(self):
         "Returns (start, end) times"
@@ -5,18 +5,30 @@
 
 from subprocess import run, DEVNULL
 from collections.abc import Iterator
+from segment.product.base import SegmentProduct
 from segment.product.logs import SegmentLogs
 from jinja2 import FileSystemLoader, Environment
 import shutil
 from pathlib import Path
 import json
-from hashlib import md5
 from base64 import b64encode
 from collections import defaultdict
 from itertools import combinations
 from datetime import timedelta
+import pandas as pd
+from segment.product.simulation import mc_world, anvil_reader
 from segment.product.simulation.mc_world import MinecraftWorldView
 from segment.product.joint_attention import SegmentJointAttention
+from segment.scheduler import get_product_name
+from cache import CacheManager, get_source_fingerprint, get_code_version
+from profiling import span
+from segment.planner import (
+    estimate_log_read, 
+    estimate_frame_memory, 
+    estimate_read_seconds, 
+    VOXELS_PER_SECOND, 
+    BYTES_PER_VOXEL,
+)
 
 def tuples(iterator):
     """Yields pairs of items.
@@ -28,10 +40,18 @@ def tuples(iterator):
         yield item0, item1
         item0 = item1
 
+def to_json_values(values):
+    "Returns a list of values for JSON, with missing values (NaN or NA) as null"
+    return [None if pd.isna(value) else value for value in values]
+
 class SegmentSimulation(SegmentLogs):
     """A three.js simulation.
     - Use the full log to compute the world's initial state.
+    The study data is generated by a separate step, `SegmentSimulationData`, 
+    in a worker process; this product waits on `npm run build` and renders 
+    the HTML, so it runs with the other subprocess-bound products.
     """
+    executor = "subprocess"
     expected_params = [
         "format",
         "export_filename",
@@ -54,31 +74,56 @@ class SegmentSimulation(SegmentLogs):
     initial_production_mca_path = "data/server/production-original/region"
     world_height = 256
 
+    def get_steps(self):
+        "Generates the study data first, in its own step"
+        data = SegmentSimulationData(self.segment_params, self.params)
+        depends_on = self.params.get("depends_on", []) + [get_product_name(data)]
+        return [data, SegmentSimulation(self.segment_params, {**self.params, "depends_on": depends_on})]
+
     def export(self):
-        if not (self.params.get("use_cache", True) and self.get_cached_study_data_path().exists()):
-            self.generate_study_data_json()
-        run('npm run build', cwd=self.here / 'js', shell=True)
+        # The data step has just saved the study data to the cache.
+        study_json = self.get_study_data_json(use_cache=True)
+        with span("npm build"):
+            run('npm run build', cwd=self.here / 'js', shell=True)
         env = Environment(loader=FileSystemLoader(self.template_dir))
         template = env.get_template(self.template)
         simulation_js = self.bundle_path.read_text()
-        study_json = self.get_cached_study_data_path().read_text()
-
-        with open(self.export_filename(), 'w') as fh:
-            with open(self.bundle_path) as js_fh:
-                fh.write(template.render({
-                    'simulation_js': simulation_js,
-                    'study_json': study_json,
-                    'title': self.params.get('title', '')
-                }))
-
-    def generate_study_data_json(self):
-        world = MinecraftWorldView(
-            self.initial_production_mca_path,
-            self.main_log_file,
-            self.params['bounding_box'],
-            self.segment_params['start'],
-            self.segment_params['duration'],
-        )
+
+        with span("html write"), open(self.export_filename(), 'w') as fh:
+            fh.write(template.render({
+                'simulation_js': simulation_js,
+                'study_json': study_json,
+                'title': self.params.get('title', '')
+            }))
+
+    def get_study_data_json(self, use_cache=None):
+        """Returns the study data as JSON, from the cache when `use_cache` 
+        (by default the param, which defaults to True) and it's there. Study 
+        data is always saved to the cache.
+        """
+        cache = CacheManager()
+        key = self.get_study_data_cache_key(cache)
+        study_json = None
+        if use_cache is None:
+            use_cache = self.params.get("use_cache", True)
+        if use_cache:
+            study_json = cache.get_bytes(key)
+        if study_json is None:
+            data = self.generate_study_data()
+            with span("json write"):
+                study_json = json.dumps(data).encode("utf-8")
+                cache.put_bytes(key, study_json)
+        return study_json.decode("utf-8")
+
+    def generate_study_data(self):
+        with span("ops load"):
+            world = MinecraftWorldView(
+                self.initial_production_mca_path,
+                self.main_log_file,
+                self.params['bounding_box'],
+                self.segment_params['start'],
+                self.segment_params['duration'],
+            )
         start = self.segment_params['start']
         end = start + timedelta(seconds=self.segment_params['duration'])
         data = {}
@@ -89,22 +134,34 @@ class SegmentSimulation(SegmentLogs):
         data['layers'] = {}
         data['layers']['terrain'] = self.get_terrain_layer(world)
         p_param = self.params['layers'].get('players')
-        if p_param == 'all':
-            p_df = self.filter_players_df(world.ops_df)
-            p_layer = self.get_players_layer(p_df, all_players=True)
-        elif isinstance(self.params['layers']['players'], list):
-            p_df = self.filter_players_df(world.ops_df)
-            p_layer = self.get_players_layer(p_df, players=p_param)
-        else:
-            raise ValueError(f"Invalid players layer arg: {p_param}")
+        with span("op generation", layer="players"):
+            if p_param == 'all':
+                p_df = self.filter_players_df(world.ops_df)
+                p_layer = self.get_players_layer(p_df, all_players=True)
+            elif isinstance(self.params['layers']['players'], list):
+                p_df = self.filter_players_df(world.ops_df)
+                p_layer = self.get_players_layer(p_df, players=p_param)
+            else:
+                raise ValueError(f"Invalid players layer arg: {p_param}")
         data['layers']['players'] = p_layer
         if self.params['layers'].get('jva'):
             player_list = p_layer['initial'].keys()
-            data['layers']['jva'] = self.get_jva_layer(player_list)
-        with open(self.get_cached_study_data_path(), 'w') as fh:
-            json.dump(data, fh)
+            with span("op generation", layer="jva"):
+                data['layers']['jva'] = self.get_jva_layer(player_list)
+        return data
 
-    def get_jva_layer(self, players):
+    def set_data_context(self, context):
+        "Only the data step reads logs"
+        SegmentProduct.set_data_context(self, context)
+
+    def plan(self):
+        "Generating the study data is planned by the data step"
+        return SegmentProduct.plan(self)
+
+    def get_jva_product(self, players, with_context=True):
+        """Returns a joint attention product for the JVA layer, which shares the
+        simulation's data context when `with_context`.
+        """
         jva_params = {k:v for k, v in self.params.items() if k in 
                 SegmentJointAttention.optional_params}
         jva_params['format'] = "joint_attention"
@@ -112,39 +169,27 @@ class SegmentSimulation(SegmentLogs):
         jva_params['players'] = {p:p for p in players}
         jva_params['measure'] = "joint_attention_schneider_pea_2013"
         jva_product = SegmentJointAttention(self.segment_params, jva_params)
-        df = jva_product.get_joint_attention_schneider_pea_2013_df()
-        player_pairs = list(combinations(sorted(players), 2))
-        initial = {f"{p0}-{p1}": self.row_to_jva_state(df.iloc[0], p0, p1) for p0, p1 in player_pairs}
-        ops = {f"{p0}-{p1}": self.player_pair_ops(df, p0, p1) for p0, p1 in player_pairs}
-        return {"type": "jva", "initial": initial, "ops": ops}
-
-    def player_pair_ops(self, df, p0, p1):
-        ops = []
-        for (ts0, row0), (ts1, row1) in tuples(df.iterrows()):
-            if row0[f"{p0}-{p1}"] or row1[f"{p0}-{p1}"]:
-                s0 = self.row_to_jva_state(row0, p0, p1)
-                s1 = self.row_to_jva_state(row1, p0, p1)
-                if not (s0[1] == s1[1] and s0[2] == s1[2] and s0[3] == s1[3]):
-                    ops.append([str(ts1), s0, s1])
-        return ops
+        if with_context and self.data_context:
+            jva_product.set_data_context(self.data_context)
+        return jva_product
 
-    def row_to_jva_state(self, row, player0, player1):
-        """Given a df produced by SegmentJointAttention, returns a 4-tuple
-        (jva_bool, x, y, z), indicating the shared gaze point of the players
-        if they have JVA.
-        .Zora299629_target_block_x'
+    def get_jva_layer(self, players):
+        """Returns the JVA layer. Its states are 4-tuples (jva_bool, x, y, z), where
+        x, y, z is the pair's mean shared gaze point during a JVA episode. Each 
+        episode contributes ops for its start and its end.
         """
-        jva_bool = bool(row[f"{player0}-{player1}"])
-        if jva_bool:
-            jva_x = (row[f"{player0}_target_block_x"] + row[f"{player1}_target_block_x"]) / 2
-            jva_y = (row[f"{player0}_target_block_y"] + row[f"{player1}_target_block_y"]) / 2
-            jva_z = (row[f"{player0}_target_block_z"] + row[f"{player1}_target_block_z"]) / 2
-        else:
-            jva_x = 0
-            jva_y = 0
-            jva_z = 0
-        return (jva_bool, jva_x, jva_y, jva_z)
-        
+        players = sorted(players)
+        episodes = self.get_jva_product(players).get_joint_attention_episodes()
+        player_pairs = [f"{p0}-{p1}" for p0, p1 in combinations(players, 2)]
+        no_jva = (False, 0, 0, 0)
+        initial = {pair: no_jva for pair in player_pairs}
+        ops = {pair: [] for pair in player_pairs}
+        for pair, start, end, x, y, z in episodes[['pair', 'start', 'end', 'x', 'y', 'z']].itertuples(index=False):
+            state = (True, float(x), float(y), float(z))
+            ops[pair].append([str(start), no_jva, state])
+            ops[pair].append([str(end), state, no_jva])
+        return {"type": "jva", "initial": initial, "ops": ops}
+
     def filter_players_df(self, df):
         start = self.segment_params['start']
         end = start + timedelta(seconds=self.segment_params['duration'])
@@ -162,10 +207,12 @@ class SegmentSimulation(SegmentLogs):
 
     def get_terrain_layer(self, world):
         voxels, palette = world.get_base_layer_at_start()
+        with span("op generation", layer="terrain"):
+            ops = world.get_base_layer_opset()
         return {
             "type": "terrain",
             "initial": [voxels, palette],
-            "ops": world.get_base_layer_opset(),
+            "ops": ops,
         }
 
     def get_players_layer(self, df, players=None, all_players=False):
@@ -202,22 +249,103 @@ class SegmentSimulation(SegmentLogs):
 
     def row_to_player_state(self, row):
         return {
-            "position": [row.location_x, row.location_y, row.location_z],
-            "eyeDirection": [row.eye_direction_pitch, row.eye_direction_yaw],
-            "eyeTarget": [row.target_block_x, row.target_block_y, row.target_block_z]
+            "position": to_json_values([row.location_x, row.location_y, row.location_z]),
+            "eyeDirection": to_json_values([row.eye_direction_pitch, row.eye_direction_yaw]),
+            "eyeTarget": to_json_values([row.target_block_x, row.target_block_y, row.target_block_z])
         }
 
-    def get_cached_study_data_path(self):
-        ((x0, x1), (y0, y1), (z0, z1)) = self.params['bounding_box']
-        start, end = self.get_start_end_times()
+    def get_study_data_cache_key(self, cache):
+        """Returns the study data's cache key, which depends on the main log,
+        the initial world, the params, and the code generating the study data.
+        """
         params = {
-            'p': self.params, 
+            'p': {k: v for k, v in self.params.items() if k not in self.unfingerprinted_params}, 
             'start': str(self.segment_params['start']), 
             'duration': self.segment_params['duration']
         }
-        cache_hash = md5(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
-        return Path("data/cache") / f"simulation-{cache_hash}.json"
+        return cache.key(
+            "simulation",
+            source=self.get_source_data_fingerprint(),
+            params=params,
+            code=get_code_version(*self.get_code_modules()),
+        )
+
+    def get_sources(self):
+        return [self.main_log_file, self.initial_production_mca_path]
+
+    def get_source_data_fingerprint(self):
+        """Fingerprints the log partitions the study data is made from: block 
+        events up to the segment's end, which make the world, and all events in
+        the time range of the JVA layer, which includes the segment; and the
+        initial world.
+        """
+        start, end = self.get_start_end_times()
+        jva_start, jva_end = self.get_jva_product([], with_context=False).get_start_end_times()
+        blocks = ['BlockPlaceEvent', 'BlockBreakEvent']
+        return {
+            "blocks": get_source_fingerprint(self.main_log_file, end=end, events=blocks),
+            "logs": get_source_fingerprint(self.main_log_file, start=min(start, jva_start), end=max(end, jva_end)),
+            "world": get_source_fingerprint(self.initial_production_mca_path),
+        }
+
+    def get_code_modules(self):
+        return super().get_code_modules() + [SegmentJointAttention, mc_world, anvil_reader]
 
     def get_bounding_box_center(self):
         return [i0 + (i1 - i0) / 2 for i0, i1 in self.params['bounding_box']]
 
+class SegmentSimulationData(SegmentSimulation):
+    """The step of a simulation which generates its study data and saves it to
+    the cache, where the simulation reads it.
+    """
+    executor = "process"
+    step = "data"
+
+    def get_steps(self):
+        return [self]
+
+    def export(self):
+        self.get_study_data_json()
+
+    def get_output_filenames(self):
+        return []
+
+    def get_code_modules(self):
+        "The same as the simulation's, so that both find the study data under the same key"
+        return [m for m in super().get_code_modules() if m is not SegmentSimulationData]
+
+    def set_data_context(self, context):
+        """The simulation reads the main log through its world view, so only
+        its JVA layer requests logs from the data context.
+        """
+        SegmentProduct.set_data_context(self, context)
+        if self.params['layers'].get('jva'):
+            self.get_jva_product([]).set_data_context(context)
+
+    def plan(self):
+        """Estimates generating the study data, unless it is cached: reading 
+        block events up to the segment's end and player moves during it, and 
+        reading the voxels in the bounding box.
+        """
+        plan = SegmentProduct.plan(self)
+        cache = CacheManager()
+        key = self.get_study_data_cache_key(cache)
+        hit = self.params.get("use_cache", True) and cache.contains(key)
+        plan["cache"].append({"key": key, "hit": hit})
+        if hit:
+            return plan
+        start = self.segment_params['start']
+        end = start + timedelta(seconds=self.segment_params['duration'])
+        plan["reads"] = [
+            estimate_log_read(self.main_log_file, end=end, events=['BlockPlaceEvent', 'BlockBreakEvent']),
+            estimate_log_read(self.main_log_file, start, end, events=['PlayerMoveEvent']),
+        ]
+        for read in plan["reads"]:
+            plan["memory"] += estimate_frame_memory(read.get("rows", 0), read.get("columns", 0))
+            plan["seconds"] += estimate_read_seconds(read)
+        ((x0, x1), (y0, y1), (z0, z1)) = self.params['bounding_box']
+        volume = (x1 - x0) * (y1 - y0) * (z1 - z0)
+        plan["intermediates"]["voxels ({} blocks)".format(volume)] = volume * BYTES_PER_VOXEL
+        plan["memory"] += volume * BYTES_PER_VOXEL
+        plan["seconds"] += volume / VOXELS_PER_SECOND
+        return plan
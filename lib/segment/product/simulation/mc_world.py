@@ -6,8 +6,10 @@ from pathlib import Path
 import pandas as pd
 from collections import defaultdict
 from segment.product.simulation.anvil_reader import AnvilReader
+from logs.store import read_logs
 from datetime import timedelta
 from tqdm import tqdm
+from profiling import span
 
 DEBUG = False
 DEBUG_NROWS = 1000000
@@ -32,7 +34,8 @@ class MinecraftWorldView:
 
     def get_original_base_layer(self):
         reader = AnvilReader(self.mca_path)
-        voxels, palette = reader.read(self.bounding_box)
+        with span("voxel read"):
+            voxels, palette = reader.read(self.bounding_box)
         return voxels, palette
 
     def get_base_layer_at_start(self):
@@ -111,18 +114,15 @@ class MinecraftWorldView:
         return ops.sort_index()
 
     def get_ops_df(self):
-        relevant_event_types = [
-            'PlayerMoveEvent',
-            'BlockPlaceEvent',
-            'BlockBreakEvent',
-        ]
-        ops = pd.read_csv(
-            Path(self.logfile), 
-            index_col="timestamp", 
-            parse_dates=["timestamp"], 
-            date_parser=lambda x: pd.to_datetime(x, utc=True),
-            low_memory=False,
-            nrows = DEBUG_NROWS if DEBUG else None,
-        )
-        ops = ops[ops.event.isin(relevant_event_types)]
+        """Loads block events up to the end of the segment (the base layer
+        replays every edit before the start) and player moves during the
+        segment. Partitions outside these time ranges are never opened.
+        """
+        block_ops = read_logs(self.logfile, events=['BlockPlaceEvent', 'BlockBreakEvent'], 
+                end=self.end, utc=True)
+        move_ops = read_logs(self.logfile, events=['PlayerMoveEvent'], 
+                start=self.start, end=self.end, utc=True)
+        ops = pd.concat([block_ops, move_ops])
+        if DEBUG:
+            ops = ops.iloc[:DEBUG_NROWS]
         return ops
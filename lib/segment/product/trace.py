@@ -1,5 +1,7 @@
 from segment.product.logs import SegmentLogs
+from profiling import span
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import seaborn as sns
 
@@ -11,7 +13,9 @@ def reverse_dict(d):
     return {v:k for k, v in d.items()}
 
 class SegmentTrace(SegmentLogs):
-    """Produces a heatmap of character locations
+    """Produces a heatmap of character locations.
+    The trace has a row for each player at each time step of `granularity`, with
+    the player's last known location.
     """
     optional_params = [
         "use_cache",
@@ -38,33 +42,48 @@ class SegmentTrace(SegmentLogs):
     default_xlim = [-100, 350]
     default_ylim = [-100, 900]
 
+    def get_data_columns(self):
+        loc = self.params.get("location", self.default_location)
+        return ["player", loc + "_x", loc + "_z"]
+
     def export(self):
-        df = self.get_segment_data()
         loc = self.params.get("location", self.default_location)
-        df = df[["player", loc + "_x", loc + "_z"]]
+        features = [loc + "_x", loc + "_z"]
         if self.params.get("players"):
-            df = df[df.player.isin(self.params['players'].values())]
+            players = list(self.params['players'].values())
+        else:
+            players = sorted(self.get_segment_data().player.dropna().unique())
         granularity = self.params.get("granularity", self.default_granularity)
-        df = df.resample(granularity).first().dropna()
+        times, locations = self.get_gaze_tensor(players, granularity, features)
+        df = pd.DataFrame({
+            "player": np.tile(np.array(players, dtype=object), len(times)),
+            features[0]: locations[:, :, 0].ravel(),
+            features[1]: locations[:, :, 1].ravel(),
+        }, index=times.repeat(len(players))).dropna()
         df.to_csv(self.export_filename())
 
         if self.params.get('plot_filename'):
-            reverse_lookup = reverse_dict(self.params['players'])
-            df['player'] = df.player.apply(lambda player: reverse_lookup[player])
+            with span("plot"):
+                self.plot(df)
+
+    def plot(self, df):
+        "Plots the trace as a heatmap, or diachronically"
+        reverse_lookup = reverse_dict(self.params['players'])
+        df['player'] = df.player.astype(str).map(reverse_lookup)
 
-            sns.set_theme(style="white")
-            if self.params.get("diachronic"):
-                ax = self.plot_diachronic(df)
-            else:
-                ax = self.plot_heatmap(df)
-            plt.xlim(self.params.get('xlim', self.default_xlim))
-            plt.ylim(self.params.get('ylim', self.default_ylim))
-            if self.params.get("plot_title"):
-                plt.suptitle(self.params.get("plot_title"))
-            ax.set(xlabel="X")
-            ax.set(ylabel="Z")
-            ax.figure.tight_layout()
-            plt.savefig(self.export_filename('plot_filename'))
+        sns.set_theme(style="white")
+        if self.params.get("diachronic"):
+            ax = self.plot_diachronic(df)
+        else:
+            ax = self.plot_heatmap(df)
+        plt.xlim(self.params.get('xlim', self.default_xlim))
+        plt.ylim(self.params.get('ylim', self.default_ylim))
+        if self.params.get("plot_title"):
+            plt.suptitle(self.params.get("plot_title"))
+        ax.set(xlabel="X")
+        ax.set(ylabel="Z")
+        ax.figure.tight_layout()
+        plt.savefig(self.export_filename('plot_filename'))
         
     def plot_diachronic(self, df):
         df = df.reset_index()
@@ -3,10 +3,12 @@ from subprocess import run
 from pathlib import Path
 from segment.product.base import SegmentProduct
 from metadata import get_media_metadata, METADATA_SUFFIX
+from segment.planner import estimate_file_reads, estimate_read_seconds
 
 class SegmentVideo(SegmentProduct):
     """A video in .mp4 format, optionally with an audio track.
     """
+    executor = "subprocess"
     expected_params = [
         "format",
         "export_filename",
@@ -16,6 +18,24 @@ class SegmentVideo(SegmentProduct):
         "audio_source"
     ]
 
+    def get_media_sources(self):
+        "Returns the paths of the media files this product is cut from"
+        sources = [self.params['video_source']]
+        if 'audio_source' in self.params:
+            sources.append(self.params['audio_source'])
+        return sources
+
+    def get_sources(self):
+        sources = self.get_media_sources()
+        return sources + [source + METADATA_SUFFIX for source in sources]
+
+    def plan(self):
+        "ffmpeg copies streams without re-encoding, so reading the sources dominates"
+        plan = super().plan()
+        plan["reads"] = estimate_file_reads(self.get_media_sources())
+        plan["seconds"] = sum(estimate_read_seconds(read) for read in plan["reads"])
+        return plan
+
     def export(self):
         if "audio_source" in self.params:
             export_file = self.merge_audio_and_video()
@@ -0,0 +1,199 @@
+# Running a segment's product exports concurrently
+#
+# Products form a DAG: a product may list, in its `depends_on` param, the
+# export filenames of products which must be exported before it. Products
+# whose dependencies are done run concurrently. Python-heavy products run in
+# a pool of worker processes; products which mostly wait on external programs
+# (ffmpeg, npm) declare `executor = "subprocess"` and run in a small pool of
+# threads, bounding the number of concurrent subprocesses. A product which
+# does both is split into steps (see `SegmentProduct.get_steps`).
+#
+# Worker processes are forked after the segment's data context has loaded the
+# logs, so they share the loaded data rather than each reading it again. 
+# Forking a process while other threads run can deadlock it, so all workers
+# are forked up front, before any thread is started (see `start_process_pool`).
+# Where fork is unavailable or unsafe (Windows, macOS), products are exported
+# serially.
+
+import multiprocessing
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from profiling import span, after_fork, collect_spans, add_spans, paused_sampling
+
+PROCESS = "process"
+SUBPROCESS = "subprocess"
+
+# Products being exported, inherited by forked worker processes.
+_products = []
+
+class ExportScheduler:
+    """Exports a segment's products, respecting their dependencies.
+    With `workers` > 1, independent products are exported concurrently in up to
+    `workers` processes, and subprocess-bound products in up to
+    `subprocess_workers` threads, unless processes can't be forked (see `can_fork`). A failing product doesn't stop the others;
+    products which depend on it are skipped. Products whose indices are in 
+    `skip` are treated as already exported.
+    """
+
+    class ExportError(Exception):
+        def __init__(self, failures):
+            self.failures = failures
+            super().__init__("{} products failed:\n{}".format(len(failures), "\n".join(
+                " - {}: {}".format(name, error.strip().splitlines()[-1])
+                for name, error in failures.items()
+            )))
+
+    def __init__(self, products, workers=1, subprocess_workers=2, skip=()):
+        self.products = products
+        self.skip = set(skip)
+        self.workers = workers
+        self.subprocess_workers = subprocess_workers
+        self.names = [get_product_name(product) for product in products]
+        self.order = get_export_order(products)
+        self.dependencies = get_dependencies(products)
+        self.errors = {}
+
+    def run(self):
+        """Exports all products. Returns a dict mapping the name of each product
+        which failed or was skipped to its error message.
+        """
+        if self.workers > 1 and can_fork():
+            self.run_concurrently()
+        else:
+            self.run_serially()
+        return self.get_failures()
+
+    def run_serially(self):
+        for i in self.order:
+            if i in self.skip or not self.check_dependencies(i):
+                continue
+            error = export_product(self.products[i])
+            if error:
+                self.report_failure(i, error)
+
+    def run_concurrently(self):
+        global _products
+        _products = self.products
+        pending = set(range(len(self.products))) - self.skip
+        running = {}
+        with start_process_pool(self.workers) as processes, \
+                ThreadPoolExecutor(self.subprocess_workers) as threads:
+            while pending or running:
+                for i in sorted(pending):
+                    deps = self.dependencies[i]
+                    if any(d in self.errors for d in deps):
+                        pending.remove(i)
+                        self.check_dependencies(i)
+                    elif not (deps & pending or deps & set(running.values())):
+                        pending.remove(i)
+                        if getattr(self.products[i], "executor", PROCESS) == SUBPROCESS:
+                            future = threads.submit(export_product_in_thread, self.products[i])
+                        else:
+                            future = processes.submit(export_product_in_worker, i)
+                        running[future] = i
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    try:
+                        error, spans = future.result()
+                        add_spans(spans)
+                    except Exception:
+                        error = traceback.format_exc()
+                    if error:
+                        self.report_failure(i, error)
+        _products = []
+
+    def check_dependencies(self, i):
+        """Returns True when none of product i's dependencies failed. Otherwise,
+        records product i as skipped.
+        """
+        failed = [self.names[d] for d in sorted(self.dependencies[i]) if d in self.errors]
+        if failed:
+            self.errors[i] = "Skipped because {} failed".format(", ".join(failed))
+            print("{}: {}".format(self.names[i], self.errors[i]))
+        return not failed
+
+    def report_failure(self, i, error):
+        self.errors[i] = error
+        print("{} failed:\n{}".format(self.names[i], error))
+
+    def get_failures(self):
+        "Returns a dict mapping the names of failed or skipped products to errors"
+        return {self.names[i]: error for i, error in sorted(self.errors.items())}
+
+def can_fork():
+    """Checks whether worker processes can be forked. fork is unavailable on
+    Windows, and unsafe on macOS, whose system libraries may run threads.
+    """
+    return sys.platform != "darwin" and "fork" in multiprocessing.get_all_start_methods()
+
+def start_process_pool(workers):
+    """Returns a pool of `workers` forked processes, all of which are forked 
+    right away, while the profiler's sampler is paused. Call it before starting
+    any threads, so that no thread is running when the workers fork.
+    """
+    executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+    with paused_sampling():
+        # With fork, the first task makes the pool fork all of its workers.
+        executor.submit(int).result()
+    return executor
+
+def export_product(product):
+    "Exports a product, returning the formatted traceback if it fails"
+    try:
+        with span("product " + get_product_name(product), format=product.params.get("format")):
+            product.export()
+    except Exception:
+        return traceback.format_exc()
+
+def export_product_in_worker(i):
+    "Exports a product in a worker process. Returns (error, spans)."
+    after_fork()
+    return export_product(_products[i]), collect_spans()
+
+def export_product_in_thread(product):
+    """Exports a product in a worker thread. Returns (error, spans), though 
+    spans recorded in threads are already in the profile.
+    """
+    return export_product(product), []
+
+def get_product_name(product):
+    """Returns a product's name: its export filename, or its format, followed
+    by its step, if it is a step of a product.
+    """
+    name = product.params.get("export_filename", product.params.get("format"))
+    step = getattr(product, "step", None)
+    return name + " " + step if step else name
+
+def get_dependencies(products):
+    """Returns a list with the set of indices of the products each product
+    depends on. Raises ValueError if a dependency isn't one of the products.
+    """
+    names = [get_product_name(product) for product in products]
+    dependencies = []
+    for product in products:
+        deps = set()
+        for name in product.params.get("depends_on", []):
+            if name not in names:
+                raise ValueError("{} depends on unknown product {}".format(get_product_name(product), name))
+            deps.add(names.index(name))
+        dependencies.append(deps)
+    return dependencies
+
+def get_export_order(products):
+    """Returns the indices of products in an order which respects their
+    dependencies, keeping the products' order otherwise.
+    Raises ValueError when dependencies form a cycle.
+    """
+    dependencies = get_dependencies(products)
+    order = []
+    while len(order) < len(products):
+        ready = [i for i in range(len(products)) if i not in order and dependencies[i] <= set(order)]
+        if not ready:
+            cycle = [get_product_name(products[i]) for i in range(len(products)) if i not in order]
+            raise ValueError("Products have circular dependencies: {}".format(", ".join(cycle)))
+        order.append(ready[0])
+    return order
@@ -11,11 +11,18 @@ sys.path.append("lib")
     "world": "name of world",
     "minecraft_username": "optional: sync one user's data",
     "dataframe": "whether to also generate a dataframe",
+    "csv": "also export the dataframe as CSV",
     "interact": "enter interactive mode to explore the resulting dataframe",
+    "workers": "number of processes to use when parsing log files",
+    "incremental": "only parse lines added since the last sync",
+    "lenient": "skip malformed lines, saving them to a quarantine file next to the dataframe",
 })
-def sync(c, world, minecraft_username=None, dataframe=True, interact=False):
+def sync(c, world, minecraft_username=None, dataframe=True, csv=False, interact=False, 
+        workers=1, incremental=False, lenient=False):
     "Sync logs from the server to local filesystem"
     from logs.reader import LogReader
+    from logs.ingest import ingest_logs
+    from logs.store import read_logs
 
     remote_path = Path(c.minecraft_server.mscs_dir) / "worlds" / world / "plugins" / "SuperLog" / "logs"
     local_path = Path(c.local.logs_path) / world
@@ -31,19 +38,65 @@ def sync(c, world, minecraft_username=None, dataframe=True, interact=False):
     )
     c.run(command)
 
-    if minecraft_username:
-        df_fn = world + "_" + minecraft_username + ".csv"
-    else:
-        df_fn = world + ".csv"
-    df_path = Path(c.local.dataframe_path) / df_fn
+    df_path = get_dataframe_path(c, world, minecraft_username)
     df_path.parent.mkdir(exist_ok=True, parents=True)
-    df = LogReader(local_path).to_df()
+    quarantine_path = df_path.with_suffix(".quarantine.jsonl")
+    reader = LogReader(local_path, lenient=lenient, quarantine_path=quarantine_path)
     if dataframe:
-        df.to_csv(df_path)
+        num_events = ingest_logs(reader, df_path, workers=workers, incremental=incremental)
+        print("Ingested {} new events".format(num_events))
+        if reader.file_stats:
+            print(reader.format_report())
+        if reader.report()["errors"]:
+            print("Malformed lines were saved to {}".format(quarantine_path))
+        if csv:
+            read_logs(df_path).to_csv(df_path.with_suffix(".csv"))
     if interact:
+        if dataframe:
+            df = read_logs(df_path)
+        else:
+            df = reader.to_df(workers=workers, merge=True)
         print("Synced dataframe is bound to `df`")
         code.interact(local=locals())
 
+def get_dataframe_path(c, world, minecraft_username=None):
+    "Returns the path of the log store for a world, or for one user's data"
+    if minecraft_username:
+        df_fn = world + "_" + minecraft_username + ".parquet"
+    else:
+        df_fn = world + ".parquet"
+    return Path(c.local.dataframe_path) / df_fn
+
+@task(help={
+    "logs_path": "log file or directory of log files to parse",
+    "lines": "maximum number of lines to parse",
+})
+def benchmark_parser(c, logs_path, lines=100000):
+    "Compare the speed of the line-by-line and fast-path log parsers"
+    from logs.benchmark import benchmark_parsers
+
+    results = benchmark_parsers(logs_path, max_lines=int(lines))
+    print("Parsed {:,} lines".format(results["lines"]))
+    print("parse_line:  {:>12,.0f} lines/sec".format(results["parse_line"]))
+    print("parse_lines: {:>12,.0f} lines/sec".format(results["parse_lines"]))
+    print("Speedup: {:.1f}x".format(results["parse_lines"] / results["parse_line"]))
+
+@task(help={
+    "logs_path": "log file or directory of log files to parse",
+    "workers": "number of processes to use when parsing log files",
+    "merge": "merge files' events in time order",
+})
+def check_reader(c, logs_path, workers=None, merge=False):
+    "Check that the log reader gives the same columns and dtypes as parsing line by line"
+    from logs.benchmark import check_to_df
+
+    differences = check_to_df(logs_path, workers=int(workers) if workers else None, merge=merge)
+    for difference in differences:
+        print(difference)
+    if differences:
+        sys.exit(1)
+    print("to_df matches the line-by-line reader")
+
 @task(help={
     "world": "name of world",
     "minecraft_username": "optional: sync one user's data",
@@ -51,23 +104,52 @@ def sync(c, world, minecraft_username=None, dataframe=True, interact=False):
 def interact(c, world, minecraft_username=None):
     "Drop into interactive console with the selected dataframe loaded"
     import pandas as pd
+    from logs.store import read_logs
 
-    if minecraft_username:
-        df_fn = world + "_" + minecraft_username + ".csv"
-    else:
-        df_fn = world + ".csv"
-    df_path = Path(c.local.dataframe_path) / df_fn
-    df = pd.read_csv(
-        Path(c.local.dataframe_path) / df_fn,
-        index_col="timestamp", 
-        parse_dates=["timestamp"],
-        date_parser=lambda x: pd.to_datetime(x, utc=True),
-    )
+    df = read_logs(get_dataframe_path(c, world, minecraft_username), utc=True)
     print("Synced dataframe is bound to `df`")
     code.interact(local=locals())
 
-@task
-def export_segment(c, params_file, clean=False, dryrun=False):
+@task(iterable=["players"], help={
+    "world": "name of world",
+    "players": "username of a player; give at least two",
+    "start": "optional: only read logs from this time",
+    "end": "optional: only read logs until this time",
+    "output": "write transitions to this CSV file instead of printing them",
+    "distance_threshold": "maximum distance between players' target blocks",
+    "window_seconds": "JVA lasts this long after players' target blocks are close",
+})
+def joint_attention(c, world, players, start=None, end=None, output=None, distance_threshold=6,
+        window_seconds=2):
+    "Stream joint attention transitions from a world's synced logs, in constant memory"
+    import csv
+    import pandas as pd
+    from logs.reader import LogReader
+    from joint_attention import JointAttentionStream
+
+    if len(players) < 2:
+        raise ValueError("Give at least two players")
+    reader = LogReader(Path(c.local.logs_path) / world, start=start, end=end, players=players)
+    stream = JointAttentionStream(players, float(distance_threshold), float(window_seconds))
+    fh = open(output, "w", newline="") if output else sys.stdout
+    try:
+        writer = csv.writer(fh)
+        writer.writerow(["timestamp", "pair", "jva"])
+        for transition in stream.run(reader.iter_merged_events()):
+            writer.writerow([pd.Timestamp(transition["timestamp"]).isoformat(), transition["pair"], transition["jva"]])
+    finally:
+        if output:
+            fh.close()
+
+@task(help={
+    "workers": "number of processes to use to export independent products concurrently",
+    "subprocess_workers": "maximum number of concurrent ffmpeg/npm products",
+    "incremental": "reuse the export dir, only exporting products which changed",
+    "dryrun": "print an estimate of what the export would read, its memory and time, without exporting",
+    "profile": "also write cProfile stats to profile.prof in the export dir",
+})
+def export_segment(c, params_file, clean=False, dryrun=False, workers=1, subprocess_workers=2, 
+        incremental=False, profile=False):
     "Export a segment as speficied by a params file"
     from segment import Segment
 
@@ -77,7 +159,63 @@ def export_segment(c, params_file, clean=False, dryrun=False):
     params = yaml.safe_load(pf.read_text())
     segment = Segment(params)
     segment.validate()
-    segment.export(clean=clean)
+    if dryrun:
+        from segment.planner import format_plan
+        print(format_plan(segment.dry_run(clean=clean, incremental=incremental)))
+        return
+    segment.export(clean=clean, workers=workers, subprocess_workers=subprocess_workers, 
+            incremental=incremental, cprofile=profile)
+
+@task(iterable=["params_files"], help={
+    "params_files": "a params file or glob of params files; may be given more than once",
+    "clean": "replace existing export dirs",
+    "workers": "number of segments to export concurrently",
+    "incremental": "reuse export dirs, only exporting products which changed",
+})
+def export_segments(c, params_files, clean=False, workers=1, incremental=False):
+    "Export many segments, loading the logs they share once"
+    from glob import glob
+    from segment import Segment
+    from segment.batch import export_segments
+
+    paths = sorted({path for pattern in params_files for path in glob(pattern)})
+    if not paths:
+        raise ValueError("No params files match {}".format(", ".join(params_files)))
+    segments = []
+    for path in paths:
+        segment = Segment(yaml.safe_load(Path(path).read_text()))
+        segment.validate()
+        segments.append(segment)
+    failures = export_segments(segments, clean=clean, workers=workers, incremental=incremental)
+    print("Exported {} of {} segments".format(len(segments) - len(failures), len(segments)))
+    if failures:
+        raise ValueError("Failed to export:\n{}".format("\n".join(" - " + d for d in failures)))
+
+@task(help={
+    "entries": "list the cache's entries",
+    "budget": "set the cache's disk budget, in MB",
+    "prune": "evict least recently used entries until the cache fits its budget",
+    "clear": "delete all cache entries",
+})
+def cache(c, entries=False, budget=None, prune=False, clear=False):
+    "Inspect and prune the cache of data derived from the logs"
+    from cache import CacheManager
+
+    cache = CacheManager()
+    if clear:
+        print("Deleted {} entries".format(len(cache.clear())))
+    if budget:
+        print("Evicted {} entries".format(len(cache.set_budget(int(float(budget) * 1024 ** 2)))))
+    if prune:
+        print("Pruned {} entries".format(len(cache.prune())))
+    stats = cache.stats()
+    if entries:
+        for key, entry in sorted(stats["entries"].items(), key=lambda item: item[1]["last_used"]):
+            print("{:<48} {:>10.1f} MB  last used {}  {} hits".format(
+                    key, entry["size"] / 1024 ** 2, entry["last_used"][:19], entry["hits"]))
+    print("{} entries, {:.1f} of {:.1f} MB".format(
+            stats["num_entries"], stats["size"] / 1024 ** 2, stats["budget"] / 1024 ** 2))
+    print("{} hits, {} misses ({:.0%} hit rate)".format(stats["hits"], stats["misses"], stats["hit_rate"]))
 
 @task
 def manifest(c, time=None, interact=False):
@@ -144,8 +282,10 @@ def localize(c, time, media_path, duration=None, end=None, reverse=False):
     else:
         print(f"{segment_start_media}")
 
-@task
-def analysis(c, params_file, clean=False):
+@task(help={
+    "profile": "also write cProfile stats to profile.prof in the export dir",
+})
+def analysis(c, params_file, clean=False, profile=False):
     "Compute named analysis"
     from analysis import MODELS
 
@@ -160,6 +300,6 @@ def analysis(c, params_file, clean=False):
     model = Model(params)
     model.validate()
     model.prepare_export_dir(clean=clean)
-    model.export()
+    model.run(cprofile=profile)
     
 